@@ -5,4 +5,12 @@ class TooPathConfig(AppConfig):
     name = 'TooPath3'
 
     def ready(self):
-        import TooPath3.devices.signals
\ No newline at end of file
+        import TooPath3.devices.signals
+        import TooPath3.stream.signals
+        import TooPath3.caching
+        import TooPath3.conditional
+        import TooPath3.jobs
+        import TooPath3.archive
+        import TooPath3.proximity
+        import TooPath3.stops
+
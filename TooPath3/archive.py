@@ -0,0 +1,252 @@
+import datetime
+import functools
+import os
+import struct
+import zlib
+
+import numpy as np
+from django.conf import settings
+from django.contrib.gis.geos import Point
+from django.db import connection, transaction
+from django.db.models import Max
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from TooPath3.jobs import handler
+from TooPath3.models import Track, TrackLocation
+from TooPath3.packing import pack, unpack
+from TooPath3.renderers import batches
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=timezone.utc)
+MICROSECOND = datetime.timedelta(microseconds=1)
+# Every column is stored as the differences between consecutive values, which are small for points in id order and
+# compress far better than the values. Coordinates are differenced as the bits of their doubles, so they come back
+# exactly. NULL device ids are stored as 0 and NULL sequence numbers as -1.
+INTEGER_COLUMNS = ('id', 'created_at', 'updated_at', 'device', 'seq')
+FLOAT_COLUMNS = ('x', 'y')
+# An archive is MAGIC, the number of columns, an ENTRY per column and then the zlib-compressed columns.
+MAGIC = b'TPA1'
+COUNT = struct.Struct('<I')
+ENTRY = struct.Struct('<16sQQ')
+# Written once and read many times: the slowest level costs nothing when reading.
+COMPRESSION_LEVEL = 9
+
+# Points still in the table are skipped, and so are those a device uploaded again after an older release archived
+# them with their sequence number.
+RESTORE_TRACK_LOCATIONS = '''
+    INSERT INTO track_locations (id, point, created_at, updated_at, track_id, device_id, seq)
+    SELECT archived.id, ST_SetSRID(ST_MakePoint(archived.x, archived.y), 4326), archived.created_at,
+           archived.updated_at, %(track)s, archived.device_id, archived.seq
+    FROM unnest(%(ids)s::integer[], %(xs)s::float8[], %(ys)s::float8[], %(created)s::timestamptz[],
+                %(updated)s::timestamptz[], %(devices)s::integer[], %(seqs)s::bigint[])
+         AS archived (id, x, y, created_at, updated_at, device_id, seq)
+    ON CONFLICT DO NOTHING
+'''
+
+
+def archive_path(tid):
+    return os.path.join(settings.TOOPATH_ARCHIVE_DIR, '%03d' % (tid % 1000), '%d.cols' % tid)
+
+
+def _microseconds(date):
+    return (date - EPOCH) // MICROSECOND
+
+
+def _date(microseconds):
+    return EPOCH + datetime.timedelta(microseconds=int(microseconds))
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def columns_of(locations):
+    return {
+        'id': np.array([location.id for location in locations], dtype=np.int64),
+        'x': np.array([location.point.x for location in locations], dtype=np.float64),
+        'y': np.array([location.point.y for location in locations], dtype=np.float64),
+        'created_at': np.array([_microseconds(location.created_at) for location in locations], dtype=np.int64),
+        'updated_at': np.array([_microseconds(location.updated_at) for location in locations], dtype=np.int64),
+        'device': np.array([location.device_id or 0 for location in locations], dtype=np.int64),
+        'seq': np.array([-1 if location.seq is None else location.seq for location in locations], dtype=np.int64),
+    }
+
+
+def locations_of(tid, columns, indexes=None):
+    """
+     TrackLocation instances of the archived rows at `indexes`, all of them by default.
+    """
+    return [
+        TrackLocation(id=int(columns['id'][i]), point=Point(float(columns['x'][i]), float(columns['y'][i]), srid=4326),
+                      created_at=_date(columns['created_at'][i]), updated_at=_date(columns['updated_at'][i]),
+                      track_id=tid, device_id=int(columns['device'][i]) or None,
+                      seq=None if columns['seq'][i] < 0 else int(columns['seq'][i]))
+        for i in (range(len(columns['id'])) if indexes is None else indexes)
+    ]
+
+
+def write_archive(tid, columns):
+    """
+     Writes the columns to the track's archive, replacing it at once: readers see either the old file or the new one.
+    """
+    encoded = {name: np.diff(columns[name], prepend=np.int64(0)) for name in INTEGER_COLUMNS}
+    # Unsigned differences wrap around instead of overflowing, which the cumulative sum undoes exactly.
+    encoded.update({name: np.diff(columns[name].view(np.uint64), prepend=np.uint64(0)) for name in FLOAT_COLUMNS})
+    blobs = [(name, zlib.compress(encoded[name].tobytes(), COMPRESSION_LEVEL)) for name in sorted(encoded)]
+    offset = len(MAGIC) + COUNT.size + ENTRY.size * len(blobs)
+    entries = []
+    for name, blob in blobs:
+        entries.append(ENTRY.pack(name.encode('ascii'), offset, len(blob)))
+        offset += len(blob)
+    path = archive_path(tid)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(MAGIC + COUNT.pack(len(blobs)) + b''.join(entries))
+        for name, blob in blobs:
+            f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+
+def read_archive(tid):
+    """
+     The columns of the track's archive, or None when it has none. Every column is decompressed whole, so the file is
+     read in one go.
+    """
+    try:
+        with open(archive_path(tid), 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    encoded = {}
+    with memoryview(data) as view:
+        if view[:len(MAGIC)] != MAGIC:
+            raise ValueError('%s is not a track archive.' % archive_path(tid))
+        count, = COUNT.unpack_from(view, len(MAGIC))
+        for i in range(count):
+            name, offset, length = ENTRY.unpack_from(view, len(MAGIC) + COUNT.size + i * ENTRY.size)
+            name = name.rstrip(b'\x00').decode('ascii')
+            dtype = np.uint64 if name in FLOAT_COLUMNS else np.int64
+            encoded[name] = np.frombuffer(zlib.decompress(view[offset:offset + length]), dtype=dtype)
+    columns = {name: np.cumsum(encoded[name], dtype=np.int64) for name in INTEGER_COLUMNS}
+    columns.update({name: np.cumsum(encoded[name], dtype=np.uint64).view(np.float64) for name in FLOAT_COLUMNS})
+    return columns
+
+
+def archived_columns(track):
+    """
+     The columns of the points moved out of the table: packed in the track's row, or else in its archive file.
+    """
+    if track.packed is not None:
+        return unpack(track.packed)
+    return read_archive(track.tid)
+
+
+def track_locations(track, hot=None):
+    """
+     The locations of the track, archived ones included, in id order: only those of `hot` from the table when given.
+     Tracks never archived are left to the ORM, and to whatever was prefetched.
+    """
+    if hot is None:
+        hot = track.locations.all()
+    if not track.archived_points:
+        return hot
+    columns = archived_columns(track)
+    locations = {location.id: location for location in (locations_of(track.tid, columns) if columns else [])}
+    # A point both archived and still in the table, left by an interrupted archiving, is only served once.
+    locations.update((location.id, location) for location in hot)
+    return [locations[pk] for pk in sorted(locations)]
+
+
+def location_batches(track, size):
+    if not track.archived_points:
+        return batches(track.locations.all(), size)
+    locations = track_locations(track)
+    return (locations[i:i + size] for i in range(0, len(locations), size))
+
+
+def _move_out(tid, packed):
+    """
+     Moves the points of the track from the table, merged with those moved out before, into a blob in its row when
+     `packed` or else into its archive file.
+    """
+    with transaction.atomic():
+        track = Track.objects.select_for_update().filter(pk=tid, trash=False).first()
+        if track is None:
+            return
+        # Points uploaded with a sequence number stay in the table: its (device_id, seq) index is what skips them when
+        # the device uploads them again, and what its high-water mark is read from (see TooPath3/locations/queries.py).
+        hot = list(TrackLocation.objects.filter(track=track, seq__isnull=True).order_by('id'))
+        in_file = bool(track.archived_points) and track.packed is None
+        moved = track.packed is not None if packed else in_file
+        if not hot and (moved or not track.archived_points):
+            return
+        locations = track_locations(track, hot) if track.archived_points else hot
+        columns = columns_of(locations)
+        if packed:
+            track.packed = pack(columns)
+        else:
+            write_archive(tid, columns)
+            track.packed = None
+        # By id: a point added while this ran stays in the table. No signals, the track's output doesn't change.
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM track_locations WHERE id = ANY(%s)', [[location.id for location in hot]])
+        track.archived_points = len(locations)
+        track.save(update_fields=['archived_points', 'packed', 'updated_at'])
+        if packed and in_file:
+            transaction.on_commit(functools.partial(_remove, archive_path(tid)))
+
+
+@handler('archive_track')
+def archive_track(tid):
+    _move_out(tid, packed=False)
+
+
+@handler('pack_track')
+def pack_track(tid):
+    _move_out(tid, packed=True)
+
+
+def restore_track(track):
+    """
+     Moves the archived points of the track back into the table, for the writes that need them there.
+    """
+    with transaction.atomic():
+        track = Track.objects.select_for_update().get(pk=track.pk)
+        in_file = track.packed is None
+        columns = archived_columns(track)
+        if columns is not None:
+            with connection.cursor() as cursor:
+                cursor.execute(RESTORE_TRACK_LOCATIONS, {
+                    'track': track.tid, 'ids': columns['id'].tolist(), 'xs': columns['x'].tolist(),
+                    'ys': columns['y'].tolist(), 'created': [_date(value) for value in columns['created_at']],
+                    'updated': [_date(value) for value in columns['updated_at']],
+                    'devices': [value or None for value in columns['device'].tolist()],
+                    'seqs': [None if value < 0 else value for value in columns['seq'].tolist()]})
+        track.archived_points = 0
+        track.packed = None
+        track.save(update_fields=['archived_points', 'packed', 'updated_at'])
+        if in_file:
+            transaction.on_commit(functools.partial(_remove, archive_path(track.tid)))
+    return track
+
+
+def cold_tracks(days):
+    """
+     Ids of the tracks with points in the table that can be archived, none of them updated in the last `days` days.
+    """
+    cutoff = timezone.now() - datetime.timedelta(days=days)
+    return (Track.objects.filter(trash=False, locations__seq__isnull=True).values('tid')
+            .annotate(last_updated=Max('locations__updated_at')).filter(last_updated__lt=cutoff)
+            .values_list('tid', flat=True))
+
+
+@receiver(post_delete, sender=Track)
+def remove_archive(sender, instance, **kwargs):
+    if instance.archived_points and instance.packed is None:
+        transaction.on_commit(functools.partial(_remove, archive_path(instance.tid)))
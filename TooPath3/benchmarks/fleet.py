@@ -0,0 +1,70 @@
+import random
+
+import numpy as np
+from django.contrib.auth.hashers import make_password
+from django.contrib.gis.geos import Point
+from django.db import connection
+from django.utils import timezone
+
+from TooPath3.benchmarks.synthetic import copy_track_locations
+from TooPath3.models import CustomUser, Device, Track, ActualLocation
+from TooPath3.utils import generate_token_for_user
+
+BENCHMARK_PASSWORD = 'benchmark'
+# Every user the benchmarks create, the fleet's and the scenarios' own, has an email in this domain.
+BENCHMARK_DOMAIN = '@toopath.test'
+
+
+class Fleet(object):
+    """
+     Users with their devices, tracks and points, built with bulk inserts for the benchmarks.
+    """
+
+    def __init__(self, users, devices, tracks, points, seed=0):
+        self.size = {'users': users, 'devices': devices, 'tracks': tracks, 'points': points}
+        self.seed = seed
+        self.users = []
+        self.tokens = {}
+        self.devices = {}
+        self.tracks = {}
+
+    def build(self):
+        rng = random.Random(self.seed)
+        password = make_password(BENCHMARK_PASSWORD)
+        self.users = CustomUser.objects.bulk_create(
+            CustomUser(username='bench%d' % n, email='bench%d%s' % (n, BENCHMARK_DOMAIN), password=password)
+            for n in range(self.size['users']))
+        track_ids = []
+        now = timezone.now()
+        for user in self.users:
+            self.tokens[user.pk] = generate_token_for_user(user)
+            self.devices[user.pk] = Device.objects.bulk_create(
+                Device(name='device %d' % n, owner=user, device_type=rng.choice(Device.TYPE_CHOICES)[0])
+                for n in range(self.size['devices']))
+            devices = self.devices[user.pk]
+            ActualLocation.objects.bulk_create(
+                ActualLocation(device=device, point=Point(rng.uniform(-9, 3), rng.uniform(36.5, 43.5)))
+                for device in devices)
+            for device in devices:
+                self.tracks[device.pk] = Track.objects.bulk_create(
+                    Track(name='track %d' % n, device=device, points=self.size['points'], points_updated_at=now)
+                    for n in range(self.size['tracks']))
+                track_ids.extend(track.pk for track in self.tracks[device.pk])
+        with connection.cursor() as cursor:
+            copy_track_locations(cursor, track_ids, self.size['points'], np.random.default_rng(self.seed))
+        return self
+
+    def destroy(self):
+        """
+         Deletes the fleet and whatever the benchmarks added to it, with the users they created.
+        """
+        CustomUser.objects.filter(email__endswith=BENCHMARK_DOMAIN).delete()
+
+    def sample(self, rng):
+        """
+         Returns a random (user, token, device, track) of the fleet.
+        """
+        user = rng.choice(self.users)
+        device = rng.choice(self.devices[user.pk])
+        track = rng.choice(self.tracks[device.pk])
+        return user, self.tokens[user.pk], device, track
@@ -0,0 +1,346 @@
+import platform
+import re
+import subprocess
+import threading
+import time
+import tracemalloc
+from contextlib import ExitStack
+from urllib.parse import urlencode
+
+import django
+import requests
+from django.core.servers.basehttp import WSGIRequestHandler, WSGIServer
+from django.core.wsgi import get_wsgi_application
+from django.db import connections
+from django.db.models import Max, Min
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from TooPath3.benchmarks.fleet import BENCHMARK_DOMAIN, BENCHMARK_PASSWORD
+from TooPath3.models import TrackLocation
+from TooPath3.utils import create_device_with_owner, create_track_with_device, create_track_location_with_track, \
+    create_user_with_email, generate_token_for_user
+
+MEMORY_SAMPLES = 20
+
+
+class Scenario(object):
+    """
+     A request against one route of `TooPath3/urls.py`. `setup` prepares what the request consumes, like the
+     device a DELETE removes, and is not timed.
+    """
+
+    def __init__(self, endpoint, method, path, body=None, setup=None):
+        self.endpoint = endpoint
+        self.method = method
+        self.path = path
+        self.body = body
+        self.setup = setup or sample
+
+    @property
+    def name(self):
+        return '%s %s' % (self.endpoint, self.method)
+
+
+def sample(fleet, rng):
+    user, token, device, track = fleet.sample(rng)
+    return {'user': user, 'token': token, 'device': device, 'track': track,
+            'location': TrackLocation.objects.filter(track=track).only('pk').first()}
+
+
+def new_device(fleet, rng):
+    context = sample(fleet, rng)
+    context['device'] = create_device_with_owner(context['user'])
+    return context
+
+
+def new_track(fleet, rng):
+    context = sample(fleet, rng)
+    context['track'] = create_track_with_device(context['device'])
+    return context
+
+
+def new_location(fleet, rng):
+    context = sample(fleet, rng)
+    context['location'] = create_track_location_with_track(context['track'])
+    return context
+
+
+def new_user(fleet, rng):
+    user = create_user_with_email('bench-%d%s' % (rng.getrandbits(48), BENCHMARK_DOMAIN))
+    return {'user': user, 'token': generate_token_for_user(user)}
+
+
+def unique_email(fleet, rng):
+    return {'token': None, 'email': 'bench-%d%s' % (rng.getrandbits(48), BENCHMARK_DOMAIN)}
+
+
+def track_time(fleet, rng):
+    context = sample(fleet, rng)
+    times = TrackLocation.objects.filter(track=context['track']).aggregate(first=Min('created_at'),
+                                                                           last=Max('created_at'))
+    context['at'] = times['first'] + (times['last'] - times['first']) / 2 if times['first'] else timezone.now()
+    return context
+
+
+def new_sync_batch(fleet, rng):
+    context = sample(fleet, rng)
+    # Numbers the device never used, so the batch is stored rather than skipped as already synced.
+    first = rng.getrandbits(48)
+    context['locations'] = [dict(point(context), seq=first + n) for n in range(100)]
+    return context
+
+
+def device_path(suffix=''):
+    return lambda c: '/devices/%d/%s' % (c['device'].pk, suffix)
+
+
+def track_path(suffix=''):
+    return lambda c: '/devices/%d/tracks/%d/%s' % (c['device'].pk, c['track'].pk, suffix)
+
+
+def location_path(c):
+    return '/devices/%d/tracks/%d/locations/%d/' % (c['device'].pk, c['track'].pk, c['location'].pk)
+
+
+def user_path(c):
+    return '/users/%d/' % c['user'].pk
+
+
+def point(c):
+    return {'point': {'type': 'Point', 'coordinates': [41.38, 2.17]}}
+
+
+SCENARIOS = [
+    Scenario('device-list', 'GET', lambda c: '/devices/'),
+    Scenario('device-list', 'POST', lambda c: '/devices/', body=lambda c: {'name': 'bench'}),
+    Scenario('device-detail', 'GET', device_path()),
+    Scenario('device-detail', 'PATCH', device_path(), body=lambda c: {'description': 'bench'}),
+    Scenario('device-detail', 'PUT', device_path(), body=lambda c: {'name': c['device'].name}),
+    Scenario('device-detail', 'DELETE', device_path(), setup=new_device),
+    Scenario('device-nearby', 'GET', lambda c: '/devices/nearby/?point=-3.7,40.4&radius=50000'),
+    Scenario('device-clusters', 'GET', lambda c: '/devices/clusters/?bbox=-9,36.5,3,43.5&zoom=6'),
+    Scenario('device-actual-location', 'GET', device_path('actualLocation/')),
+    Scenario('device-actual-location', 'PUT', device_path('actualLocation/'), body=point),
+    Scenario('track-list', 'GET', device_path('tracks/')),
+    Scenario('track-list', 'POST', device_path('tracks/'), body=lambda c: {'name': 'bench'}),
+    Scenario('track-detail', 'GET', track_path()),
+    Scenario('track-detail', 'PATCH', track_path(), body=lambda c: {'description': 'bench'}),
+    Scenario('track-detail', 'PUT', track_path(), body=lambda c: {'name': c['track'].name,
+                                                                   'device': c['device'].pk}),
+    Scenario('track-detail', 'DELETE', track_path(), setup=new_track),
+    Scenario('track-nearest', 'GET', lambda c: track_path('nearest/')(c) + '?point=2.17,41.38&k=5'),
+    Scenario('track-position', 'GET', lambda c: track_path('position/')(c) + '?' + urlencode(
+        {'at': c['at'].isoformat()}), setup=track_time),
+    Scenario('track-stops', 'GET', track_path('stops/')),
+    Scenario('track-location-list', 'GET', lambda c: track_path('locations/')(c) + '?max_points=1000'),
+    Scenario('track-location-list', 'POST', track_path('locations/'), body=point),
+    Scenario('track-sync', 'GET', track_path('sync/')),
+    Scenario('track-sync', 'POST', track_path('sync/'), body=lambda c: {'locations': c['locations']},
+             setup=new_sync_batch),
+    Scenario('track-location-detail', 'DELETE', location_path, setup=new_location),
+    Scenario('user-detail', 'GET', user_path),
+    Scenario('user-detail', 'PATCH', user_path, body=lambda c: {'first_name': 'bench'}),
+    Scenario('user-detail', 'PUT', user_path, body=lambda c: {'username': c['user'].username,
+                                                               'email': c['user'].email,
+                                                               'password': BENCHMARK_PASSWORD}),
+    Scenario('user-detail', 'DELETE', user_path, setup=new_user),
+    Scenario('user-list', 'POST', lambda c: '/users/',
+             body=lambda c: {'username': c['email'], 'email': c['email'], 'password': BENCHMARK_PASSWORD},
+             setup=unique_email),
+    Scenario('login', 'POST', lambda c: '/login/',
+             body=lambda c: {'email': c['user'].email, 'password': BENCHMARK_PASSWORD}),
+    Scenario('api-token-refresh', 'POST', lambda c: '/api-token-refresh/', body=lambda c: {'token': c['token']}),
+    Scenario('api-token-verify', 'POST', lambda c: '/api-token-verify/', body=lambda c: {'token': c['token']}),
+    Scenario('metrics', 'GET', lambda c: '/metrics/'),
+]
+
+# `login-google` needs a token signed by Google and is left out.
+
+
+class InProcessClient(object):
+    mode = 'inprocess'
+
+    def __init__(self):
+        self.client = APIClient()
+
+    def request(self, method, path, token, body):
+        self.client.credentials(HTTP_AUTHORIZATION='JWT ' + token if token else '')
+        with ExitStack() as stack:
+            captured = [stack.enter_context(CaptureQueriesContext(connection)) for connection in connections.all()]
+            response = getattr(self.client, method.lower())(path, data=body, format='json')
+            size = sum(len(chunk) for chunk in response.streaming_content) if response.streaming else len(
+                response.content)
+        return response.status_code, size, sum(len(queries) for queries in captured)
+
+    def query_totals(self):
+        return None
+
+
+class HttpClient(object):
+    """
+     Drives a running server. Its query counts come from the server's own `/metrics/`.
+    """
+    mode = 'http'
+    QUERIES = re.compile(r'^toopath_request_queries_(sum|count)\{endpoint="([^"]*)",method="([^"]*)"\} (\S+)$', re.M)
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.session = requests.Session()
+
+    def request(self, method, path, token, body):
+        headers = {'Authorization': 'JWT ' + token} if token else {}
+        response = self.session.request(method, self.url + path, json=body, headers=headers)
+        return response.status_code, len(response.content), None
+
+    def query_totals(self):
+        try:
+            text = self.session.get(self.url + '/metrics/').text
+        except requests.RequestException:
+            return None
+        totals = {}
+        for kind, endpoint, method, value in self.QUERIES.findall(text):
+            totals.setdefault((endpoint, method), {})[kind] = float(value)
+        return totals
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class LiveServer(threading.Thread):
+    """
+     Serves the project over HTTP from a background thread, against the same database as the benchmark.
+    """
+
+    def __init__(self):
+        super(LiveServer, self).__init__(daemon=True)
+        self.ready = threading.Event()
+        self.httpd = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.httpd.server_address[1]
+
+    def run(self):
+        self.httpd = WSGIServer(('127.0.0.1', 0), QuietRequestHandler)
+        self.httpd.set_app(get_wsgi_application())
+        self.ready.set()
+        try:
+            self.httpd.serve_forever()
+        finally:
+            connections.close_all()
+
+    def start(self):
+        super(LiveServer, self).start()
+        self.ready.wait()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.join()
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def run_scenario(client, scenario, fleet, rng, requests_count, warmup):
+    latencies = []
+    query_counts = []
+    sizes = []
+    statuses = {}
+    totals_before = client.query_totals()
+    for n in range(warmup + requests_count):
+        context = scenario.setup(fleet, rng)
+        body = scenario.body(context) if scenario.body else None
+        start = time.perf_counter()
+        status, size, queries = client.request(scenario.method, scenario.path(context), context['token'], body)
+        elapsed = time.perf_counter() - start
+        if n < warmup:
+            continue
+        latencies.append(elapsed)
+        sizes.append(size)
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+        if queries is not None:
+            query_counts.append(queries)
+
+    if not query_counts and totals_before is not None:
+        before = totals_before.get((scenario.endpoint, scenario.method), {})
+        after = client.query_totals().get((scenario.endpoint, scenario.method), {})
+        handled = after.get('count', 0) - before.get('count', 0)
+        if handled:
+            query_counts = [(after.get('sum', 0) - before.get('sum', 0)) / handled]
+
+    return {
+        'endpoint': scenario.endpoint,
+        'method': scenario.method,
+        'requests': requests_count,
+        'statuses': statuses,
+        'p50_ms': _ms(percentile(latencies, 0.50)),
+        'p95_ms': _ms(percentile(latencies, 0.95)),
+        'p99_ms': _ms(percentile(latencies, 0.99)),
+        'mean_ms': _ms(sum(latencies) / len(latencies)) if latencies else None,
+        'throughput_rps': len(latencies) / sum(latencies) if latencies else None,
+        'queries_per_request': sum(query_counts) / len(query_counts) if query_counts else None,
+        'response_bytes': sum(sizes) / len(sizes) if sizes else None,
+        'peak_memory_kb': peak_memory(client, scenario, fleet, rng),
+    }
+
+
+def peak_memory(client, scenario, fleet, rng):
+    # tracemalloc slows everything down, so memory is measured in a pass of its own and only in-process.
+    if client.mode != 'inprocess':
+        return None
+    contexts = [scenario.setup(fleet, rng) for n in range(MEMORY_SAMPLES)]
+    tracemalloc.start()
+    try:
+        for context in contexts:
+            body = scenario.body(context) if scenario.body else None
+            client.request(scenario.method, scenario.path(context), context['token'], body)
+        return tracemalloc.get_traced_memory()[1] / 1024.0
+    finally:
+        tracemalloc.stop()
+
+
+def _ms(seconds):
+    return seconds * 1000.0 if seconds is not None else None
+
+
+def run(client, fleet, rng, requests_count, warmup, scenarios=None):
+    return {scenario.name: run_scenario(client, scenario, fleet, rng, requests_count, warmup)
+            for scenario in scenarios or SCENARIOS}
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'django': django.get_version(),
+            'platform': platform.platform(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}
+
+
+def compare(report, baseline, metrics=('p50_ms', 'p95_ms', 'p99_ms', 'queries_per_request')):
+    """
+     Returns a line per scenario and metric with the change against a previous report.
+    """
+    lines = []
+    for mode, results in sorted(report['results'].items()):
+        for name, result in sorted(results.items()):
+            previous = baseline.get('results', {}).get(mode, {}).get(name)
+            if previous is None:
+                continue
+            for metric in metrics:
+                old, new = previous.get(metric), result.get(metric)
+                if old is None or new is None:
+                    continue
+                change = (new - old) / old * 100.0 if old else 0.0
+                lines.append('%-9s %-36s %-20s %10.2f -> %10.2f (%+.1f%%)' % (mode, name, metric, old, new, change))
+    return lines
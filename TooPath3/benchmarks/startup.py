@@ -0,0 +1,69 @@
+"""
+ Boot probe run in a fresh interpreter by `manage.py benchmark_startup`:
+
+     python -m TooPath3.benchmarks.startup <wsgi module> <requests>
+
+ It imports the WSGI module, then sends unauthenticated requests straight to the application, which go through
+ every middleware and the DRF authentication but never reach the database. Prints its measures as JSON.
+"""
+import importlib
+import io
+import json
+import resource
+import sys
+import time
+
+PATH = '/devices/'
+WARMUP = 20
+
+
+def environ(path):
+    return {
+        'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'SCRIPT_NAME': '', 'QUERY_STRING': '',
+        'SERVER_NAME': '127.0.0.1', 'SERVER_PORT': '80', 'HTTP_HOST': '127.0.0.1', 'SERVER_PROTOCOL': 'HTTP/1.1',
+        'wsgi.version': (1, 0), 'wsgi.url_scheme': 'http', 'wsgi.input': io.BytesIO(), 'wsgi.errors': sys.stderr,
+        'wsgi.multithread': False, 'wsgi.multiprocess': True, 'wsgi.run_once': False,
+    }
+
+
+def request(application, path=PATH):
+    statuses = []
+    response = application(environ(path), lambda status, headers, exc_info=None: statuses.append(status))
+    try:
+        b''.join(response)
+    finally:
+        response.close()
+    return int(statuses[0].split()[0])
+
+
+def measure(module, requests_count):
+    modules = len(sys.modules)
+    start = time.perf_counter()
+    application = importlib.import_module(module).application
+    boot = time.perf_counter() - start
+
+    start = time.perf_counter()
+    status = request(application)
+    first = time.perf_counter() - start
+
+    for n in range(WARMUP):
+        request(application)
+    latencies = []
+    for n in range(requests_count):
+        start = time.perf_counter()
+        request(application)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return {
+        'boot_ms': boot * 1000.0,
+        'first_request_ms': first * 1000.0,
+        'request_p50_us': latencies[len(latencies) // 2] * 10 ** 6,
+        'request_p95_us': latencies[int(len(latencies) * 0.95)] * 10 ** 6,
+        'status': status,
+        'modules': len(sys.modules) - modules,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+if __name__ == '__main__':
+    print(json.dumps(measure(sys.argv[1], int(sys.argv[2]))))
@@ -0,0 +1,128 @@
+import io
+import struct
+import time
+
+import numpy as np
+import psycopg2
+
+# Points per COPY: a chunk is generated and written in one go, which bounds the memory of each worker.
+CHUNK_POINTS = 1000000
+SAMPLING_INTERVALS = (1.0, 5.0, 10.0, 30.0)
+DWELL_SWITCH_PROBABILITY = 0.002
+GPS_NOISE_METERS = 4.0
+METERS_PER_DEGREE_LAT = 110540.0
+METERS_PER_DEGREE_LON = 111320.0
+
+PG_EPOCH_US = 946684800 * 10 ** 6
+COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+COPY_TRAILER = struct.pack('>h', -1)
+EWKB_POINT_WITH_SRID = 0x20000001
+
+# One row of `COPY track_locations (track_id, point, created_at, updated_at) FROM STDIN (FORMAT binary)`: every
+# field is a big-endian length followed by its value, the point being a little-endian EWKB.
+TRACK_LOCATION_ROW = np.dtype([
+    ('fields', '>i2'),
+    ('track_id_length', '>i4'), ('track_id', '>i4'),
+    ('point_length', '>i4'), ('byte_order', 'u1'), ('wkb_type', '<u4'), ('srid', '<u4'), ('x', '<f8'), ('y', '<f8'),
+    ('created_at_length', '>i4'), ('created_at', '>i8'),
+    ('updated_at_length', '>i4'), ('updated_at', '>i8'),
+])
+
+COPY_TRACK_LOCATIONS = 'COPY track_locations (track_id, point, created_at, updated_at) FROM STDIN WITH (FORMAT binary)'
+
+
+def start_walks(rng, n_tracks, points, days):
+    # Every walk ends before now, at most `days` ago.
+    interval = rng.choice(SAMPLING_INTERVALS, n_tracks)
+    end_us = int(time.time() * 10 ** 6) - rng.integers(0, days * 86400 * 10 ** 6, n_tracks)
+    return {
+        'lon': rng.uniform(-9.0, 3.0, n_tracks),
+        'lat': rng.uniform(36.5, 43.5, n_tracks),
+        'heading': rng.uniform(0.0, 2 * np.pi, n_tracks),
+        'time': end_us - (points * interval * 1.2 * 10 ** 6).astype(np.int64),
+        'interval': interval,
+        'speed': rng.uniform(1.0, 25.0, n_tracks),
+        'dwelling': rng.random(n_tracks) < 0.1,
+    }
+
+
+def walk(rng, state, n_points):
+    """
+     Advances every walk of `state` by n_points fixes: random turns along a heading, a sampling rate per track with
+     jitter, stationary dwells and GPS noise. Returns (lon, lat, time_us) arrays shaped (tracks, n_points).
+    """
+    shape = (len(state['lon']), n_points)
+    dt = state['interval'][:, None] * rng.uniform(0.8, 1.2, shape)
+    switches = np.cumsum(rng.random(shape) < DWELL_SWITCH_PROBABILITY, axis=1)
+    dwelling = (switches + state['dwelling'][:, None]) % 2 == 1
+    heading = state['heading'][:, None] + np.cumsum(rng.normal(0.0, 0.15, shape), axis=1)
+    distance = state['speed'][:, None] * rng.lognormal(0.0, 0.2, shape) * dt * ~dwelling
+    meters_per_degree_lon = METERS_PER_DEGREE_LON * np.cos(np.radians(state['lat']))[:, None]
+
+    lat = state['lat'][:, None] + np.cumsum(distance * np.cos(heading), axis=1) / METERS_PER_DEGREE_LAT
+    lon = state['lon'][:, None] + np.cumsum(distance * np.sin(heading), axis=1) / meters_per_degree_lon
+    np.clip(lat, -85.0, 85.0, out=lat)
+    times = state['time'][:, None] + np.cumsum(dt * 10 ** 6, axis=1).astype(np.int64)
+
+    state.update(lon=lon[:, -1].copy(), lat=lat[:, -1].copy(), heading=heading[:, -1].copy(),
+                 time=times[:, -1].copy(), dwelling=dwelling[:, -1].copy())
+    noise = rng.normal(0.0, GPS_NOISE_METERS, (2,) + shape)
+    lon = (lon + noise[0] / meters_per_degree_lon + 180.0) % 360.0 - 180.0
+    return lon, lat + noise[1] / METERS_PER_DEGREE_LAT, times
+
+
+def track_location_rows(track_ids, lon, lat, times):
+    rows = np.empty(lon.size, dtype=TRACK_LOCATION_ROW)
+    rows['fields'] = 4
+    rows['track_id_length'] = 4
+    rows['track_id'] = np.repeat(track_ids, lon.shape[1])
+    rows['point_length'] = 25
+    rows['byte_order'] = 1
+    rows['wkb_type'] = EWKB_POINT_WITH_SRID
+    rows['srid'] = 4326
+    rows['x'] = lon.ravel()
+    rows['y'] = lat.ravel()
+    rows['created_at_length'] = 8
+    rows['created_at'] = times.ravel() - PG_EPOCH_US
+    rows['updated_at_length'] = 8
+    rows['updated_at'] = rows['created_at']
+    return rows
+
+
+def copy_track_locations(cursor, track_ids, points, rng, days=30):
+    """
+     Streams `points` synthetic fixes for each track with COPY. Returns the last (lon, lat, time_us) of each track,
+     NaN when it has no points.
+    """
+    track_ids = np.asarray(track_ids, dtype=np.int64)
+    last = (np.full(len(track_ids), np.nan), np.full(len(track_ids), np.nan), np.zeros(len(track_ids), np.int64))
+    tracks_per_chunk = max(1, CHUNK_POINTS // max(points, 1))
+    points_per_chunk = min(points, CHUNK_POINTS)
+    if points <= 0:
+        return last
+    for start in range(0, len(track_ids), tracks_per_chunk):
+        chunk = slice(start, start + tracks_per_chunk)
+        state = start_walks(rng, len(track_ids[chunk]), points, days)
+        remaining = points
+        while remaining > 0:
+            lon, lat, times = walk(rng, state, min(points_per_chunk, remaining))
+            rows = track_location_rows(track_ids[chunk], lon, lat, times)
+            cursor.copy_expert(COPY_TRACK_LOCATIONS, io.BytesIO(COPY_HEADER + rows.tobytes() + COPY_TRAILER))
+            remaining -= lon.shape[1]
+        last[0][chunk], last[1][chunk], last[2][chunk] = lon[:, -1], lat[:, -1], times[:, -1]
+    return last
+
+
+def generate_points(task):
+    """
+     Worker process entry point: fills its share of tracks over its own connection.
+    """
+    connection_params, track_ids, points, days, seed = task
+    start = time.perf_counter()
+    connection = psycopg2.connect(**connection_params)
+    try:
+        with connection, connection.cursor() as cursor:
+            last = copy_track_locations(cursor, track_ids, points, np.random.default_rng(seed), days)
+    finally:
+        connection.close()
+    return track_ids, last, len(track_ids) * points, time.perf_counter() - start
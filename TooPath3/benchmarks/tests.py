@@ -0,0 +1,99 @@
+import random
+import struct
+from unittest import mock
+
+import numpy as np
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.wsgi import get_wsgi_application
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+
+from TooPath3.benchmarks.fleet import Fleet
+from TooPath3.benchmarks.runner import InProcessClient, SCENARIOS, compare, percentile, run
+from TooPath3.benchmarks.startup import request
+from TooPath3.benchmarks.synthetic import PG_EPOCH_US, copy_track_locations, start_walks, track_location_rows, walk
+from TooPath3.models import CustomUser, Device, TrackLocation
+from TooPath3.utils import create_user_with_email, create_device_with_owner, create_track_with_device
+
+
+class PercentileCase(SimpleTestCase):
+    def test_percentiles_of_sorted_latencies(self):
+        latencies = [float(n) for n in range(1, 101)]
+        self.assertEqual(51.0, percentile(latencies, 0.50))
+        self.assertEqual(99.0, percentile(latencies, 0.99))
+
+    def test_compare_reports_the_change_per_metric(self):
+        baseline = {'results': {'inprocess': {'device-list GET': {'p50_ms': 10.0}}}}
+        report = {'results': {'inprocess': {'device-list GET': {'p50_ms': 5.0}}}}
+        self.assertIn('(-50.0%)', compare(report, baseline)[0])
+
+
+class StartupProbeCase(SimpleTestCase):
+    def test_unauthenticated_requests_go_through_the_application_without_the_database(self):
+        self.assertEqual(401, request(get_wsgi_application()))
+
+
+class FleetCase(TestCase):
+    def test_fleet_has_the_requested_size(self):
+        Fleet(users=2, devices=3, tracks=2, points=4).build()
+        self.assertEqual(6, Device.objects.count())
+        self.assertEqual(2 * 3 * 2 * 4, TrackLocation.objects.count())
+
+    def test_every_scenario_runs_in_process(self):
+        fleet = Fleet(users=1, devices=2, tracks=1, points=3).build()
+        report = run(InProcessClient(), fleet, random.Random(0), requests_count=2, warmup=0)
+        self.assertEqual(len(SCENARIOS), len(report))
+        for name, result in report.items():
+            self.assertFalse([status for status in result['statuses'] if status.startswith('5')], name)
+
+    def test_every_request_of_a_scenario_has_its_queries_counted(self):
+        fleet = Fleet(users=1, devices=2, tracks=1, points=3).build()
+        client = InProcessClient()
+        user, token, device, track = fleet.sample(random.Random(0))
+        counts = [client.request('GET', '/users/%d/' % user.pk, token, None)[2] for n in range(3)]
+        self.assertGreater(counts[0], 0)
+        self.assertEqual([counts[0]] * 3, counts)
+
+    def test_destroy_deletes_the_fleet(self):
+        create_user_with_email('someone@gmail.com')
+        Fleet(users=2, devices=1, tracks=1, points=2).build().destroy()
+        self.assertEqual(['someone@gmail.com'], list(CustomUser.objects.values_list('email', flat=True)))
+        self.assertFalse(TrackLocation.objects.exists())
+
+
+class BenchmarkCommandCase(SimpleTestCase):
+    def test_refuses_to_write_the_fleet_to_a_database_that_is_not_a_test_one(self):
+        with mock.patch.dict(connection.settings_dict, NAME='toopath'):
+            with self.assertRaises(CommandError):
+                call_command('benchmark', url='http://127.0.0.1:8000')
+
+
+class SyntheticTracesCase(SimpleTestCase):
+    def test_walks_are_time_ordered_and_continue_across_chunks(self):
+        rng = np.random.default_rng(0)
+        state = start_walks(rng, n_tracks=3, points=200, days=1)
+        lon, lat, times = walk(rng, state, 100)
+        more_lon, more_lat, more_times = walk(rng, state, 100)
+        self.assertEqual((3, 100), lon.shape)
+        self.assertTrue((np.diff(np.hstack([times, more_times]), axis=1) > 0).all())
+
+    def test_rows_are_laid_out_as_binary_copy_tuples(self):
+        rows = track_location_rows(np.array([7]), np.array([[2.5]]), np.array([[41.5]]), np.array([[PG_EPOCH_US]]))
+        row = rows.tobytes()
+        self.assertEqual(63, len(row))
+        self.assertEqual((4, 4, 7, 25), struct.unpack('>hiii', row[:14]))
+        self.assertEqual((1, 0x20000001, 4326, 2.5, 41.5), struct.unpack('<BIIdd', row[14:39]))
+        self.assertEqual((8, 0), struct.unpack('>iq', row[39:51]))
+
+
+class CopyTrackLocationsCase(TestCase):
+    def test_every_point_is_copied(self):
+        user = create_user_with_email('copy@gmail.com')
+        track = create_track_with_device(create_device_with_owner(user))
+        with connection.cursor() as cursor:
+            copy_track_locations(cursor, [track.tid], 250, np.random.default_rng(0))
+        locations = TrackLocation.objects.filter(track=track).order_by('id')
+        self.assertEqual(250, locations.count())
+        self.assertEqual(4326, locations[0].point.srid)
+        self.assertLess(locations[0].created_at, locations[249].created_at)
@@ -0,0 +1,141 @@
+import functools
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from rest_framework.response import Response
+from rest_framework.status import HTTP_200_OK
+
+from TooPath3.metrics import registry
+from TooPath3.models import Device, Track, TrackLocation, ActualLocation
+
+
+def version_key(kind, pk):
+    return 'version:%s:%s' % (kind, pk)
+
+
+def _cache():
+    return caches[settings.TOOPATH_RESPONSE_CACHE]
+
+
+def get_versions(keys):
+    """
+     Current version of every key. A version is a random token rather than a counter, so a key evicted from the
+     cache comes back with a value no cached response was ever stored under.
+    """
+    cache = _cache()
+    versions = cache.get_many(keys)
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        for key in missing:
+            cache.add(key, uuid.uuid4().hex, None)
+        versions.update(cache.get_many(missing))
+    return [versions.get(key, '') for key in keys]
+
+
+def _new_versions(keys):
+    _cache().set_many({key: uuid.uuid4().hex for key in keys}, None)
+
+
+def _committed_bump():
+    """
+     The callback of the current transaction that bumps its keys when it commits, registered on first use.
+    """
+    for savepoints, callback in connection.run_on_commit:
+        if hasattr(callback, 'keys'):
+            return callback
+    keys = set()
+
+    def callback():
+        _new_versions(keys)
+
+    callback.keys = keys
+    transaction.on_commit(callback)
+    return callback
+
+
+def bump(*keys):
+    """
+     Gives every key a new version, which orphans the responses cached under the old one. Inside a transaction
+     the keys it bumped are bumped again, all at once, when it commits, in case a concurrent request cached the
+     data it read before the commit.
+    """
+    if not settings.TOOPATH_RESPONSE_CACHE_ENABLED:
+        return
+    _new_versions(keys)
+    if connection.in_atomic_block:
+        # Looked for every time: a rollback drops it, with the keys of the savepoint it was registered in.
+        _committed_bump().keys.update(keys)
+
+
+def device_dependencies(d_pk, **kwargs):
+    # The device and every track it nests. Listing them also catches a track moved to another device.
+    tracks = Track.objects.filter(device_id=d_pk, trash=False).values_list('tid', flat=True)
+    return [version_key('device', d_pk)] + [version_key('track', tid) for tid in tracks]
+
+
+# Trashing a device bumps its version, which must hide its tracks and actual location too.
+
+def track_dependencies(d_pk, t_pk, **kwargs):
+    return [version_key('track', t_pk), version_key('device', d_pk)]
+
+
+def actual_location_dependencies(d_pk, **kwargs):
+    return [version_key('actual-location', d_pk), version_key('device', d_pk)]
+
+
+def cached_response(endpoint, dependencies):
+    """
+     Caches the data of a view's successful GET per user, under the versions of the objects it is built from.
+     Cached responses are only ever stored after the view checked the object permissions for that user, and are
+     kept apart per query string, which can ask for a sparse fieldset.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(view, request, **kwargs):
+            if not settings.TOOPATH_RESPONSE_CACHE_ENABLED:
+                return method(view, request, **kwargs)
+            keys = dependencies(**kwargs)
+            versions = ','.join('%s=%s' % item for item in zip(keys, get_versions(keys)))
+            arguments = ','.join('%s=%s' % item for item in sorted(kwargs.items()))
+            query = request.GET.urlencode()
+            key = 'response:%s:%s:%s:%s' % (endpoint, request.user.pk, arguments,
+                                            hashlib.md5((versions + '?' + query).encode('utf-8')).hexdigest())
+            labels = (('endpoint', endpoint),)
+            data = _cache().get(key)
+            if data is not None:
+                registry.inc('toopath_response_cache_hits_total', labels)
+                return Response(data=data, status=HTTP_200_OK)
+            registry.inc('toopath_response_cache_misses_total', labels)
+            response = method(view, request, **kwargs)
+            if response.status_code == HTTP_200_OK:
+                _cache().set(key, response.data, settings.TOOPATH_RESPONSE_CACHE_SECONDS)
+            return response
+        return wrapper
+    return decorator
+
+
+@receiver((post_save, post_delete), sender=Device)
+def device_changed(sender, instance, **kwargs):
+    bump(version_key('device', instance.pk))
+
+
+@receiver((post_save, post_delete), sender=Track)
+def track_changed(sender, instance, **kwargs):
+    bump(version_key('track', instance.pk), version_key('device', instance.device_id))
+
+
+# Saves only: a delete receiver would stop Django from deleting the locations of a track or device in a single
+# query, and those deletes bump their parent anyway. Views deleting a single location bump its track themselves.
+@receiver(post_save, sender=TrackLocation)
+def track_location_changed(sender, instance, **kwargs):
+    bump(version_key('track', instance.track_id))
+
+
+@receiver((post_save, post_delete), sender=ActualLocation)
+def actual_location_changed(sender, instance, **kwargs):
+    bump(version_key('actual-location', instance.pk))
@@ -0,0 +1,139 @@
+import math
+import threading
+
+from django.conf import settings
+
+from TooPath3.models import Device
+
+MAX_LATITUDE = 85.0511287798
+# A cluster covers a quarter of a 256 pixel map tile: the points of one zoom's cell are those within about
+# 64 pixels of each other on screen, and every cell splits into four at the next zoom.
+CELLS_PER_TILE = 4
+
+
+def mercator(x, y):
+    """
+     Web Mercator coordinates of a lon/lat point, both in [0, 1] from the north-west corner of the map.
+    """
+    sine = math.sin(math.radians(max(-MAX_LATITUDE, min(MAX_LATITUDE, y))))
+    return (x + 180.0) / 360.0, 0.5 - math.log((1 + sine) / (1 - sine)) / (4 * math.pi)
+
+
+def unmercator(mx, my):
+    return mx * 360.0 - 180.0, math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * my))))
+
+
+def cell_of(mx, my, zoom):
+    side = CELLS_PER_TILE << zoom
+    return min(int(mx * side), side - 1), min(int(my * side), side - 1)
+
+
+def accumulate(clusters, zoom, did, mx, my, sign=1):
+    """
+     Adds a point to, or with a `sign` of -1 takes it from, its cluster at `zoom`: a count, the sums of the
+     coordinates and the XOR of the device ids, which is the id itself when the cluster holds a single device.
+    """
+    cell = cell_of(mx, my, zoom)
+    cluster = clusters.get(cell)
+    if cluster is None:
+        cluster = clusters[cell] = [0, 0.0, 0.0, 0]
+    cluster[0] += sign
+    cluster[1] += sign * mx
+    cluster[2] += sign * my
+    cluster[3] ^= did
+    if not cluster[0]:
+        del clusters[cell]
+
+
+class ClusterPyramid(object):
+    """
+     The clusters of public devices at every zoom up to `max_zoom`, updated as devices move: a move takes the device
+     from its old cluster and adds it to its new one at each zoom, without reclustering anything else.
+    """
+
+    def __init__(self, max_zoom):
+        self.zooms = [{} for zoom in range(max_zoom + 1)]
+        self.lock = threading.Lock()
+
+    @property
+    def max_zoom(self):
+        return len(self.zooms) - 1
+
+    def _apply(self, did, x, y, privacy, sign):
+        if privacy != Device.PUBLIC:
+            return
+        mx, my = mercator(x, y)
+        with self.lock:
+            for zoom, clusters in enumerate(self.zooms):
+                accumulate(clusters, zoom, did, mx, my, sign)
+
+    def add(self, did, x, y, privacy):
+        self._apply(did, x, y, privacy, 1)
+
+    def remove(self, did, x, y, privacy):
+        self._apply(did, x, y, privacy, -1)
+
+    def clusters(self, zoom, columns, rows):
+        """
+         Copies of the clusters at `zoom` whose cells are in `columns` and `rows`, ranges of cell coordinates.
+        """
+        clusters = self.zooms[zoom]
+        with self.lock:
+            if len(columns) * len(rows) > len(clusters):
+                columns = set(columns)
+                return {cell: list(cluster) for cell, cluster in clusters.items()
+                        if cell[0] in columns and cell[1] in rows}
+            return {(column, row): list(clusters[column, row]) for column in columns for row in rows
+                    if (column, row) in clusters}
+
+
+def cell_ranges(west, south, east, north, zoom):
+    """
+     The cell columns and rows of a bounding box at `zoom`. Boxes across the antimeridian have west > east.
+    """
+    (first, bottom), (last, top) = (cell_of(*mercator(west, south), zoom=zoom),
+                                    cell_of(*mercator(east, north), zoom=zoom))
+    if west > east:
+        columns = list(range(first, CELLS_PER_TILE << zoom)) + list(range(0, last + 1))
+    elif east - west >= 360.0:
+        columns = range(CELLS_PER_TILE << zoom)
+    else:
+        columns = range(first, last + 1)
+    return columns, range(top, bottom + 1)
+
+
+def _inside(x, y, west, south, east, north):
+    return south <= y <= north and (west <= x <= east if west <= east else x >= west or x <= east)
+
+
+def device_clusters(index, user, west, south, east, north, zoom):
+    """
+     The zoom answered and the clusters of the devices `user` may see in the bounding box, as [lon, lat, count]
+     lists, with a fourth item, the device id, for clusters of one device.
+
+     Up to the pyramid's `max_zoom` the public devices come from it, otherwise the box is clustered from the grid
+     index, unless it spans more than TOOPATH_CLUSTER_MAX_SCAN_CELLS cells of it, in which case the pyramid's
+     `max_zoom` is answered. The user's own devices that aren't public are added to the clusters either way.
+    """
+    pyramid = index.pyramid
+    clusters = None
+    if zoom > pyramid.max_zoom:
+        grid_columns = index.columns_between(west, east)
+        if len(grid_columns) * (int((north - south) / index.cell) + 2) <= settings.TOOPATH_CLUSTER_MAX_SCAN_CELLS:
+            clusters = {}
+            points = [(did, x, y) for did, x, y, owner_id, privacy in index.within(grid_columns, south, north)
+                      if privacy == Device.PUBLIC]
+        else:
+            zoom = pyramid.max_zoom
+    if clusters is None:
+        clusters = pyramid.clusters(zoom, *cell_ranges(west, south, east, north, zoom))
+        points = []
+    points.extend((did, x, y) for did, x, y, privacy in index.owned_by(user.pk) if privacy != Device.PUBLIC)
+    for did, x, y in points:
+        if _inside(x, y, west, south, east, north):
+            accumulate(clusters, zoom, did, *mercator(x, y))
+    result = []
+    for count, mx, my, did in clusters.values():
+        x, y = unmercator(mx / count, my / count)
+        result.append([round(x, 6), round(y, 6), count, did] if count == 1 else [round(x, 6), round(y, 6), count])
+    return zoom, result
@@ -0,0 +1,106 @@
+import functools
+import re
+import zlib
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+
+from TooPath3.conditional import device_list_aggregates
+from TooPath3.models import Track
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ACCEPT_ENCODING = re.compile(r'\s*([^\s;,]+)\s*(?:;\s*q\s*=\s*([0-9.]+))?')
+# Rough size of each serialized row, to tell big responses from small ones with a count.
+DEVICE_BYTES = 300
+TRACK_BYTES = 150
+LOCATION_BYTES = 200
+
+
+def accepted_encoding(request):
+    """
+     The best encoding the client accepts: br when the brotli module is installed, then gzip; None for identity.
+    """
+    qualities = {}
+    for coding, quality in ACCEPT_ENCODING.findall(request.META.get('HTTP_ACCEPT_ENCODING', '')):
+        try:
+            qualities[coding.lower()] = float(quality) if quality else 1.0
+        except ValueError:
+            continue
+    for coding in ('br', 'gzip') if brotli is not None else ('gzip',):
+        if qualities.get(coding, qualities.get('*', 0.0)) > 0:
+            return coding
+    return None
+
+
+class GzipStream(object):
+    def __init__(self):
+        self.compressor = zlib.compressobj(settings.TOOPATH_COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, chunk):
+        # A sync flush per chunk sends what's compressed so far instead of waiting for a full window.
+        return self.compressor.compress(chunk) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+class BrotliStream(object):
+    def __init__(self):
+        self.compressor = brotli.Compressor(mode=brotli.MODE_TEXT, quality=settings.TOOPATH_COMPRESSION_BROTLI_QUALITY)
+
+    def compress(self, chunk):
+        return self.compressor.process(chunk) + self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+STREAMS = {'gzip': GzipStream, 'br': BrotliStream}
+
+
+def compressed_chunks(chunks, encoding):
+    stream = STREAMS[encoding]()
+    for chunk in chunks:
+        compressed = stream.compress(chunk)
+        if compressed:
+            yield compressed
+    yield stream.finish()
+
+
+def device_list_bytes(request, **kwargs):
+    # The same aggregate as the list's validators, which already ran it for this request.
+    counts = device_list_aggregates(request)
+    return counts['devices'] * DEVICE_BYTES + counts['tracks'] * TRACK_BYTES + counts['locations'] * LOCATION_BYTES
+
+
+def track_bytes(request, t_pk, **kwargs):
+    points = Track.objects.filter(pk=t_pk).values_list('points', flat=True).first()
+    return TRACK_BYTES + (points or 0) * LOCATION_BYTES
+
+
+def compressed_stream(estimated_bytes, stream):
+    """
+     Lets a GET answer with its JSON compressed on the fly, as the view's `stream` method serializes it chunk by
+     chunk, when the client accepts gzip or br and `estimated_bytes` says the body is worth it. Smaller responses
+     and clients without compression go through the view as usual.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(view, request, **kwargs):
+            encoding = accepted_encoding(request) if request.accepted_renderer.format == 'json' else None
+            if encoding is not None and estimated_bytes(request, **kwargs) >= settings.TOOPATH_COMPRESSION_MIN_BYTES:
+                chunks = getattr(view, stream)(request, **kwargs)
+                response = StreamingHttpResponse(compressed_chunks(chunks, encoding),
+                                                 content_type='application/json')
+                response['Content-Encoding'] = encoding
+            else:
+                response = method(view, request, **kwargs)
+            patch_vary_headers(response, ('Accept-Encoding',))
+            return response
+        return wrapper
+    return decorator
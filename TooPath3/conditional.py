@@ -0,0 +1,150 @@
+import calendar
+import functools
+import hashlib
+
+from django.db import connection
+from django.db.models import Count, Max, Sum
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+from TooPath3.models import Device, Track, ActualLocation, TrackLocation
+
+# One statement for the tracks of a whole batch, stamped when it runs like the points it counts (see
+# TooPath3/ingest.py).
+POINTS_CHANGED = '''
+    UPDATE tracks SET points = tracks.points + changed.points, points_updated_at = clock_timestamp()
+    FROM unnest(%(tracks)s::integer[], %(points)s::integer[]) AS changed (tid, points)
+    WHERE tracks.tid = changed.tid
+'''
+
+
+class Validators(object):
+    """
+     ETag and Last-Modified of a response, worked out from row counts and the latest `updated_at` of the rows it is
+     serialized from; the points of a track are counted and stamped on the track itself. A count changes when a row
+     is deleted, which the latest `updated_at` alone can't tell, so If-Modified-Since is only trusted for a single
+     row; collections are revalidated with their ETag.
+    """
+
+    def __init__(self, parts, last_modified, single_row=False):
+        self.etag = 'W/"%s"' % hashlib.md5(repr(parts).encode('utf-8')).hexdigest()
+        self.last_modified = calendar.timegm(last_modified.utctimetuple()) if last_modified else None
+        self.single_row = single_row
+
+    def vary(self, representation):
+        """
+         Gives another ETag to another representation of the same rows, like a sparse fieldset of them.
+        """
+        self.etag = 'W/"%s"' % hashlib.md5((self.etag + representation).encode('utf-8')).hexdigest()
+
+    def not_modified(self, request):
+        return get_conditional_response(request, etag=self.etag,
+                                        last_modified=self.last_modified if self.single_row else None)
+
+    def add_headers(self, response):
+        response['ETag'] = self.etag
+        if self.last_modified is not None:
+            response['Last-Modified'] = http_date(self.last_modified)
+        return response
+
+
+def _latest(*dates):
+    dates = [date for date in dates if date is not None]
+    return max(dates) if dates else None
+
+
+def points_changed(points):
+    """
+     Adds `points[tid]` points, fewer when negative, to each track and stamps its points changed.
+    """
+    tracks = sorted(tid for tid in points if points[tid])
+    if tracks:
+        with connection.cursor() as cursor:
+            cursor.execute(POINTS_CHANGED, {'tracks': tracks, 'points': [points[tid] for tid in tracks]})
+
+
+# Creates only, like the receiver of TooPath3/caching.py: the writes that delete points or add them in bulk count
+# them themselves.
+@receiver(post_save, sender=TrackLocation)
+def track_location_created(sender, instance, created, raw, **kwargs):
+    if created and not raw:
+        points_changed({instance.track_id: 1})
+
+
+def _devices_aggregates(devices):
+    return devices.aggregate(devices=Count('did', distinct=True), devices_updated=Max('updated_at'),
+                             tracks=Count('tracks'), tracks_updated=Max('tracks__updated_at'),
+                             locations=Coalesce(Sum('tracks__points'), 0),
+                             locations_updated=Max('tracks__points_updated_at'))
+
+
+def _devices_validators(request, aggregates):
+    # The owner's username is serialized with every device.
+    parts = (request.user.username, sorted(aggregates.items()))
+    return Validators(parts, _latest(aggregates['devices_updated'], aggregates['tracks_updated'],
+                                     aggregates['locations_updated']))
+
+
+def device_list_aggregates(request):
+    """
+     Counts and latest `updated_at` of the user's devices, tracks and locations, worked out once per request from
+     the devices and tracks alone: the validators of the device list and the estimate of its size (see
+     TooPath3/compression.py) both read them.
+    """
+    aggregates = getattr(request, '_device_list_aggregates', None)
+    if aggregates is None:
+        aggregates = _devices_aggregates(Device.objects.filter(owner=request.user, trash=False))
+        request._device_list_aggregates = aggregates
+    return aggregates
+
+
+def device_list_validators(request, **kwargs):
+    return _devices_validators(request, device_list_aggregates(request))
+
+
+def device_validators(request, d_pk, **kwargs):
+    aggregates = _devices_aggregates(Device.objects.filter(pk=d_pk, owner=request.user, trash=False))
+    return _devices_validators(request, aggregates) if aggregates['devices'] else None
+
+
+def track_validators(request, d_pk, t_pk, **kwargs):
+    track = Track.objects.filter(pk=t_pk, device_id=d_pk, device__owner=request.user, trash=False,
+                                 device__trash=False).values('updated_at', 'points', 'points_updated_at').first()
+    if track is None:
+        return None
+    return Validators(sorted(track.items()), _latest(track['updated_at'], track['points_updated_at']))
+
+
+def actual_location_validators(request, d_pk, **kwargs):
+    updated_at = ActualLocation.objects.filter(pk=d_pk, device__owner=request.user, device__trash=False).values_list(
+        'updated_at', flat=True).first()
+    if updated_at is None:
+        return None
+    return Validators(updated_at.isoformat(), updated_at, single_row=True)
+
+
+def conditional_response(validators):
+    """
+     Answers a GET with 304 Not Modified when the client's validators still match, before the view loads or
+     serializes anything. Validators only exist for objects the user owns; otherwise the view answers as usual.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(view, request, **kwargs):
+            current = validators(request, **kwargs)
+            if current is None:
+                return method(view, request, **kwargs)
+            if request.GET:
+                current.vary(request.GET.urlencode())
+            not_modified = current.not_modified(request)
+            if not_modified is not None:
+                return current.add_headers(not_modified)
+            response = method(view, request, **kwargs)
+            if response.status_code == 200:
+                current.add_headers(response)
+            return response
+        return wrapper
+    return decorator
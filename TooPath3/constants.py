@@ -10,6 +10,14 @@ DEFAULT_ERROR_MESSAGES = {
     'patch_user_fields_required': _('You must provide a valid fields to update the User instance'),
     'invalid_email': _('The email provided is incorrect'),
     'invalid_password': _('The password provided is incorrect'),
-    'invalid_google_token': _('The google token is invalid')
+    'invalid_google_token': _('The google token is invalid'),
+    'invalid_point': _('Enter a valid point as lon,lat.'),
+    'invalid_bbox': _('Enter a valid bounding box as west,south,east,north.'),
+    'invalid_sync_point': _('Enter a valid GeoJSON Point.'),
+    'sync_batch_too_big': _('Upload at most %(max)d locations per batch.'),
+    'playback_time_required': _('Give either at or times.'),
+    'too_many_times': _('Ask for at most %(max)d times per request.'),
+    'invalid_bucket': _('Enter a bucket as a number of seconds, optionally followed by s, m, h or d.'),
+    'invalid_time_window': _('until must be later than since.'),
 
 }
@@ -1,17 +1,19 @@
 from rest_framework import serializers
 
 from TooPath3.constants import DEFAULT_ERROR_MESSAGES
+from TooPath3.fieldsets import SparseFieldsetMixin
 from TooPath3.models import Device
 from TooPath3.tracks.serializers import TrackSerializer
 
 
-class DeviceSerializer(serializers.ModelSerializer):
+class DeviceSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     owner = serializers.ReadOnlyField(source='owner.username')
     tracks = TrackSerializer(many=True, read_only=True)
 
     class Meta:
         model = Device
-        fields = '__all__'
+        exclude = ('synced_seq',)
+        read_only_fields = ('trash',)
 
     def validate(self, data):
         if self.partial is True:
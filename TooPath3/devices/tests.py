@@ -1,8 +1,16 @@
+import datetime
+from unittest import mock
+
+from django.db import connection
+from django.test import SimpleTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from rest_framework.status import *
 from rest_framework.test import APITestCase, APIClient
 from rest_framework_jwt.serializers import jwt_decode_handler, jwt_get_username_from_payload
 
 from TooPath3.devices.serializers import DeviceSerializer
+from TooPath3.proximity import GridIndex, live_positions
 
 from TooPath3.utils import *
 
@@ -42,6 +50,32 @@ class GetDeviceCase(APITestCase):
         response = self.client.get('/devices/' + str(device.did) + '/', format='json')
         self.assertEqual(DeviceSerializer(device).data, response.data)
 
+    def test_return_only_the_fields_asked_for(self):
+        device = create_device_with_owner(self.user)
+        create_various_track_locations_with_track(create_track_with_device(device))
+        response = self.client.get('/devices/' + str(device.did) + '/?fields=name,tracks.name', format='json')
+        self.assertEqual(DeviceSerializer(device, fields=['name', 'tracks.name']).data, response.data)
+        self.assertEqual({'name', 'tracks'}, set(response.data))
+        self.assertEqual(['name'], list(response.data['tracks'][0]))
+
+    def test_omitted_relations_are_not_fetched(self):
+        device = create_device_with_owner(self.user)
+        create_various_track_locations_with_track(create_track_with_device(device))
+        path = '/devices/' + str(device.did) + '/'
+        with CaptureQueriesContext(connection) as whole:
+            self.client.get(path, format='json')
+        with CaptureQueriesContext(connection) as sparse:
+            response = self.client.get(path + '?omit=tracks,owner', format='json')
+        self.assertNotIn('tracks', response.data)
+        self.assertNotIn('owner', response.data)
+        # Neither the tracks nor their locations are prefetched.
+        self.assertEqual(len(whole) - 2, len(sparse))
+
+    def test_fieldsets_have_their_own_etag(self):
+        device = create_device_with_owner(self.user)
+        path = '/devices/' + str(device.did) + '/'
+        self.assertNotEqual(self.client.get(path)['ETag'], self.client.get(path + '?fields=name')['ETag'])
+
 
 class PatchDeviceCase(APITestCase):
     def setUp(self):
@@ -178,6 +212,13 @@ class GetDevicesCase(APITestCase):
         devices = Device.objects.filter(owner=self.user)
         self.assertEqual(DeviceSerializer(devices, many=True).data, response.data)
 
+    def test_return_devices_without_the_omitted_fields(self):
+        create_various_devices_with_owner(self.user)
+        response = self.client.get(path='/devices/?omit=tracks.locations,description')
+        devices = Device.objects.filter(owner=self.user)
+        self.assertEqual(DeviceSerializer(devices, many=True, omit=['tracks.locations', 'description']).data,
+                         response.data)
+
 
 class PostDeviceCase(APITestCase):
     def setUp(self):
@@ -225,3 +266,132 @@ class PostDeviceCase(APITestCase):
         payload = jwt_decode_handler(self.token)
         username = jwt_get_username_from_payload(payload)
         self.assertEqual(response.data['owner'], username)
+
+
+class LivePositionsTestCase(APITestCase):
+    def setUp(self):
+        live_positions.index = None
+        self.client = APIClient()
+        self.user = create_user_with_email(email='nearby@gmail.com')
+        self.other = create_user_with_email(email='other@gmail.com')
+        self.own = self.located(self.user, Device.PRIVATE, 2.1734, 41.3851)
+        self.public = self.located(self.other, Device.PUBLIC, 2.1744, 41.3851)
+        self.friends = self.located(self.other, Device.FRIENDS, 2.1735, 41.3851)
+        self.far = self.located(self.other, Device.PUBLIC, -3.7038, 40.4168)
+        self.client.credentials(HTTP_AUTHORIZATION='JWT ' + generate_token_for_user(user=self.user))
+
+    def tearDown(self):
+        live_positions.index = None
+
+    def located(self, owner, privacy, x, y):
+        device = create_device_with_owner(owner=owner)
+        device.device_privacy = privacy
+        device.save()
+        ActualLocation.objects.filter(pk=device).update(point=Point(x, y, srid=4326))
+        return device
+
+
+class NearbyDevicesCase(LivePositionsTestCase):
+    def nearby(self, **params):
+        params.setdefault('point', '2.1734,41.3851')
+        params.setdefault('radius', 1000)
+        response = self.client.get(path='/devices/nearby/', data=params)
+        self.assertEqual(HTTP_200_OK, response.status_code)
+        return [feature['properties']['device'] for feature in response.data['features']]
+
+    def test_return_own_and_public_devices_by_distance(self):
+        self.assertEqual([self.own.did, self.public.did], self.nearby())
+
+    def test_return_at_most_k_devices(self):
+        self.assertEqual([self.own.did], self.nearby(k=1))
+
+    def test_return_400_status_when_radius_is_missing(self):
+        response = self.client.get(path='/devices/nearby/', data={'point': '2.1734,41.3851'})
+        self.assertEqual(HTTP_400_BAD_REQUEST, response.status_code)
+
+    def test_moves_and_privacy_changes_are_seen_at_once(self):
+        self.nearby()
+        self.public.device_privacy = Device.PRIVATE
+        self.public.save()
+        self.client.put(path='/devices/%d/actualLocation/' % self.own.did, format='json',
+                        data={'point': {'type': 'Point', 'coordinates': [-3.7038, 40.4168]}})
+        self.assertEqual([], self.nearby())
+        self.assertEqual([self.own.did, self.far.did], self.nearby(point='-3.7038,40.4168'))
+
+    def test_trashed_devices_are_dropped(self):
+        self.nearby()
+        self.client.credentials(HTTP_AUTHORIZATION='JWT ' + generate_token_for_user(user=self.user))
+        self.client.delete(path='/devices/%d/' % self.own.did)
+        self.assertEqual([self.public.did], self.nearby())
+
+    def test_the_devices_of_a_deleted_user_are_dropped(self):
+        an_hour_ago = timezone.now() - datetime.timedelta(hours=1)
+        Device.objects.update(updated_at=an_hour_ago)
+        ActualLocation.objects.update(updated_at=an_hour_ago)
+        self.nearby()
+        self.client.credentials(HTTP_AUTHORIZATION='JWT ' + generate_token_for_user(user=self.other))
+        self.assertEqual(HTTP_204_NO_CONTENT, self.client.delete(path='/users/%d/' % self.other.pk).status_code)
+        self.client.credentials(HTTP_AUTHORIZATION='JWT ' + generate_token_for_user(user=self.user))
+        with self.settings(TOOPATH_NEARBY_POLL_SECONDS=0):
+            self.assertEqual([self.own.did], self.nearby())
+
+    def test_the_index_reconciles_with_the_database_in_the_background(self):
+        self.nearby()
+        ActualLocation.objects.filter(pk=self.public).update(point=Point(-3.7038, 40.4168, srid=4326))
+        with self.settings(TOOPATH_NEARBY_RECONCILE_SECONDS=0):
+            with mock.patch('TooPath3.proximity.threading.Thread') as thread:
+                # Answered from the index as it was while it is rebuilt.
+                self.assertEqual([self.own.did, self.public.did], self.nearby())
+                self.assertEqual([self.own.did, self.public.did], self.nearby())
+            thread.return_value.start.assert_called_once_with()
+            # The rebuild runs here, on the connection of the test's transaction, which it mustn't close.
+            with mock.patch('TooPath3.proximity.connection'):
+                thread.call_args[1]['target']()
+        self.assertEqual([self.own.did], self.nearby())
+
+
+class DeviceClustersCase(LivePositionsTestCase):
+    def clusters(self, bbox='-180,-90,180,90', zoom=0):
+        response = self.client.get(path='/devices/clusters/', data={'bbox': bbox, 'zoom': zoom})
+        self.assertEqual(HTTP_200_OK, response.status_code)
+        return response.data
+
+    def test_return_nearby_devices_as_one_cluster_when_zoomed_out(self):
+        data = self.clusters()
+        self.assertEqual(0, data['zoom'])
+        self.assertEqual([1, 2], sorted(cluster[2] for cluster in data['clusters']))
+
+    def test_return_single_devices_with_their_id_when_zoomed_in(self):
+        data = self.clusters(bbox='2,41,3,42', zoom=18)
+        self.assertEqual(18, data['zoom'])
+        self.assertEqual({self.own.did, self.public.did}, {cluster[3] for cluster in data['clusters']})
+
+    def test_clusters_follow_moving_devices(self):
+        self.clusters()
+        self.client.put(path='/devices/%d/actualLocation/' % self.own.did, format='json',
+                        data={'point': {'type': 'Point', 'coordinates': [-3.7038, 40.4168]}})
+        self.assertEqual([[-3.7038, 40.4168, 2]], self.clusters(bbox='-4,40,-3,41', zoom=5)['clusters'])
+
+    def test_boxes_too_big_to_cluster_are_answered_at_a_lower_zoom(self):
+        with self.settings(TOOPATH_CLUSTER_MAX_ZOOM=10):
+            self.assertEqual(10, self.clusters(zoom=18)['zoom'])
+
+    def test_return_400_status_when_bbox_is_invalid(self):
+        response = self.client.get(path='/devices/clusters/', data={'bbox': '2,42,3,41', 'zoom': 1})
+        self.assertEqual(HTTP_400_BAD_REQUEST, response.status_code)
+
+
+class GridIndexCase(SimpleTestCase):
+    def test_lookups_wrap_around_the_antimeridian(self):
+        index = GridIndex(0.05)
+        index.update(1, 179.999, 0.0, 1, Device.PUBLIC)
+        index.update(2, -179.999, 0.0, 1, Device.PUBLIC)
+        index.update(3, 0.0, 0.0, 1, Device.PUBLIC)
+        nearby = index.nearby(-179.9995, 0.0, 1000, 10, lambda owner_id, privacy: True)
+        self.assertEqual([2, 1], [did for distance, did, x, y in nearby])
+
+    def test_lookups_near_a_pole_scan_every_longitude(self):
+        index = GridIndex(0.05)
+        index.update(1, 90.0, 89.9995, 1, Device.PUBLIC)
+        nearby = index.nearby(-90.0, 89.9995, 1000, 10, lambda owner_id, privacy: True)
+        self.assertEqual([1], [did for distance, did, x, y in nearby])
@@ -1,3 +1,6 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Prefetch, prefetch_related_objects
 from django.shortcuts import get_object_or_404
 from rest_framework.authentication import SessionAuthentication, BasicAuthentication
 from rest_framework.parsers import JSONParser
@@ -7,23 +10,62 @@ from rest_framework.status import *
 from rest_framework.views import APIView
 from rest_framework_jwt.authentication import JSONWebTokenAuthentication
 
+from TooPath3.caching import cached_response, device_dependencies
+from TooPath3.compression import compressed_stream, device_list_bytes
+from TooPath3.conditional import conditional_response, device_validators, device_list_validators
 from TooPath3.devices.permissions import IsOwnerOrReadOnly
 from TooPath3.devices.serializers import DeviceSerializer
-from TooPath3.models import Device, ActualLocation
+from TooPath3.fieldsets import requested_fieldset
+from TooPath3.jobs import enqueue
+from TooPath3.locations.serializers import NearbyQuerySerializer, ClusterQuerySerializer
+from TooPath3.models import Device, ActualLocation, Track
+from TooPath3.clustering import device_clusters
+from TooPath3.proximity import nearby_devices, live_positions
+from TooPath3.renderers import array_chunks, batches, render
+from TooPath3.utils import alive
+
+# The nested tracks and their locations of DeviceSerializer, fetched with a query per level instead of one per row.
+DEVICE_PREFETCH = (Prefetch('tracks', queryset=Track.objects.filter(trash=False)), 'tracks__locations')
+
+
+def device_prefetch(serializer):
+    """
+     DEVICE_PREFETCH trimmed to what a DeviceSerializer built with a sparse fieldset still renders: the tracks only
+     with the columns it shows, their locations only if it shows them, and nothing when it omits the tracks.
+    """
+    tracks = serializer.fields.get('tracks')
+    if tracks is None:
+        return ()
+    prefetch = [Prefetch('tracks', queryset=Track.objects.filter(trash=False).only(*tracks.child.columns('device')))]
+    if 'locations' in tracks.child.fields:
+        prefetch.append('tracks__locations')
+    return prefetch
+
+
+def sparse_devices(devices, serializer):
+    """
+     `devices` loading only the columns `serializer` renders, and the owner they are checked against.
+    """
+    devices = devices.only(*serializer.columns('owner'))
+    return devices.select_related('owner') if 'owner' in serializer.fields else devices
 
 
 class DeviceDetail(APIView):
     authentication_classes = (JSONWebTokenAuthentication, SessionAuthentication, BasicAuthentication,)
     permission_classes = (IsAuthenticated, IsOwnerOrReadOnly,)
 
-    def get_object(self, pk):
-        obj = get_object_or_404(klass=Device, pk=pk)
+    def get_object(self, pk, queryset=None):
+        obj = get_object_or_404(alive(Device) if queryset is None else queryset, pk=pk)
         self.check_object_permissions(self.request, obj=obj)
         return obj
 
+    @conditional_response(device_validators)
+    @cached_response('device-detail', device_dependencies)
     def get(self, request, d_pk):
-        device = self.get_object(pk=d_pk)
-        serializer = DeviceSerializer(instance=device)
+        serializer = DeviceSerializer(**requested_fieldset(request))
+        device = self.get_object(pk=d_pk, queryset=sparse_devices(alive(Device), serializer))
+        prefetch_related_objects([device], *device_prefetch(serializer))
+        serializer.instance = device
         return Response(data=serializer.data, status=HTTP_200_OK)
 
     def patch(self, request, d_pk):
@@ -38,12 +80,17 @@ class DeviceDetail(APIView):
         serializer = DeviceSerializer(instance=device, data=request.data)
         if serializer.is_valid():
             device_updated = serializer.save()
+            prefetch_related_objects([device_updated], *DEVICE_PREFETCH)
             return Response(data=DeviceSerializer(device_updated).data, status=HTTP_200_OK)
         return Response(data=serializer.errors, status=HTTP_400_BAD_REQUEST)
 
     def delete(self, request, d_pk):
         device = self.get_object(pk=d_pk)
-        device.delete()
+        # Gone for the API right away, its tracks and locations are purged in the background (see TooPath3/jobs.py)
+        with transaction.atomic():
+            device.trash = True
+            device.save()
+            enqueue('purge_device', did=device.did)
         return Response(status=HTTP_204_NO_CONTENT)
 
 
@@ -51,14 +98,65 @@ class DeviceList(APIView):
     authentication_classes = (JSONWebTokenAuthentication, SessionAuthentication, BasicAuthentication,)
     permission_classes = (IsAuthenticated, IsOwnerOrReadOnly,)
 
+    @conditional_response(device_list_validators)
+    @compressed_stream(device_list_bytes, 'stream')
     def get(self, request):
-        devices = Device.objects.filter(owner=request.user)
-        serializer = DeviceSerializer(instance=devices, many=True)
+        fieldset = requested_fieldset(request)
+        serializer = DeviceSerializer(**fieldset)
+        devices = sparse_devices(alive(Device).filter(owner=request.user), serializer).prefetch_related(
+            *device_prefetch(serializer))
+        serializer = DeviceSerializer(instance=devices, many=True, **fieldset)
         return Response(data=serializer.data, status=HTTP_200_OK)
 
+    def stream(self, request):
+        fieldset = requested_fieldset(request)
+        devices = sparse_devices(alive(Device).filter(owner=request.user), DeviceSerializer(**fieldset))
+        return array_chunks(self.rendered_devices(devices, fieldset))
+
+    def rendered_devices(self, devices, fieldset):
+        prefetch = device_prefetch(DeviceSerializer(**fieldset))
+        for batch in batches(devices, settings.TOOPATH_COMPRESSION_CHUNK_DEVICES):
+            prefetch_related_objects(batch, *prefetch)
+            yield render(DeviceSerializer(instance=batch, many=True, **fieldset).data)
+
     def post(self, request):
         serializer = DeviceSerializer(data=request.data)
         if serializer.is_valid():
             new_device = serializer.save(owner=request.user)
             return Response(data=DeviceSerializer(new_device).data, status=HTTP_201_CREATED)
         return Response(data=serializer.errors, status=HTTP_400_BAD_REQUEST)
+
+
+class DeviceNearby(APIView):
+    """
+     The devices closest to a point, among the public ones and the user's own, from this process' index of actual
+     locations (see TooPath3/proximity.py) rather than from the database.
+    """
+    authentication_classes = (JSONWebTokenAuthentication, SessionAuthentication, BasicAuthentication,)
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request):
+        query = NearbyQuerySerializer(data=request.query_params)
+        if query.is_valid():
+            features = [{'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [x, y]},
+                         'properties': {'device': did, 'distance': distance}}
+                        for distance, did, x, y in nearby_devices(request.user, **query.validated_data)]
+            return Response(data={'type': 'FeatureCollection', 'features': features}, status=HTTP_200_OK)
+        return Response(data=query.errors, status=HTTP_400_BAD_REQUEST)
+
+
+class DeviceClusters(APIView):
+    """
+     The public devices and the user's own in a bounding box, clustered for a map at `zoom`, from the same index as
+     DeviceNearby. Answers the zoom it clustered at, which is lower than asked for boxes too big to cluster at it.
+    """
+    authentication_classes = (JSONWebTokenAuthentication, SessionAuthentication, BasicAuthentication,)
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request):
+        query = ClusterQuerySerializer(data=request.query_params)
+        if query.is_valid():
+            zoom, clusters = device_clusters(live_positions.current(), request.user, *query.validated_data['bbox'],
+                                             zoom=query.validated_data['zoom'])
+            return Response(data={'zoom': zoom, 'clusters': clusters}, status=HTTP_200_OK)
+        return Response(data=query.errors, status=HTTP_400_BAD_REQUEST)
@@ -0,0 +1,79 @@
+from django.core.exceptions import FieldDoesNotExist
+from rest_framework.serializers import ListSerializer
+
+
+def _names(value):
+    return [name.strip() for name in value.split(',') if name.strip()] if value else []
+
+
+def requested_fieldset(request):
+    """
+     The sparse fieldset a GET asks for, as keyword arguments for a SparseFieldsetMixin serializer: `fields`, the
+     only fields to render, and `omit`, those not to, both comma-separated and dotted to reach nested serializers,
+     like `?fields=name,tracks.name` or `?omit=tracks.locations`. Empty when it asks for none.
+    """
+    fieldset = {}
+    for name in ('fields', 'omit'):
+        names = _names(request.query_params.get(name))
+        if names:
+            fieldset[name] = names
+    return fieldset
+
+
+def _nested(names, name):
+    prefix = name + '.'
+    return [nested[len(prefix):] for nested in names if nested.startswith(prefix)]
+
+
+def apply_fieldset(serializer, fields=None, omit=()):
+    """
+     Removes from `serializer` the fields the fieldset leaves out, then applies the dotted names to the nested
+     serializers that are SparseFieldsetMixin too. Unknown names are ignored.
+    """
+    kept = None if fields is None else {name.split('.', 1)[0] for name in fields}
+    for name in list(serializer.fields):
+        if (kept is not None and name not in kept) or name in omit:
+            serializer.fields.pop(name)
+    for name, field in serializer.fields.items():
+        nested_fields = None if fields is None else _nested(fields, name)
+        nested_omit = _nested(omit, name)
+        target = field.child if isinstance(field, ListSerializer) else field
+        if (nested_fields or nested_omit) and isinstance(target, SparseFieldsetMixin):
+            apply_fieldset(target, nested_fields or None, nested_omit)
+
+
+class SparseFieldsetMixin(object):
+    """
+     Lets a ModelSerializer be built with the `fields` and `omit` of `requested_fieldset`, and tells the columns its
+     remaining fields read, so views load nothing else.
+    """
+    # Model columns a field reads besides its source, like those of the rows it is built from.
+    column_dependencies = {}
+
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        omit = kwargs.pop('omit', ())
+        super(SparseFieldsetMixin, self).__init__(*args, **kwargs)
+        if fields is not None or omit:
+            apply_fieldset(self, fields, omit)
+
+    def columns(self, *required):
+        """
+         Arguments for QuerySet.only(): the primary key, `required` and the columns the remaining fields read, with
+         the related ones as `relation__column`.
+        """
+        model = self.Meta.model
+        columns = {model._meta.pk.name}
+        columns.update(required)
+        for name, field in self.fields.items():
+            columns.update(self.column_dependencies.get(name, ()))
+            if field.source == '*':
+                continue
+            parts = field.source.split('.')
+            try:
+                model_field = model._meta.get_field(parts[0])
+            except FieldDoesNotExist:
+                continue
+            if model_field.concrete:
+                columns.add('__'.join(parts) if model_field.is_relation and len(parts) > 1 else parts[0])
+        return sorted(columns)
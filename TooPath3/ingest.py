@@ -0,0 +1,289 @@
+import collections
+import fcntl
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import uuid
+import zlib
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from TooPath3.caching import bump, version_key
+from TooPath3.conditional import points_changed
+from TooPath3.metrics import registry
+from TooPath3.models import ActualLocation, IngestCheckpoint
+from TooPath3.renderers import render
+from TooPath3.stream.signals import notify_location
+
+# Every record is its payload's length and crc32 followed by the payload, a JSON object. Segments are preallocated
+# with zeros, so a zero length marks the end of what has been written.
+HEADER = struct.Struct('<II')
+SEGMENT_PATTERN = '*.wal'
+# A new segment is sized and locked under this suffix, out of SEGMENT_PATTERN, before it gets its name.
+NEW_SEGMENT_SUFFIX = '.new'
+
+# Skips the fixes of tracks purged since they were logged, which would otherwise fail the whole batch. Stamped
+# updated when written, like the actual locations below: stop detection looks for the points updated since it last
+# ran (see TooPath3/stops.py).
+REPLAY_TRACK_LOCATIONS = '''
+    INSERT INTO track_locations (point, created_at, updated_at, track_id)
+    SELECT ST_GeomFromEWKB(batch.point), to_timestamp(batch.at), clock_timestamp(), batch.track_id
+    FROM unnest(%(tracks)s::integer[], %(points)s::bytea[], %(ats)s::float8[]) AS batch (track_id, point, at)
+    JOIN tracks ON tracks.tid = batch.track_id
+'''
+
+# Stamped updated when it is written rather than when it was logged, since the drainer can run well behind the
+# processes polling `updated_at` (see TooPath3/proximity.py). A position older than the stored one, written while the
+# log was behind, is left alone.
+REPLAY_ACTUAL_LOCATIONS = '''
+    UPDATE actual_locations
+    SET point = ST_GeomFromEWKB(batch.point), fixed_at = to_timestamp(batch.at), updated_at = clock_timestamp()
+    FROM unnest(%(devices)s::integer[], %(points)s::bytea[], %(ats)s::float8[]) AS batch (device_id, point, at)
+    WHERE actual_locations.device_id = batch.device_id
+        AND coalesce(actual_locations.fixed_at, actual_locations.updated_at) <= to_timestamp(batch.at)
+    RETURNING actual_locations.device_id
+'''
+
+
+class Segment(object):
+    """
+     A log file of fixed size, mapped in memory. Its writer holds an exclusive flock on it until it rolls over to
+     the next segment or dies, which is how the drainer tells sealed segments from the ones still being written.
+    """
+
+    def __init__(self, path, size=None):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if size is not None:
+            os.ftruncate(self.fd, size)
+            os.fsync(self.fd)
+        self.size = os.fstat(self.fd).st_size
+        self.map = mmap.mmap(self.fd, self.size)
+        self.offset = 0
+
+    def lock(self, blocking=True):
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+
+    def records(self, offset=0):
+        """
+         Yields the payload of every complete record from `offset`, with the offset where the next one starts. Stops
+         at the end of what was written, or at a record torn by a crash or still being written.
+        """
+        while offset + HEADER.size <= self.size:
+            length, crc = HEADER.unpack_from(self.map, offset)
+            end = offset + HEADER.size + length
+            if length == 0 or end > self.size:
+                return
+            payload = self.map[offset + HEADER.size:end]
+            if zlib.crc32(payload) != crc:
+                return
+            yield payload, end
+            offset = end
+
+    def append(self, payloads):
+        """
+         Writes the payloads and syncs them to disk. Returns False, writing nothing, when they don't fit.
+        """
+        start = self.offset
+        if start + sum(HEADER.size + len(payload) for payload in payloads) > self.size:
+            return False
+        for payload in payloads:
+            HEADER.pack_into(self.map, self.offset, len(payload), zlib.crc32(payload))
+            self.map[self.offset + HEADER.size:self.offset + HEADER.size + len(payload)] = payload
+            self.offset += HEADER.size + len(payload)
+        # msync needs a page-aligned start.
+        aligned = start - start % mmap.PAGESIZE
+        self.map.flush(aligned, self.offset - aligned)
+        return True
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+
+class IngestLog(object):
+    """
+     The segments written by this process. Every process has its own, so appending never waits for another one.
+    """
+
+    def __init__(self, directory, segment_bytes):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.prefix = uuid.uuid4().hex
+        self.segment = None
+        self.lock = threading.Lock()
+
+    def roll(self):
+        if self.segment is not None:
+            self.segment.close()
+        os.makedirs(self.directory, exist_ok=True)
+        # Named by creation time so the drainer replays older segments first.
+        name = '%020d-%s.wal' % (int(time.time() * 1000000), self.prefix)
+        path = os.path.join(self.directory, name)
+        # Only renamed once locked: a drainer finding it unlocked would take it for sealed and remove it.
+        segment = Segment(path + NEW_SEGMENT_SUFFIX, self.segment_bytes)
+        segment.lock()
+        os.rename(segment.path, path)
+        segment.path, segment.name = path, name
+        self.segment = segment
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    def append(self, records):
+        payloads = [render(record) for record in records]
+        if sum(HEADER.size + len(payload) for payload in payloads) > self.segment_bytes:
+            raise ValueError('The records don\'t fit in a log segment.')
+        with self.lock:
+            if self.segment is None or not self.segment.append(payloads):
+                self.roll()
+                self.segment.append(payloads)
+        registry.inc('toopath_ingest_appended_total', value=len(payloads))
+
+    def close(self):
+        with self.lock:
+            if self.segment is not None:
+                self.segment.close()
+                self.segment = None
+
+
+_log = None
+_log_pid = None
+
+
+def get_log():
+    global _log, _log_pid
+    # A forked worker must not write to its parent's segment.
+    if _log is None or _log_pid != os.getpid():
+        _log = IngestLog(settings.TOOPATH_INGEST_LOG_DIR, settings.TOOPATH_INGEST_SEGMENT_BYTES)
+        _log_pid = os.getpid()
+    return _log
+
+
+def close_log():
+    global _log
+    if _log is not None and _log_pid == os.getpid():
+        _log.close()
+    _log = None
+
+
+def _ewkb(point):
+    if point.srid is None:
+        point.srid = 4326
+    return bytes(point.ewkb).hex()
+
+
+def log_track_location(track, point):
+    get_log().append([{'kind': 'track', 'track': track.pk, 'point': _ewkb(point), 'at': time.time()}])
+
+
+def log_actual_location(device_pk, point):
+    get_log().append([{'kind': 'actual', 'device': device_pk, 'point': _ewkb(point), 'at': time.time()}])
+
+
+def replay(segment_name, records, offset):
+    """
+     Writes a batch of logged fixes and the segment's new checkpoint in one transaction, so a drainer that crashes
+     halfway replays nothing twice.
+    """
+    tracks = [record for record in records if record['kind'] == 'track']
+    latest = {}
+    for record in records:
+        if record['kind'] == 'actual' and record['at'] >= latest.get(record['device'], record)['at']:
+            latest[record['device']] = record
+    actual = list(latest.values())
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            if tracks:
+                cursor.execute(REPLAY_TRACK_LOCATIONS, {
+                    'tracks': [record['track'] for record in tracks],
+                    'points': [bytes.fromhex(record['point']) for record in tracks],
+                    'ats': [record['at'] for record in tracks]})
+                points_changed(collections.Counter(record['track'] for record in tracks))
+            updated = []
+            if actual:
+                cursor.execute(REPLAY_ACTUAL_LOCATIONS, {
+                    'devices': [record['device'] for record in actual],
+                    'points': [bytes.fromhex(record['point']) for record in actual],
+                    'ats': [record['at'] for record in actual]})
+                updated = [row[0] for row in cursor.fetchall()]
+        if updated and settings.TOOPATH_STREAM_ENABLED:
+            for actual_location in ActualLocation.objects.filter(pk__in=updated):
+                notify_location(actual_location)
+        IngestCheckpoint.objects.update_or_create(segment=segment_name, defaults={'offset': offset})
+    bump(*[version_key('track', tid) for tid in set(record['track'] for record in tracks)] +
+         [version_key('actual-location', d_pk) for d_pk in updated])
+    registry.inc('toopath_ingest_replayed_total', value=len(records))
+    if records:
+        registry.set('toopath_ingest_lag_seconds', value=time.time() - min(record['at'] for record in records))
+
+
+def drain_segment(path, batch_size):
+    """
+     Replays what was appended to the segment since its checkpoint. A sealed segment is removed once replayed.
+     Returns how many records were replayed.
+    """
+    if os.path.getsize(path) < HEADER.size:
+        # Not sized yet, which only a writer from before segments were renamed into place leaves behind.
+        return 0
+    segment = Segment(path)
+    try:
+        # Locked before reading: once its writer is gone, nothing can be appended after what is read here.
+        sealed = segment.lock(blocking=False)
+        checkpoint = IngestCheckpoint.objects.filter(segment=segment.name).values_list('offset', flat=True).first()
+        count = 0
+        batch, offset = [], checkpoint or 0
+        for payload, offset in segment.records(checkpoint or 0):
+            batch.append(json.loads(payload.decode('utf-8')))
+            if len(batch) >= batch_size:
+                replay(segment.name, batch, offset)
+                count += len(batch)
+                batch = []
+        if batch:
+            replay(segment.name, batch, offset)
+            count += len(batch)
+        if sealed:
+            # The file goes first: a checkpoint left behind is harmless, a segment without one would be replayed.
+            os.remove(path)
+            IngestCheckpoint.objects.filter(segment=segment.name).delete()
+        return count
+    finally:
+        segment.close()
+
+
+def drain():
+    """
+     Replays every segment of the log directory, oldest first. Returns how many records were replayed, or None
+     when another drainer is running.
+    """
+    directory = settings.TOOPATH_INGEST_LOG_DIR
+    os.makedirs(directory, exist_ok=True)
+    lock = os.open(os.path.join(directory, 'drain.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        count = 0
+        paths = sorted(glob.glob(os.path.join(directory, SEGMENT_PATTERN)))
+        for path in paths:
+            count += drain_segment(path, settings.TOOPATH_INGEST_DRAIN_BATCH)
+        if not count:
+            registry.set('toopath_ingest_lag_seconds', value=0)
+        registry.set('toopath_ingest_segments', value=len(glob.glob(os.path.join(directory, SEGMENT_PATTERN))))
+        registry.flush()
+        return count
+    finally:
+        os.close(lock)
@@ -0,0 +1,119 @@
+import datetime
+import traceback
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from TooPath3.metrics import registry
+from TooPath3.models import Job, CustomUser, Device, Track, TrackLocation
+
+handlers = {}
+
+
+def handler(kind):
+    """
+     Registers the function that runs the jobs of `kind`. It is called with the job's payload as keyword arguments
+     and must be safe to run again: a job whose worker died is handed to another one.
+    """
+    def decorator(function):
+        handlers[kind] = function
+        return function
+    return decorator
+
+
+def enqueue(kind, **payload):
+    # In the caller's transaction: the job only exists if what asked for it commits.
+    return Job.objects.create(kind=kind, payload=payload)
+
+
+def claim():
+    """
+     Takes the oldest job due, if any, skipping the rows other workers have locked. Running jobs whose lease ran
+     out are due again.
+    """
+    now = timezone.now()
+    expired = now - datetime.timedelta(seconds=settings.TOOPATH_JOBS_LEASE_SECONDS)
+    with transaction.atomic():
+        job = (Job.objects.select_for_update(skip_locked=True)
+               .filter(status=Job.QUEUED, run_after__lte=now).order_by('id').first())
+        if job is None:
+            job = (Job.objects.select_for_update(skip_locked=True)
+                   .filter(status=Job.RUNNING, locked_at__lt=expired).order_by('id').first())
+        if job is None:
+            return None
+        job.status = Job.RUNNING
+        job.locked_at = now
+        job.attempts += 1
+        job.save(update_fields=['status', 'locked_at', 'attempts', 'updated_at'])
+    return job
+
+
+def run(job):
+    labels = (('kind', job.kind),)
+    try:
+        handlers[job.kind](**job.payload)
+    except Exception:
+        job.error = traceback.format_exc()
+        if job.attempts < settings.TOOPATH_JOBS_MAX_ATTEMPTS:
+            job.status = Job.QUEUED
+            job.run_after = timezone.now() + datetime.timedelta(seconds=2 ** job.attempts)
+        else:
+            job.status = Job.FAILED
+    else:
+        job.status = Job.DONE
+        job.error = None
+    job.save(update_fields=['status', 'run_after', 'error', 'updated_at'])
+    registry.inc('toopath_jobs_total', labels + (('status', job.status),))
+    registry.flush()
+    return job
+
+
+def run_pending():
+    """
+     Runs jobs until none is due. Returns how many ran.
+    """
+    count = 0
+    job = claim()
+    while job is not None:
+        run(job)
+        count += 1
+        job = claim()
+    return count
+
+
+def purge_rows(model, column, value):
+    """
+     Deletes the rows of `model` whose `column` is `value`, a batch per statement so no transaction holds many
+     locks nor runs for long. No signals are sent: the rows belong to something already trashed.
+    """
+    table = connection.ops.quote_name(model._meta.db_table)
+    pk = connection.ops.quote_name(model._meta.pk.column)
+    sql = 'DELETE FROM {table} WHERE {pk} IN (SELECT {pk} FROM {table} WHERE {column} = %s LIMIT %s)'.format(
+        table=table, pk=pk, column=connection.ops.quote_name(column))
+    batch_size = settings.TOOPATH_JOBS_PURGE_BATCH
+    while True:
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [value, batch_size])
+            if cursor.rowcount < batch_size:
+                return
+
+
+@handler('purge_track')
+def purge_track(tid):
+    purge_rows(TrackLocation, 'track_id', tid)
+    Track.objects.filter(pk=tid).delete()
+
+
+@handler('purge_device')
+def purge_device(did):
+    for tid in Track.objects.filter(device_id=did).values_list('tid', flat=True):
+        purge_track(tid)
+    Device.objects.filter(pk=did).delete()
+
+
+@handler('purge_user')
+def purge_user(user_id):
+    for did in Device.objects.filter(owner_id=user_id).values_list('did', flat=True):
+        purge_device(did)
+    CustomUser.objects.filter(pk=user_id).delete()
@@ -0,0 +1,252 @@
+import math
+
+import numpy as np
+from django.conf import settings
+from django.db import connection
+from django.db.models import Count, Max, Min
+
+from TooPath3.archive import EPOCH, MICROSECOND, archived_columns, locations_of
+from TooPath3.conditional import points_changed
+from TooPath3.models import TrackLocation
+
+# `<->` orders by planar distance in degrees, which is only an approximation of the geodesic one away from the
+# equator. The k points the KNN index scan ranks first are no farther than the farthest of them, so the k nearest lie
+# within that distance: they are looked for again in a box wide enough for it at the latitude of the point, and ranked
+# by their real distance.
+NEAREST_TRACK_LOCATIONS_BOUND = '''
+    SELECT max(distance) FROM (
+        SELECT ST_Distance(point::geography, ST_GeomFromEWKB(%(origin)s)::geography) AS distance
+        FROM track_locations
+        WHERE track_id = %(track)s {radius_filter}
+        ORDER BY point <-> ST_GeomFromEWKB(%(origin)s)
+        LIMIT %(k)s
+    ) AS candidates
+'''
+
+NEAREST_TRACK_LOCATIONS = '''
+    SELECT id, point, created_at, updated_at, track_id, device_id, seq,
+           ST_Distance(point::geography, ST_GeomFromEWKB(%(origin)s)::geography) AS distance
+    FROM track_locations
+    WHERE track_id = %(track)s {radius_filter}
+      AND point && ST_MakeEnvelope(%(west)s, %(south)s, %(east)s, %(north)s, 4326)
+      AND ST_DWithin(point::geography, ST_GeomFromEWKB(%(origin)s)::geography, %(bound)s)
+    ORDER BY distance, id
+    LIMIT %(k)s
+'''
+
+# The fewest meters in a degree of latitude, and in a degree of longitude at the equator, on the WGS 84 ellipsoid: boxes
+# drawn with them are never too small.
+METERS_PER_DEGREE_OF_LATITUDE = 110574
+METERS_PER_DEGREE_OF_LONGITUDE = 111319
+
+RADIUS_FILTER = 'AND ST_DWithin(point::geography, ST_GeomFromEWKB(%(origin)s)::geography, %(radius)s)'
+
+# The archived points of a track have no index: PostGIS ranks them all, with the same distance as above.
+NEAREST_ARCHIVED_LOCATIONS = '''
+    SELECT * FROM (
+        SELECT id, ST_Distance(ST_SetSRID(ST_MakePoint(x, y), 4326)::geography,
+                               ST_GeomFromEWKB(%(origin)s)::geography) AS distance
+        FROM unnest(%(ids)s::integer[], %(xs)s::float8[], %(ys)s::float8[]) AS archived (id, x, y)
+    ) AS candidates
+    WHERE %(radius)s::float8 IS NULL OR distance <= %(radius)s::float8
+    ORDER BY distance, id
+    LIMIT %(k)s
+'''
+
+
+def nearest_track_locations(track, point, k, radius=None):
+    """
+     Returns the k locations of the track closest to the point, annotated with their `distance` in meters.
+    """
+    radius_filter = RADIUS_FILTER if radius is not None else ''
+    params = {'origin': bytes(point.ewkb), 'track': track.pk, 'k': k, 'radius': radius}
+    with connection.cursor() as cursor:
+        cursor.execute(NEAREST_TRACK_LOCATIONS_BOUND.format(radius_filter=radius_filter), params)
+        bound = cursor.fetchone()[0]
+    nearest = []
+    if bound is not None:
+        west, south, east, north = bounding_box(point, bound)
+        params.update(bound=bound, west=west, south=south, east=east, north=north)
+        nearest = list(TrackLocation.objects.raw(NEAREST_TRACK_LOCATIONS.format(radius_filter=radius_filter), params))
+    if track.archived_points:
+        merged = {location.id: location for location in nearest_archived_locations(track, point, k, radius)}
+        merged.update((location.id, location) for location in nearest)
+        nearest = sorted(merged.values(), key=lambda location: (location.distance, location.id))[:k]
+    return nearest
+
+
+def bounding_box(point, meters):
+    """
+     The (west, south, east, north) box, in degrees, holding every point within `meters` of the point. It spans every
+     longitude when it would reach a pole or cross the antimeridian.
+    """
+    margin = meters / METERS_PER_DEGREE_OF_LATITUDE
+    south, north = max(point.y - margin, -90.0), min(point.y + margin, 90.0)
+    # A degree of longitude is the shortest on the parallel of the box closest to a pole.
+    widest = max(abs(south), abs(north))
+    if widest >= 90.0:
+        return -180.0, south, 180.0, north
+    margin = meters / (METERS_PER_DEGREE_OF_LONGITUDE * math.cos(math.radians(widest)))
+    if point.x - margin < -180.0 or point.x + margin > 180.0:
+        return -180.0, south, 180.0, north
+    return point.x - margin, south, point.x + margin, north
+
+
+def nearest_archived_locations(track, point, k, radius=None):
+    columns = archived_columns(track)
+    if columns is None:
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute(NEAREST_ARCHIVED_LOCATIONS, {
+            'origin': bytes(point.ewkb), 'ids': columns['id'].tolist(), 'xs': columns['x'].tolist(),
+            'ys': columns['y'].tolist(), 'k': k, 'radius': radius})
+        distances = dict(cursor.fetchall())
+    nearest = locations_of(track.tid, columns, np.searchsorted(columns['id'], sorted(distances)))
+    for location in nearest:
+        location.distance = distances[location.id]
+    return nearest
+
+
+# Rows whose (device_id, seq) is already stored are skipped, including repeats inside the batch itself.
+SYNC_TRACK_LOCATIONS = '''
+    INSERT INTO track_locations (point, created_at, updated_at, track_id, device_id, seq)
+    SELECT ST_GeomFromEWKB(batch.point), now(), now(), %(track)s, %(device)s, batch.seq
+    FROM unnest(%(points)s::bytea[], %(seqs)s::bigint[]) AS batch (point, seq)
+    ON CONFLICT (device_id, seq) DO NOTHING
+'''
+
+
+def sync_track_locations(track, locations):
+    """
+     Stores a batch of `{'seq': ..., 'point': ...}` uploaded by the track's device in a single statement and counts
+     the new ones on the track. Returns how many were new. No signals are sent.
+    """
+    params = {'track': track.pk, 'device': track.device_id,
+              'points': [bytes(location['point'].ewkb) for location in locations],
+              'seqs': [location['seq'] for location in locations]}
+    with connection.cursor() as cursor:
+        cursor.execute(SYNC_TRACK_LOCATIONS, params)
+        created = cursor.rowcount
+    points_changed({track.pk: created})
+    return created
+
+
+# Walks up the device's sequence numbers from its high-water mark, one probe of the (device_id, seq) unique index per
+# number, and stops before the first one missing. The first walk starts at the lowest number stored.
+SYNC_HIGH_WATER_MARK = '''
+    WITH RECURSIVE run (seq) AS (
+        SELECT coalesce(synced_seq, (SELECT min(seq) FROM track_locations WHERE device_id = %(device)s))
+        FROM devices WHERE did = %(device)s
+      UNION ALL
+        SELECT run.seq + 1 FROM run
+        WHERE EXISTS (SELECT 1 FROM track_locations WHERE device_id = %(device)s AND seq = run.seq + 1)
+    )
+    UPDATE devices SET synced_seq = greatest(synced_seq, (SELECT max(seq) FROM run))
+    WHERE did = %(device)s
+    RETURNING synced_seq
+'''
+
+
+def sync_high_water_mark(device):
+    """
+     The highest sequence number up to which every point of the device is stored, so that a client resuming from it
+     uploads again the points of a batch that were lost; None before its first sync.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(SYNC_HIGH_WATER_MARK, {'device': device.pk})
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+# One point per bucket of %(width)s microseconds counted from the epoch, as date_trunc would for whole units: the first
+# or the last of each bucket in (created_at, id) order, ranked in a single pass over the (track, created_at) index.
+DOWNSAMPLED_TRACK_LOCATIONS = '''
+    SELECT id, point, created_at, updated_at, track_id, device_id, seq, bucket FROM (
+        SELECT *, row_number() OVER (PARTITION BY bucket ORDER BY created_at {order}, id {order}) AS rank
+        FROM (
+            SELECT id, point, created_at, updated_at, track_id, device_id, seq,
+                   (extract(epoch FROM created_at) * 1000000)::bigint / %(width)s AS bucket
+            FROM track_locations
+            WHERE track_id = %(track)s
+              AND (%(since)s::timestamptz IS NULL OR created_at >= %(since)s)
+              AND (%(until)s::timestamptz IS NULL OR created_at < %(until)s)
+        ) AS bucketed
+    ) AS ranked
+    WHERE rank = 1
+    ORDER BY created_at, id
+'''
+
+
+def bucket_width(first, last, bucket, max_points):
+    """
+     The narrowest width in seconds, of at least `bucket`, that splits the microseconds from `first` to `last` into
+     at most `max_points` buckets counted from the epoch.
+    """
+    def buckets(width):
+        return last // (width * 10 ** 6) - first // (width * 10 ** 6) + 1
+
+    width = max(bucket or 1, -(-(last - first) // (max_points * 10 ** 6)))
+    if buckets(width) > max_points:
+        # A bucket boundary can fall anywhere in the span: one bucket fewer over it makes room for the split one.
+        wider = -(-(last - first) // ((max_points - 1) * 10 ** 6)) if max_points > 1 else last // 10 ** 6 + 1
+        width = max(width, wider)
+    return width
+
+
+def _microseconds(date):
+    return None if date is None else (date - EPOCH) // MICROSECOND
+
+
+def _archived_in_window(track, since, until):
+    columns = archived_columns(track) if track.archived_points else None
+    if columns is None:
+        return None, np.array([], dtype=np.int64)
+    times = columns['created_at']
+    inside = np.ones(len(times), dtype=bool)
+    if since is not None:
+        inside &= times >= _microseconds(since)
+    if until is not None:
+        inside &= times < _microseconds(until)
+    indexes = np.flatnonzero(inside)
+    return columns, indexes[np.lexsort((columns['id'][indexes], times[indexes]))]
+
+
+def downsampled_track_locations(track, bucket=None, max_points=None, since=None, until=None, pick='first'):
+    """
+     The locations of the track from `since` until before `until`, archived ones included, in time order, and the
+     width in seconds of the buckets they were picked from: one location per bucket of at least `bucket` seconds,
+     the first or the last of it as `pick` says, with buckets as wide as it takes to answer at most `max_points`
+     (TOOPATH_DOWNSAMPLE_MAX_POINTS by default). Without `bucket`, tracks with no more points than that are answered
+     whole, with a width of None.
+    """
+    max_points = max_points or settings.TOOPATH_DOWNSAMPLE_MAX_POINTS
+    hot = TrackLocation.objects.filter(track=track)
+    if since is not None:
+        hot = hot.filter(created_at__gte=since)
+    if until is not None:
+        hot = hot.filter(created_at__lt=until)
+    columns, archived = _archived_in_window(track, since, until)
+    stats = hot.aggregate(count=Count('id'), first=Min('created_at'), last=Max('created_at'))
+    times = [_microseconds(stats['first']), _microseconds(stats['last'])] if stats['count'] else []
+    if len(archived):
+        times.extend((int(columns['created_at'][archived[0]]), int(columns['created_at'][archived[-1]])))
+    if not times:
+        return bucket, []
+    if bucket is None and stats['count'] + len(archived) <= max_points:
+        # A point both archived and still in the table, left by an interrupted archiving, is only served once.
+        locations = {location.id: location for location in locations_of(track.tid, columns, archived)}
+        locations.update((location.id, location) for location in hot)
+        return None, sorted(locations.values(), key=lambda location: (location.created_at, location.id))
+    width = bucket_width(min(times), max(times), bucket, max_points)
+    picked = {location.bucket: location for location in TrackLocation.objects.raw(
+        DOWNSAMPLED_TRACK_LOCATIONS.format(order='ASC' if pick == 'first' else 'DESC'),
+        {'width': width * 10 ** 6, 'track': track.pk, 'since': since, 'until': until})}
+    if len(archived):
+        order = archived if pick == 'first' else archived[::-1]
+        buckets, firsts = np.unique(columns['created_at'][order] // (width * 10 ** 6), return_index=True)
+        for number, location in zip(buckets.tolist(), locations_of(track.tid, columns, order[firsts])):
+            current = picked.get(number)
+            if current is None or ((location.created_at, location.id) < (current.created_at, current.id)) == (
+                    pick == 'first'):
+                picked[number] = location
+    return width, [picked[number] for number in sorted(picked)]
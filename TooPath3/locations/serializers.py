@@ -1,4 +1,9 @@
+import re
+
+from django.conf import settings
+from django.contrib.gis.geos import Point
 from rest_framework import serializers
+from rest_framework_gis.fields import GeometryField
 from rest_framework_gis.serializers import GeoFeatureModelSerializer
 
 from TooPath3.constants import DEFAULT_ERROR_MESSAGES
@@ -22,12 +27,138 @@ class TrackLocationSerializer(GeoFeatureModelSerializer):
         model = TrackLocation
         geo_field = 'point'
         fields = '__all__'
+        read_only_fields = ('device', 'seq')
 
     def validate(self, data):
         _validate_latitude_and_longitude(data)
         return data
 
 
+class NearestTrackLocationSerializer(TrackLocationSerializer):
+    distance = serializers.FloatField(read_only=True)
+
+
+class LonLatField(serializers.CharField):
+    default_error_messages = {
+        'invalid_point': DEFAULT_ERROR_MESSAGES['invalid_point'],
+    }
+
+    def to_internal_value(self, data):
+        try:
+            lon, lat = (float(value) for value in super(LonLatField, self).to_internal_value(data).split(','))
+        except ValueError:
+            self.fail('invalid_point')
+        if not (-180.0 <= lon <= 180.0 and -90.0 <= lat <= 90.0):
+            self.fail('invalid_point')
+        return Point(lon, lat, srid=4326)
+
+
+class BoundingBoxField(serializers.CharField):
+    default_error_messages = {
+        'invalid_bbox': DEFAULT_ERROR_MESSAGES['invalid_bbox'],
+    }
+
+    def to_internal_value(self, data):
+        try:
+            west, south, east, north = (float(value) for value in
+                                        super(BoundingBoxField, self).to_internal_value(data).split(','))
+        except ValueError:
+            self.fail('invalid_bbox')
+        if not (-180.0 <= west <= 180.0 and -180.0 <= east <= 180.0 and -90.0 <= south <= north <= 90.0):
+            self.fail('invalid_bbox')
+        return west, south, east, north
+
+
+class BucketField(serializers.CharField):
+    """
+     A bucket width in seconds, given as `30`, `30s`, `5m`, `1h` or `1d`.
+    """
+    UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    default_error_messages = {
+        'invalid_bucket': DEFAULT_ERROR_MESSAGES['invalid_bucket'],
+    }
+
+    def to_internal_value(self, data):
+        match = re.match(r'^([0-9]+)([smhd]?)$', super(BucketField, self).to_internal_value(data).lower())
+        if match is None or not int(match.group(1)):
+            self.fail('invalid_bucket')
+        return int(match.group(1)) * self.UNITS[match.group(2) or 's']
+
+
+class NearestQuerySerializer(serializers.Serializer):
+    point = LonLatField(required=True)
+    k = serializers.IntegerField(min_value=1, max_value=1000, default=1)
+    radius = serializers.FloatField(min_value=0, required=False)
+
+
+class NearbyQuerySerializer(serializers.Serializer):
+    point = LonLatField(required=True)
+    radius = serializers.FloatField(min_value=0, max_value=settings.TOOPATH_NEARBY_MAX_RADIUS, required=True)
+    k = serializers.IntegerField(min_value=1, max_value=1000, default=10)
+
+
+class ClusterQuerySerializer(serializers.Serializer):
+    bbox = BoundingBoxField(required=True)
+    zoom = serializers.IntegerField(min_value=0, max_value=30, required=True)
+
+
+class PlaybackQuerySerializer(serializers.Serializer):
+    at = serializers.DateTimeField(required=False)
+    times = serializers.CharField(required=False)
+
+    def validate_times(self, times):
+        times = times.split(',')
+        if len(times) > settings.TOOPATH_PLAYBACK_MAX_TIMES:
+            raise serializers.ValidationError(DEFAULT_ERROR_MESSAGES['too_many_times'] %
+                                              {'max': settings.TOOPATH_PLAYBACK_MAX_TIMES})
+        return [serializers.DateTimeField().to_internal_value(time) for time in times]
+
+    def validate(self, data):
+        if ('at' in data) == ('times' in data):
+            raise serializers.ValidationError(DEFAULT_ERROR_MESSAGES['playback_time_required'])
+        return data
+
+
+class DownsampleQuerySerializer(serializers.Serializer):
+    bucket = BucketField(required=False)
+    max_points = serializers.IntegerField(min_value=1, max_value=settings.TOOPATH_DOWNSAMPLE_MAX_POINTS,
+                                          required=False)
+    since = serializers.DateTimeField(required=False)
+    until = serializers.DateTimeField(required=False)
+    pick = serializers.ChoiceField(choices=('first', 'last'), default='first')
+
+    def validate(self, data):
+        if 'since' in data and 'until' in data and data['until'] <= data['since']:
+            raise serializers.ValidationError(DEFAULT_ERROR_MESSAGES['invalid_time_window'])
+        return data
+
+
+class SyncLocationSerializer(serializers.Serializer):
+    seq = serializers.IntegerField(min_value=0, max_value=2 ** 63 - 1)
+    point = GeometryField()
+
+    def validate_point(self, point):
+        if point.geom_type != 'Point':
+            raise serializers.ValidationError(DEFAULT_ERROR_MESSAGES['invalid_sync_point'])
+        if point.srid is None:
+            point.srid = 4326
+        return point
+
+    def validate(self, data):
+        _validate_latitude_and_longitude(data)
+        return data
+
+
+class SyncBatchSerializer(serializers.Serializer):
+    locations = SyncLocationSerializer(many=True, allow_empty=False)
+
+    def validate_locations(self, locations):
+        if len(locations) > settings.TOOPATH_SYNC_MAX_BATCH:
+            raise serializers.ValidationError(DEFAULT_ERROR_MESSAGES['sync_batch_too_big'] %
+                                              {'max': settings.TOOPATH_SYNC_MAX_BATCH})
+        return locations
+
+
 def _validate_latitude_and_longitude(data):
     if (data['point'].x < -90.0) or (data['point'].x > 90.0):
         raise serializers.ValidationError(DEFAULT_ERROR_MESSAGES['invalid_latitude'])
@@ -1,13 +1,23 @@
+import datetime
+import os
+import tempfile
+import time
 from builtins import set
+from unittest import mock
 
 from django.contrib.auth.hashers import make_password
 from django.contrib.gis.geos import Point
+from django.test import SimpleTestCase, override_settings
+from django.utils import timezone
 from rest_framework.test import APITestCase, APIRequestFactory, force_authenticate, APIClient
 from rest_framework_jwt.settings import api_settings
 
 from TooPath3.constants import DEFAULT_ERROR_MESSAGES
+from TooPath3.ingest import Segment, close_log, drain, get_log
 from TooPath3.locations.views import *
-from TooPath3.models import Device, CustomUser, TrackLocation
+from TooPath3.metrics import registry
+from TooPath3.models import Device, CustomUser, TrackLocation, ActualLocation, IngestCheckpoint
+from TooPath3.throttling import BucketTable, get_table
 from TooPath3.utils import generate_token_for_user, get_latest_id_inserted, create_user_with_email, \
     create_device_with_owner, create_track_with_device, create_track_location_with_track
 
@@ -221,3 +231,372 @@ class PostTrackLocationCase(APITestCase):
 
     def _get_track_location_by_id(self, id):
         return TrackLocation.objects.get(pk=id)
+
+
+class GetNearestTrackLocationsCase(APITestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = create_user_with_email('user_test')
+        self.token = generate_token_for_user(self.user)
+        self.client.credentials(HTTP_AUTHORIZATION='JWT ' + self.token)
+        self.device = create_device_with_owner(self.user)
+        self.track = create_track_with_device(self.device)
+        self.far = TrackLocation.objects.create(point=Point(2.0, 41.0), track=self.track)
+        self.near = TrackLocation.objects.create(point=Point(2.1734, 41.3851), track=self.track)
+        self.path = '/devices/' + str(self.device.did) + '/tracks/' + str(self.track.tid) + '/nearest/'
+
+    def test_return_403_status_when_user_has_not_permissions(self):
+        owner = create_user_with_email('owner')
+        device = create_device_with_owner(owner)
+        track = create_track_with_device(device)
+        response = self.client.get('/devices/' + str(device.did) + '/tracks/' + str(track.tid) + '/nearest/',
+                                   {'point': '2.17,41.38'})
+        self.assertEqual(HTTP_403_FORBIDDEN, response.status_code)
+
+    def test_return_400_status_when_point_is_invalid(self):
+        response = self.client.get(self.path, {'point': '200,41'})
+        self.assertEqual({'point': [DEFAULT_ERROR_MESSAGES['invalid_point']]}, response.data)
+
+    def test_return_closest_location_first(self):
+        other_track = create_track_with_device(self.device)
+        TrackLocation.objects.create(point=Point(2.1734, 41.3851), track=other_track)
+        response = self.client.get(self.path, {'point': '2.17,41.38', 'k': 5})
+        self.assertEqual([self.near.id, self.far.id], [feature['id'] for feature in response.data['features']])
+
+    def test_return_only_locations_within_radius(self):
+        response = self.client.get(self.path, {'point': '2.1734,41.3851', 'k': 5, 'radius': 50})
+        self.assertEqual([self.near.id], [feature['id'] for feature in response.data['features']])
+        self.assertLess(response.data['features'][0]['properties']['distance'], 50)
+
+    def test_return_the_closest_location_when_many_are_closer_in_degrees(self):
+        # Near the pole a degree of longitude is a few kilometers: these are closer in degrees but farther away.
+        TrackLocation.objects.bulk_create(
+            TrackLocation(point=Point(0.0, 80.2 + n / 1000.0), track=self.track) for n in range(10))
+        closest = TrackLocation.objects.create(point=Point(0.5, 80.0), track=self.track)
+        response = self.client.get(self.path, {'point': '0,80', 'k': 1})
+        self.assertEqual([closest.id], [feature['id'] for feature in response.data['features']])
+
+
+@override_settings(TOOPATH_RESPONSE_CACHE_ENABLED=False)
+class GetTrackLocationsCase(APITestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = create_user_with_email('user_test')
+        self.client.credentials(HTTP_AUTHORIZATION='JWT ' + generate_token_for_user(self.user))
+        self.device = create_device_with_owner(self.user)
+        self.track = create_track_with_device(self.device)
+        # A point a second for two minutes, from a whole minute on.
+        self.start = timezone.now().replace(second=0, microsecond=0) - datetime.timedelta(hours=1)
+        TrackLocation.objects.bulk_create(
+            TrackLocation(point=Point(seconds / 1000.0, 41.0, srid=4326), track=self.track) for seconds in range(120))
+        for seconds, location in enumerate(TrackLocation.objects.filter(track=self.track).order_by('id')):
+            TrackLocation.objects.filter(pk=location.pk).update(
+                created_at=self.start + datetime.timedelta(seconds=seconds))
+        self.ids = list(TrackLocation.objects.filter(track=self.track).order_by('id').values_list('id', flat=True))
+        self.path = '/devices/' + str(self.device.did) + '/tracks/' + str(self.track.tid) + '/locations/'
+
+    def ids_of(self, response):
+        return [feature['id'] for feature in response.data['features']]
+
+    def test_return_403_status_when_user_has_not_permissions(self):
+        owner = create_user_with_email('owner')
+        device = create_device_with_owner(owner)
+        track = create_track_with_device(device)
+        response = self.client.get('/devices/' + str(device.did) + '/tracks/' + str(track.tid) + '/locations/')
+        self.assertEqual(HTTP_403_FORBIDDEN, response.status_code)
+
+    def test_return_every_location_in_time_order(self):
+        response = self.client.get(self.path)
+        self.assertEqual(self.ids, self.ids_of(response))
+        self.assertIsNone(response.data['bucket'])
+
+    def test_return_the_first_or_last_location_of_each_bucket(self):
+        response = self.client.get(self.path, {'bucket': '30s'})
+        self.assertEqual([self.ids[i] for i in (0, 30, 60, 90)], self.ids_of(response))
+        self.assertEqual(30, response.data['bucket'])
+        response = self.client.get(self.path, {'bucket': '1m', 'pick': 'last'})
+        self.assertEqual([self.ids[59], self.ids[119]], self.ids_of(response))
+
+    def test_return_at_most_max_points(self):
+        for max_points in (1, 7, 10, 119):
+            response = self.client.get(self.path, {'max_points': max_points})
+            self.assertLessEqual(len(response.data['features']), max_points)
+            self.assertEqual(self.ids[0], self.ids_of(response)[0])
+
+    @override_settings(TOOPATH_DOWNSAMPLE_MAX_POINTS=50)
+    def test_buckets_are_widened_to_bound_the_response(self):
+        response = self.client.get(self.path, {'bucket': '1'})
+        self.assertLessEqual(len(response.data['features']), 50)
+        self.assertGreater(response.data['bucket'], 1)
+
+    def test_return_locations_within_the_time_window(self):
+        response = self.client.get(self.path, {'since': (self.start + datetime.timedelta(seconds=100)).isoformat(),
+                                               'until': (self.start + datetime.timedelta(seconds=110)).isoformat()})
+        self.assertEqual(self.ids[100:110], self.ids_of(response))
+
+    def test_return_400_status_when_bucket_is_invalid(self):
+        response = self.client.get(self.path, {'bucket': '30 parsecs'})
+        self.assertEqual({'bucket': [DEFAULT_ERROR_MESSAGES['invalid_bucket']]}, response.data)
+
+
+class SyncTrackLocationsCase(APITestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = create_user_with_email('user_test')
+        self.token = generate_token_for_user(self.user)
+        self.client.credentials(HTTP_AUTHORIZATION='JWT ' + self.token)
+        self.device = create_device_with_owner(self.user)
+        self.track = create_track_with_device(self.device)
+        self.path = '/devices/' + str(self.device.did) + '/tracks/' + str(self.track.tid) + '/sync/'
+
+    def batch(self, *seqs):
+        return {'locations': [{'seq': seq, 'point': {'type': 'Point', 'coordinates': [2.17, 41.38]}} for seq in seqs]}
+
+    def test_return_high_water_mark_before_first_sync(self):
+        response = self.client.get(self.path)
+        self.assertEqual({'seq': None}, response.data)
+
+    def test_return_created_locations_and_high_water_mark(self):
+        response = self.client.post(self.path, self.batch(1, 2, 3))
+        self.assertEqual(HTTP_200_OK, response.status_code)
+        self.assertEqual({'seq': 3, 'created': 3}, response.data)
+        seqs = TrackLocation.objects.filter(track=self.track).values_list('seq', flat=True)
+        self.assertEqual([1, 2, 3], sorted(seqs))
+
+    def test_retried_batch_does_not_duplicate_locations(self):
+        self.client.post(self.path, self.batch(1, 2, 3))
+        response = self.client.post(self.path, self.batch(2, 3, 4, 4))
+        self.assertEqual({'seq': 4, 'created': 1}, response.data)
+        self.assertEqual(4, TrackLocation.objects.filter(track=self.track).count())
+        self.assertEqual({'seq': 4}, self.client.get(self.path).data)
+
+    def test_high_water_mark_stops_before_a_missing_location(self):
+        response = self.client.post(self.path, self.batch(1, 2, 4))
+        self.assertEqual({'seq': 2, 'created': 3}, response.data)
+        self.assertEqual({'seq': 2}, self.client.get(self.path).data)
+        response = self.client.post(self.path, self.batch(3))
+        self.assertEqual({'seq': 4, 'created': 1}, response.data)
+
+    def test_sequence_numbers_belong_to_the_device(self):
+        other_track = create_track_with_device(self.device)
+        self.client.post(self.path, self.batch(1, 2))
+        response = self.client.post('/devices/' + str(self.device.did) + '/tracks/' + str(other_track.tid) +
+                                    '/sync/', self.batch(2, 3))
+        self.assertEqual({'seq': 3, 'created': 1}, response.data)
+
+    def test_return_404_when_track_belongs_to_another_device(self):
+        other_device = create_device_with_owner(self.user)
+        response = self.client.post('/devices/' + str(other_device.did) + '/tracks/' + str(self.track.tid) +
+                                    '/sync/', self.batch(1))
+        self.assertEqual(HTTP_404_NOT_FOUND, response.status_code)
+
+    def test_return_403_status_when_user_has_not_permissions(self):
+        owner = create_user_with_email('owner')
+        device = create_device_with_owner(owner)
+        track = create_track_with_device(device)
+        response = self.client.post('/devices/' + str(device.did) + '/tracks/' + str(track.tid) + '/sync/',
+                                    self.batch(1))
+        self.assertEqual(HTTP_403_FORBIDDEN, response.status_code)
+
+    def test_return_400_status_when_point_is_invalid(self):
+        json_body = {'locations': [{'seq': 1, 'point': {'type': 'Point', 'coordinates': [91, 90]}}]}
+        response = self.client.post(self.path, json_body)
+        self.assertEqual(HTTP_400_BAD_REQUEST, response.status_code)
+        self.assertFalse(TrackLocation.objects.exists())
+
+    def test_synced_locations_are_served_by_the_track(self):
+        self.client.post(self.path, self.batch(1, 2))
+        response = self.client.get('/devices/' + str(self.device.did) + '/tracks/' + str(self.track.tid) + '/')
+        self.assertEqual(2, len(response.data['locations']['features']))
+
+
+class IngestLogCase(APITestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.settings = override_settings(TOOPATH_INGEST_LOG_ENABLED=True, TOOPATH_INGEST_LOG_DIR=self.directory,
+                                          TOOPATH_INGEST_SEGMENT_BYTES=4096, TOOPATH_INGEST_DRAIN_BATCH=3,
+                                          TOOPATH_THROTTLE_ENABLED=False)
+        self.settings.enable()
+        self.client = APIClient()
+        self.user = create_user_with_email('ingest@gmail.com')
+        self.device = create_device_with_owner(self.user)
+        self.track = create_track_with_device(self.device)
+        self.client.credentials(HTTP_AUTHORIZATION='JWT ' + generate_token_for_user(self.user))
+
+    def tearDown(self):
+        close_log()
+        self.settings.disable()
+
+    def post_locations(self, count):
+        for i in range(count):
+            response = self.client.post('/devices/%d/tracks/%d/locations/' % (self.device.pk, self.track.pk),
+                                        {'point': {'type': 'Point', 'coordinates': [41.38, 2.17]}})
+            self.assertEqual(202, response.status_code)
+
+    def test_track_locations_are_acknowledged_then_replayed(self):
+        self.post_locations(5)
+        self.assertFalse(TrackLocation.objects.exists())
+        self.assertEqual(5, drain())
+        self.assertEqual(5, TrackLocation.objects.filter(track=self.track).count())
+
+    def test_a_replayed_record_is_not_replayed_again(self):
+        self.post_locations(2)
+        drain()
+        self.post_locations(1)
+        self.assertEqual(1, drain())
+        self.assertEqual(3, TrackLocation.objects.count())
+
+    def test_the_actual_location_keeps_the_latest_fix(self):
+        for coordinates in ([1.0, 2.0], [3.0, 4.0]):
+            response = self.client.put('/devices/%d/actualLocation/' % self.device.pk,
+                                       {'point': {'type': 'Point', 'coordinates': coordinates}})
+            self.assertEqual(202, response.status_code)
+        drain()
+        point = ActualLocation.objects.get(pk=self.device.pk).point
+        self.assertEqual((3.0, 4.0), (point.x, point.y))
+
+    def put_actual_location(self, coordinates, logged_ago):
+        with mock.patch('TooPath3.ingest.time.time', return_value=time.time() - logged_ago):
+            response = self.client.put('/devices/%d/actualLocation/' % self.device.pk,
+                                       {'point': {'type': 'Point', 'coordinates': coordinates}})
+        self.assertEqual(202, response.status_code)
+
+    def test_a_late_replay_is_stamped_updated_when_it_is_written(self):
+        self.put_actual_location([1.0, 2.0], logged_ago=600)
+        drain()
+        actual_location = ActualLocation.objects.get(pk=self.device.pk)
+        self.assertGreater(actual_location.updated_at, timezone.now() - datetime.timedelta(seconds=60))
+        self.assertLess(actual_location.fixed_at, timezone.now() - datetime.timedelta(seconds=500))
+        # Older than the fix just written, although logged after it was stamped updated.
+        self.put_actual_location([3.0, 4.0], logged_ago=900)
+        drain()
+        point = ActualLocation.objects.get(pk=self.device.pk).point
+        self.assertEqual((1.0, 2.0), (point.x, point.y))
+
+    def test_sealed_segments_are_removed_once_replayed(self):
+        self.post_locations(60)
+        close_log()
+        self.assertEqual(60, drain())
+        self.assertEqual([], [name for name in os.listdir(self.directory) if name.endswith('.wal')])
+        self.assertFalse(IngestCheckpoint.objects.exists())
+
+    def test_a_segment_is_locked_before_the_drainer_can_see_it(self):
+        rename = os.rename
+
+        def locked_rename(source, destination):
+            self.assertEqual([], [name for name in os.listdir(self.directory) if name.endswith('.wal')])
+            reader = Segment(source)
+            self.assertFalse(reader.lock(blocking=False))
+            reader.close()
+            rename(source, destination)
+
+        with mock.patch('TooPath3.ingest.os.rename', side_effect=locked_rename) as renamed:
+            self.post_locations(1)
+        self.assertTrue(renamed.called)
+        self.assertEqual(1, drain())
+        self.assertEqual([get_log().segment.name], [name for name in os.listdir(self.directory)
+                                                    if name.endswith('.wal')])
+
+    def test_an_empty_segment_is_skipped(self):
+        self.post_locations(1)
+        open(os.path.join(self.directory, '0-empty.wal'), 'wb').close()
+        self.assertEqual(1, drain())
+        self.assertTrue(os.path.exists(os.path.join(self.directory, '0-empty.wal')))
+
+    def test_a_torn_record_ends_the_segment(self):
+        self.post_locations(2)
+        segment = get_log().segment
+        # The second record's last byte never reached the disk.
+        offset = [offset for payload, offset in segment.records()][1]
+        segment.map[offset - 1:offset] = b'\x00'
+        reader = Segment(segment.path)
+        self.assertEqual(1, len(list(reader.records())))
+        reader.close()
+
+
+class BucketTableCase(SimpleTestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'buckets')
+        self.table = BucketTable(self.path, 64)
+
+    def test_a_bucket_allows_its_burst_then_asks_to_wait(self):
+        self.assertEqual([0, 0, 0], [self.table.take('device:1', 3, 0.5, now=100.0) for i in range(3)])
+        self.assertEqual(2.0, self.table.take('device:1', 3, 0.5, now=100.0))
+
+    def test_a_bucket_refills_over_time(self):
+        for i in range(3):
+            self.table.take('device:1', 3, 0.5, now=100.0)
+        self.assertEqual(0, self.table.take('device:1', 3, 0.5, now=102.0))
+        self.assertGreater(self.table.take('device:1', 3, 0.5, now=102.0), 0)
+
+    def test_buckets_are_shared_by_every_mapping_of_the_file(self):
+        other = BucketTable(self.path, 64)
+        self.table.take('device:1', 1, 0.1, now=100.0)
+        self.assertGreater(other.take('device:1', 1, 0.1, now=100.0), 0)
+        self.assertEqual(0, other.take('device:2', 1, 0.1, now=100.0))
+
+    def test_an_empty_bucket_keeps_the_others_from_being_taken_from(self):
+        self.table.take('user:1', 1, 0.1, now=100.0)
+        self.assertEqual([0, 10.0], self.table.take_all([('device:1', 1, 0.1), ('user:1', 1, 0.1)], now=100.0))
+        self.assertEqual(0, self.table.take('device:1', 1, 0.1, now=100.0))
+
+
+class LocationWriteThrottleCase(APITestCase):
+    def setUp(self):
+        registry.clear()
+        self.settings = override_settings(
+            TOOPATH_THROTTLE_ENABLED=True, TOOPATH_THROTTLE_FILE=os.path.join(tempfile.mkdtemp(), 'buckets'),
+            TOOPATH_THROTTLE_DEVICE_RATES={Device.ENFORA: (3, 0.01)}, TOOPATH_THROTTLE_DEFAULT_DEVICE_RATE=(2, 0.01),
+            TOOPATH_THROTTLE_USER_RATE=(4, 0.01))
+        self.settings.enable()
+        self.client = APIClient()
+        self.user = create_user_with_email('throttle@gmail.com')
+        self.device = create_device_with_owner(self.user)
+        self.track = create_track_with_device(self.device)
+        self.client.credentials(HTTP_AUTHORIZATION='JWT ' + generate_token_for_user(self.user))
+
+    def tearDown(self):
+        self.settings.disable()
+
+    def post(self, device, track):
+        return self.client.post('/devices/%d/tracks/%d/locations/' % (device.pk, track.pk),
+                                {'point': {'type': 'Point', 'coordinates': [41.38, 2.17]}})
+
+    def test_a_device_over_its_burst_gets_429_with_retry_after(self):
+        self.assertEqual([201, 201], [self.post(self.device, self.track).status_code for i in range(2)])
+        response = self.post(self.device, self.track)
+        self.assertEqual(429, response.status_code)
+        self.assertLessEqual(1, int(response['Retry-After']))
+        self.assertEqual(1, registry.values[('toopath_throttle_decisions_total',
+                                             (('decision', 'throttled'), ('device_type', Device.ANDROID),
+                                              ('scope', 'device')))])
+
+    def test_the_burst_depends_on_the_device_type(self):
+        tracker = create_device_with_owner(self.user)
+        Device.objects.filter(pk=tracker.pk).update(device_type=Device.ENFORA)
+        track = create_track_with_device(tracker)
+        self.assertEqual([201, 201, 201, 429], [self.post(tracker, track).status_code for i in range(4)])
+
+    def test_the_user_bucket_spans_their_devices(self):
+        statuses = []
+        for i in range(3):
+            device = self.device if i == 0 else create_device_with_owner(self.user)
+            track = self.track if i == 0 else create_track_with_device(device)
+            statuses += [self.post(device, track).status_code for j in range(2 if i < 2 else 1)]
+        self.assertEqual([201, 201, 201, 201, 429], statuses)
+
+    def test_a_request_the_user_bucket_refuses_leaves_the_device_bucket_alone(self):
+        for i in range(2):
+            device = create_device_with_owner(self.user)
+            track = create_track_with_device(device)
+            self.assertEqual([201, 201], [self.post(device, track).status_code for j in range(2)])
+        self.assertEqual(429, self.post(self.device, self.track).status_code)
+        key = 'device:%d:%d' % (self.user.pk, self.device.pk)
+        self.assertEqual([0, 0], [get_table().take(key, 2, 0.01) for i in range(2)])
+
+    def test_reads_are_not_throttled(self):
+        for i in range(3):
+            self.assertEqual(200, self.client.get('/devices/%d/actualLocation/' % self.device.pk).status_code)
+
+
+# Transactional: the archives are removed once their deletion commits.
@@ -1,3 +1,5 @@
+from django.conf import settings
+from django.http import Http404
 from rest_framework.authentication import SessionAuthentication, BasicAuthentication
 from rest_framework.generics import get_object_or_404
 from rest_framework.permissions import IsAuthenticated
@@ -6,20 +8,33 @@ from rest_framework.status import *
 from rest_framework.views import APIView
 from rest_framework_jwt.authentication import JSONWebTokenAuthentication
 
+from TooPath3.archive import restore_track
+from TooPath3.caching import cached_response, actual_location_dependencies, track_dependencies, bump, version_key
+from TooPath3.conditional import conditional_response, actual_location_validators, track_validators, points_changed
 from TooPath3.devices.permissions import IsOwnerOrReadOnly
-from TooPath3.locations.serializers import ActualLocationSerializer, TrackLocationSerializer
+from TooPath3.ingest import log_track_location, log_actual_location
+from TooPath3.locations.queries import nearest_track_locations, sync_track_locations, sync_high_water_mark, \
+    downsampled_track_locations
+from TooPath3.locations.serializers import ActualLocationSerializer, TrackLocationSerializer, \
+    NearestQuerySerializer, NearestTrackLocationSerializer, SyncBatchSerializer, DownsampleQuerySerializer
 from TooPath3.models import ActualLocation, Track, Device, TrackLocation
+from TooPath3.proximity import live_positions
+from TooPath3.throttling import LocationWriteThrottle
+from TooPath3.utils import alive
 
 
 class DeviceActualLocation(APIView):
     authentication_classes = (JSONWebTokenAuthentication, SessionAuthentication, BasicAuthentication,)
     permission_classes = (IsAuthenticated, IsOwnerOrReadOnly,)
+    throttle_classes = (LocationWriteThrottle,)
 
     def get_object(self, pk):
-        obj = get_object_or_404(ActualLocation, pk=pk)
+        obj = get_object_or_404(alive(ActualLocation), pk=pk)
         self.check_object_permissions(self.request, obj=obj)
         return obj
 
+    @conditional_response(actual_location_validators)
+    @cached_response('device-actual-location', actual_location_dependencies)
     def get(self, request, d_pk):
         actual_location = self.get_object(d_pk)
         serializer = ActualLocationSerializer(instance=actual_location)
@@ -30,6 +45,12 @@ class DeviceActualLocation(APIView):
         actual_location = self.get_object(d_pk)
         serializer = ActualLocationSerializer(instance=actual_location, data=request.data)
         if serializer.is_valid():
+            if settings.TOOPATH_INGEST_LOG_ENABLED:
+                # Logged to disk and acknowledged; the drainer writes it to the database (see TooPath3/ingest.py).
+                log_actual_location(actual_location.pk, serializer.validated_data['point'])
+                live_positions.moved(actual_location.pk, serializer.validated_data['point'])
+                actual_location.point = serializer.validated_data['point']
+                return Response(data=ActualLocationSerializer(instance=actual_location).data, status=HTTP_202_ACCEPTED)
             actual_location_updated = serializer.save()
             return Response(data=ActualLocationSerializer(instance=actual_location_updated).data, status=HTTP_200_OK)
         return Response(data=serializer.errors, status=HTTP_400_BAD_REQUEST)
@@ -40,33 +61,120 @@ class TrackLocationDetail(APIView):
     permission_classes = (IsAuthenticated, IsOwnerOrReadOnly,)
 
     def get_object(self, pk, model_class):
-        obj = get_object_or_404(model_class, pk=pk)
+        obj = get_object_or_404(alive(model_class), pk=pk)
         self.check_object_permissions(self.request, obj=obj)
         return obj
 
     def delete(self, request, d_pk, t_pk, l_pk):
         self.get_object(pk=d_pk, model_class=Device)
-        self.get_object(pk=t_pk, model_class=Track)
+        track = self.get_object(pk=t_pk, model_class=Track)
+        if track.archived_points:
+            restore_track(track)
         track_location = self.get_object(pk=l_pk, model_class=TrackLocation)
         track_location.delete()
+        points_changed({track.tid: -1})
+        # Its stops are detected again from scratch (see TooPath3/stops.py).
+        Track.objects.filter(pk=track.pk).update(stops_checked_at=None)
+        bump(version_key('track', track.tid))
         return Response(status=HTTP_204_NO_CONTENT)
 
 
 class TrackLocationList(APIView):
     authentication_classes = (JSONWebTokenAuthentication, SessionAuthentication, BasicAuthentication,)
     permission_classes = (IsAuthenticated, IsOwnerOrReadOnly,)
+    throttle_classes = (LocationWriteThrottle,)
 
-    def get_object(self, pk, model_class):
-        obj = get_object_or_404(model_class, pk=pk)
+    def get_object(self, pk, model_class, queryset=None):
+        obj = get_object_or_404(alive(model_class) if queryset is None else queryset, pk=pk)
         self.check_object_permissions(self.request, obj=obj)
         return obj
 
+    @conditional_response(track_validators)
+    @cached_response('track-location-list', track_dependencies)
+    def get(self, request, d_pk, t_pk):
+        """
+         The locations of the track in time order, between `since` and `until` when given, one per `bucket` (like
+         `30s` or `5m`) when asked for, and never more than `max_points`: buckets are widened as needed, and their
+         width in seconds is answered as `bucket`. `pick` tells whether the first or the last point of a bucket stands
+         for it.
+        """
+        self.get_object(d_pk, Device)
+        track = self.get_object(t_pk, Track, alive(Track).defer(None))
+        query = DownsampleQuerySerializer(data=request.query_params)
+        if query.is_valid():
+            width, track_locations = downsampled_track_locations(track, **query.validated_data)
+            data = TrackLocationSerializer(instance=track_locations, many=True).data
+            data['bucket'] = width
+            return Response(data=data, status=HTTP_200_OK)
+        return Response(data=query.errors, status=HTTP_400_BAD_REQUEST)
+
     def post(self, request, d_pk, t_pk):
         self.get_object(d_pk, Device)
         track = self.get_object(t_pk, Track)
         request.data['track'] = track.tid
         serializer = TrackLocationSerializer(data=request.data)
         if serializer.is_valid():
+            if settings.TOOPATH_INGEST_LOG_ENABLED:
+                log_track_location(track, serializer.validated_data['point'])
+                track_location = TrackLocation(track=track, point=serializer.validated_data['point'])
+                return Response(data=TrackLocationSerializer(instance=track_location).data, status=HTTP_202_ACCEPTED)
             track_location_created = serializer.save()
             return Response(data=TrackLocationSerializer(instance=track_location_created).data, status=HTTP_201_CREATED)
         return Response(data=serializer.errors, status=HTTP_400_BAD_REQUEST)
+
+
+class TrackLocationNearest(APIView):
+    authentication_classes = (JSONWebTokenAuthentication, SessionAuthentication, BasicAuthentication,)
+    permission_classes = (IsAuthenticated, IsOwnerOrReadOnly,)
+
+    def get_object(self, pk, model_class, queryset=None):
+        obj = get_object_or_404(alive(model_class) if queryset is None else queryset, pk=pk)
+        self.check_object_permissions(self.request, obj=obj)
+        return obj
+
+    def get(self, request, d_pk, t_pk):
+        self.get_object(d_pk, Device)
+        track = self.get_object(t_pk, Track, alive(Track).defer(None))
+        query = NearestQuerySerializer(data=request.query_params)
+        if query.is_valid():
+            track_locations = nearest_track_locations(track, **query.validated_data)
+            serializer = NearestTrackLocationSerializer(instance=track_locations, many=True)
+            return Response(data=serializer.data, status=HTTP_200_OK)
+        return Response(data=query.errors, status=HTTP_400_BAD_REQUEST)
+
+
+class TrackLocationSync(APIView):
+    """
+     Batch upload for devices that buffer points while offline. Each point carries the device's own sequence number;
+     points already stored are skipped, so a client resumes by uploading again whatever it hasn't seen acknowledged.
+     Both methods answer with the device's high-water mark.
+    """
+    authentication_classes = (JSONWebTokenAuthentication, SessionAuthentication, BasicAuthentication,)
+    permission_classes = (IsAuthenticated, IsOwnerOrReadOnly,)
+    throttle_classes = (LocationWriteThrottle,)
+
+    def get_object(self, pk, model_class):
+        obj = get_object_or_404(alive(model_class), pk=pk)
+        self.check_object_permissions(self.request, obj=obj)
+        return obj
+
+    def get_track(self, d_pk, t_pk):
+        device = self.get_object(d_pk, Device)
+        track = self.get_object(t_pk, Track)
+        if track.device_id != device.did:
+            raise Http404
+        return device, track
+
+    def get(self, request, d_pk, t_pk):
+        device, track = self.get_track(d_pk, t_pk)
+        return Response(data={'seq': sync_high_water_mark(device)}, status=HTTP_200_OK)
+
+    def post(self, request, d_pk, t_pk):
+        device, track = self.get_track(d_pk, t_pk)
+        serializer = SyncBatchSerializer(data=request.data)
+        if serializer.is_valid():
+            created = sync_track_locations(track, serializer.validated_data['locations'])
+            if created:
+                bump(version_key('track', track.tid))
+            return Response(data={'seq': sync_high_water_mark(device), 'created': created}, status=HTTP_200_OK)
+        return Response(data=serializer.errors, status=HTTP_400_BAD_REQUEST)
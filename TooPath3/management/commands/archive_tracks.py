@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from TooPath3.archive import cold_tracks
+from TooPath3.jobs import enqueue
+
+
+class Command(BaseCommand):
+    help = ('Queues a job archiving every track whose points in the table were all last updated more than --days '
+            'ago. Run it from cron; `run_jobs` does the archiving.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.TOOPATH_ARCHIVE_AFTER_DAYS)
+
+    def handle(self, *args, **options):
+        count = 0
+        for tid in cold_tracks(options['days']).iterator():
+            enqueue('archive_track', tid=tid)
+            count += 1
+        self.stdout.write('Queued %d tracks.' % count)
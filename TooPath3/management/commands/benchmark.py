@@ -0,0 +1,90 @@
+import json
+import random
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.backends.base.creation import TEST_DATABASE_PREFIX
+from django.test import override_settings
+
+from TooPath3.benchmarks.fleet import Fleet
+from TooPath3.benchmarks.runner import HttpClient, InProcessClient, LiveServer, SCENARIOS, compare, environment, \
+    run
+
+
+class Command(BaseCommand):
+    help = ('Builds a synthetic fleet in a throwaway test database and benchmarks every endpoint in-process and '
+            'over HTTP, writing a JSON report that can be compared across commits.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=2)
+        parser.add_argument('--devices', type=int, default=10, help='Devices per user.')
+        parser.add_argument('--tracks', type=int, default=3, help='Tracks per device.')
+        parser.add_argument('--points', type=int, default=500, help='Points per track.')
+        parser.add_argument('--requests', type=int, default=200, help='Timed requests per scenario.')
+        parser.add_argument('--warmup', type=int, default=20, help='Untimed requests per scenario.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--mode', choices=('inprocess', 'http', 'both'), default='both')
+        parser.add_argument('--scenario', action='append', default=[],
+                            help='Only run the scenarios whose name contains this text (repeatable).')
+        parser.add_argument('--url', help='Benchmark a running server instead of a local one. The fleet is then '
+                                          'written to the configured database, which that server must share and '
+                                          'which must be a test database (its name starting with "test_"). The '
+                                          'fleet is deleted afterwards.')
+        parser.add_argument('--keepdb', action='store_true', help='Keep the test database between runs.')
+        parser.add_argument('--output', help='Where to write the JSON report.')
+        parser.add_argument('--compare', help='A previous JSON report to compare against.')
+
+    def handle(self, *args, **options):
+        scenarios = [scenario for scenario in SCENARIOS
+                     if not options['scenario'] or any(text in scenario.name for text in options['scenario'])]
+        old_name = connection.settings_dict['NAME']
+        if options['url'] and not old_name.startswith(TEST_DATABASE_PREFIX):
+            raise CommandError('--url writes the fleet to the configured database, %s, which is not a test '
+                               'database: point the server and this command at a "%s" database.' % (
+                                   old_name, TEST_DATABASE_PREFIX))
+        if not options['url']:
+            connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options['keepdb'])
+        # Driving a local fleet this hard, the location writes would mostly be answered with 429.
+        throttle = settings.TOOPATH_THROTTLE_ENABLED and bool(options['url'])
+        try:
+            with override_settings(TOOPATH_THROTTLE_ENABLED=throttle):
+                report = self.benchmark(scenarios, options)
+        finally:
+            if not options['url']:
+                connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+        else:
+            self.stdout.write(json.dumps(report, indent=2, sort_keys=True))
+        if options['compare']:
+            with open(options['compare']) as f:
+                for line in compare(report, json.load(f)):
+                    self.stdout.write(line)
+
+    def benchmark(self, scenarios, options):
+        fleet = Fleet(options['users'], options['devices'], options['tracks'], options['points'],
+                      seed=options['seed']).build()
+        try:
+            return self.run_scenarios(fleet, scenarios, options)
+        finally:
+            if options['url']:
+                fleet.destroy()
+
+    def run_scenarios(self, fleet, scenarios, options):
+        report = {'environment': environment(), 'fleet': fleet.size, 'results': {}}
+        if options['mode'] in ('inprocess', 'both'):
+            report['results']['inprocess'] = run(InProcessClient(), fleet, random.Random(options['seed']),
+                                                 options['requests'], options['warmup'], scenarios)
+        if options['mode'] in ('http', 'both'):
+            server = None if options['url'] else LiveServer().start()
+            try:
+                client = HttpClient(options['url'] or server.url)
+                report['results']['http'] = run(client, fleet, random.Random(options['seed']), options['requests'],
+                                                options['warmup'], scenarios)
+            finally:
+                if server is not None:
+                    server.stop()
+        return report
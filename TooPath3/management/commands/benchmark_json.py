@@ -0,0 +1,90 @@
+import io
+import json
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+from TooPath3.benchmarks.fleet import Fleet
+from TooPath3.devices.serializers import DeviceSerializer
+from TooPath3.devices.views import DEVICE_PREFETCH
+from TooPath3.models import Device, Track
+from TooPath3.renderers import FastJSONRenderer, FastJSONParser, orjson
+from TooPath3.tracks.serializers import TrackSerializer
+from TooPath3.users.serializers import CustomUserSerializer
+
+
+def timed(function, repeat, number):
+    """
+     Median seconds per call over `repeat` rounds of `number` calls.
+    """
+    rounds = []
+    for n in range(repeat):
+        start = time.perf_counter()
+        for i in range(number):
+            function()
+        rounds.append((time.perf_counter() - start) / number)
+    return statistics.median(rounds)
+
+
+class Command(BaseCommand):
+    help = ('Times the encoding and decoding of real API payloads, built from a synthetic fleet in a throwaway test '
+            'database, with DRF\'s JSON renderer and parser against TooPath3.renderers.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--devices', type=int, default=20, help='Devices of the user whose list is encoded.')
+        parser.add_argument('--tracks', type=int, default=3, help='Tracks per device.')
+        parser.add_argument('--points', type=int, default=2000, help='Points per track.')
+        parser.add_argument('--repeat', type=int, default=7)
+        parser.add_argument('--number', type=int, default=20, help='Calls per round.')
+        parser.add_argument('--keepdb', action='store_true', help='Keep the test database between runs.')
+        parser.add_argument('--output', help='Where to write the JSON report.')
+
+    def handle(self, *args, **options):
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options['keepdb'])
+        try:
+            payloads = self.payloads(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+
+        if orjson is None:
+            self.stderr.write('orjson is not installed: the fast renderer and parser fall back to DRF\'s.')
+        report = {name: self.measure(data, options['repeat'], options['number']) for name, data in payloads}
+        self.stdout.write('%-12s %10s %12s %12s %8s %12s %12s %8s' % (
+            'payload', 'bytes', 'encode ms', 'fast ms', 'x', 'decode ms', 'fast ms', 'x'))
+        for name, result in report.items():
+            self.stdout.write('%-12s %10d %12.3f %12.3f %8.1f %12.3f %12.3f %8.1f' % (
+                name, result['bytes'], result['encode_ms'], result['fast_encode_ms'],
+                result['encode_ms'] / result['fast_encode_ms'], result['decode_ms'], result['fast_decode_ms'],
+                result['decode_ms'] / result['fast_decode_ms']))
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+
+    def payloads(self, options):
+        fleet = Fleet(1, options['devices'], options['tracks'], options['points']).build()
+        user = fleet.users[0]
+        devices = Device.objects.filter(owner=user).select_related('owner').prefetch_related(*DEVICE_PREFETCH)
+        track = Track.objects.filter(device__owner=user).prefetch_related('locations').first()
+        return [
+            ('device-list', DeviceSerializer(devices, many=True).data),
+            ('track-detail', TrackSerializer(track).data),
+            ('user', CustomUserSerializer(user).data),
+        ]
+
+    def measure(self, data, repeat, number):
+        encoded = JSONRenderer().render(data)
+        fast_encoded = FastJSONRenderer().render(data)
+        if json.loads(encoded.decode('utf-8')) != json.loads(fast_encoded.decode('utf-8')):
+            self.stderr.write('The fast renderer disagrees with DRF\'s on a payload.')
+        return {
+            'bytes': len(encoded),
+            'encode_ms': timed(lambda: JSONRenderer().render(data), repeat, number) * 1000.0,
+            'fast_encode_ms': timed(lambda: FastJSONRenderer().render(data), repeat, number) * 1000.0,
+            'decode_ms': timed(lambda: JSONParser().parse(io.BytesIO(encoded)), repeat, number) * 1000.0,
+            'fast_decode_ms': timed(lambda: FastJSONParser().parse(io.BytesIO(encoded)), repeat, number) * 1000.0,
+        }
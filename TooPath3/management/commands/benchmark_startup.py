@@ -0,0 +1,53 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+MEASURES = ('boot_ms', 'first_request_ms', 'request_p50_us', 'request_p95_us', 'modules', 'max_rss_kb')
+
+
+class Command(BaseCommand):
+    help = ('Compares the boot time, the first request and the per-request overhead of the full `TooPath3.wsgi` '
+            'against the slim `TooPath3.wsgi_api`, each measured in fresh interpreters.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=5, help='Fresh interpreters per profile.')
+        parser.add_argument('--requests', type=int, default=2000, help='Timed requests per interpreter.')
+        parser.add_argument('--output', help='Where to write the JSON report.')
+
+    def handle(self, *args, **options):
+        full_settings = os.getenv('TOOPATH3_API_BASE_SETTINGS', settings.SETTINGS_MODULE)
+        if full_settings == 'TooPath3.settings.api':
+            raise CommandError('Run it with the deployment settings, not with TooPath3.settings.api.')
+        profiles = (
+            ('full', 'TooPath3.wsgi', {'DJANGO_SETTINGS_MODULE': full_settings}),
+            ('api', 'TooPath3.wsgi_api', {'DJANGO_SETTINGS_MODULE': 'TooPath3.settings.api',
+                                          'TOOPATH3_API_BASE_SETTINGS': full_settings}),
+        )
+        report = {name: self.profile(module, env, options['runs'], options['requests'])
+                  for name, module, env in profiles}
+
+        self.stdout.write('%-18s %12s %12s %8s' % ('', 'full', 'api', 'change'))
+        for measure in MEASURES:
+            full, api = report['full'][measure], report['api'][measure]
+            change = (api - full) / full * 100.0 if full else 0.0
+            self.stdout.write('%-18s %12.1f %12.1f %+7.1f%%' % (measure, full, api, change))
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+
+    def profile(self, module, env, runs, requests_count):
+        results = []
+        for n in range(runs):
+            output = subprocess.check_output(
+                [sys.executable, '-m', 'TooPath3.benchmarks.startup', module, str(requests_count)],
+                env=dict(os.environ, **env), cwd=os.path.dirname(settings.BASE_DIR))
+            results.append(json.loads(output.decode('utf-8').splitlines()[-1]))
+        statuses = {result['status'] for result in results}
+        if statuses != {401}:
+            raise CommandError('%s answered %s instead of 401' % (module, ', '.join(map(str, statuses))))
+        return {measure: statistics.median(result[measure] for result in results) for measure in MEASURES}
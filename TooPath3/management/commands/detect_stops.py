@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from TooPath3.models import Track
+from TooPath3.stops import queue_stop_detection, unchecked_tracks
+
+
+class Command(BaseCommand):
+    help = ('Queues stop detection for every track with points updated since its stops were last detected, or for '
+            'every track with --all. Run it from cron; `run_jobs --workers N` detects them in parallel.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Detect the stops of every track again from scratch.')
+
+    def handle(self, *args, **options):
+        if options['all']:
+            tids = Track.objects.filter(trash=False).values_list('tid', flat=True)
+        else:
+            tids = unchecked_tracks()
+        count = queue_stop_detection(tids.iterator(), rescan=options['all'])
+        self.stdout.write('Queued %d tracks.' % count)
@@ -0,0 +1,27 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from TooPath3.ingest import drain
+
+
+class Command(BaseCommand):
+    help = 'Replays the ingestion log of this host into the database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Exit once the log is replayed instead of polling.')
+        parser.add_argument('--poll', type=float, default=settings.TOOPATH_INGEST_DRAIN_POLL_SECONDS,
+                            help='Seconds to wait when there was nothing to replay.')
+
+    def handle(self, *args, **options):
+        while True:
+            count = drain()
+            if count is None:
+                self.stderr.write('Another drainer is running on %s.' % settings.TOOPATH_INGEST_LOG_DIR)
+                return
+            if options['once']:
+                self.stdout.write('Replayed %d records.' % count)
+                return
+            if not count:
+                time.sleep(options['poll'])
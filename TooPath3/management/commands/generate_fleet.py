@@ -0,0 +1,113 @@
+import datetime
+import io
+import multiprocessing
+import time
+
+import numpy as np
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import connection, connections, transaction
+from django.utils import timezone
+
+from TooPath3.benchmarks.synthetic import generate_points
+from TooPath3.models import CustomUser, Device
+
+COPY_DEVICES = ('COPY devices (did, name, created_at, updated_at, trash, device_privacy, device_type, owner_id) '
+                'FROM STDIN')
+COPY_TRACKS = ('COPY tracks (tid, name, device_id, updated_at, trash, archived_points, points, points_updated_at) '
+               'FROM STDIN')
+COPY_ACTUAL_LOCATIONS = 'COPY actual_locations (device_id, point, created_at, updated_at) FROM STDIN'
+
+
+def reserve_ids(cursor, table, column, count):
+    cursor.execute('SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)',
+                   [table, column, count])
+    return np.array([row[0] for row in cursor.fetchall()], dtype=np.int64)
+
+
+def copy_text(cursor, sql, rows):
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(str(value) for value in row))
+        buffer.write('\n')
+    buffer.seek(0)
+    cursor.copy_expert(sql, buffer)
+
+
+class Command(BaseCommand):
+    help = ('Synthesizes GPS traces with NumPy and streams them into devices, tracks, track_locations and '
+            'actual_locations with PostgreSQL COPY from several worker processes.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10)
+        parser.add_argument('--devices', type=int, default=10, help='Devices per user.')
+        parser.add_argument('--tracks', type=int, default=10, help='Tracks per device.')
+        parser.add_argument('--points', type=int, default=10000, help='Points per track.')
+        parser.add_argument('--days', type=int, default=30, help='Spread the tracks over the last N days.')
+        parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+        parser.add_argument('--prefix', default='fleet', help='Prefix of the generated usernames.')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        device_types = [choice for choice, _ in Device.TYPE_CHOICES]
+        now = timezone.now().isoformat()
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            prefix = options['prefix']
+            password = make_password(prefix)
+            users = CustomUser.objects.bulk_create(
+                CustomUser(username='%s%d' % (prefix, n), email='%s%d@toopath.test' % (prefix, n), password=password)
+                for n in range(options['users']))
+            owner_ids = np.repeat([user.pk for user in users], options['devices'])
+            device_ids = reserve_ids(cursor, 'devices', 'did', len(owner_ids))
+            copy_text(cursor, COPY_DEVICES, (
+                (did, 'device %d' % did, now, now, 'f', Device.PRIVATE, device_types[did % len(device_types)], owner)
+                for did, owner in zip(device_ids, owner_ids)))
+            track_devices = np.repeat(device_ids, options['tracks'])
+            track_ids = reserve_ids(cursor, 'tracks', 'tid', len(track_devices))
+            copy_text(cursor, COPY_TRACKS, (
+                (tid, 'track %d' % tid, did, now, 'f', 0, options['points'], now)
+                for tid, did in zip(track_ids, track_devices)))
+        self.stdout.write('Created %d users, %d devices and %d tracks' % (len(users), len(device_ids),
+                                                                           len(track_ids)))
+
+        # Forked workers must not share the parent's connection.
+        connections.close_all()
+        params = connection.get_connection_params()
+        shares = np.array_split(track_ids, max(1, options['workers'] * 4))
+        tasks = [(params, share, options['points'], options['days'], options['seed'] + 1 + n)
+                 for n, share in enumerate(shares) if len(share)]
+
+        start = time.perf_counter()
+        last_by_track = {}
+        points = 0
+        with multiprocessing.Pool(options['workers']) as pool:
+            for share, last, count, elapsed in pool.imap_unordered(generate_points, tasks):
+                points += count
+                for tid, lon, lat, time_us in zip(share, *last):
+                    last_by_track[tid] = (lon, lat, time_us)
+                self.stdout.write('%d points, %.0f points/s' % (points, points / (time.perf_counter() - start)))
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            copy_text(cursor, COPY_ACTUAL_LOCATIONS,
+                      self.actual_locations(device_ids, track_ids, track_devices, last_by_track))
+        elapsed = time.perf_counter() - start
+        self.stdout.write('Generated %d points in %.1fs (%.0f points/s)' % (points, elapsed, points / elapsed))
+
+    def actual_locations(self, device_ids, track_ids, track_devices, last_by_track):
+        # The position of a device is the last fix of its most recent track.
+        latest = dict.fromkeys(device_ids)
+        for tid, did in zip(track_ids, track_devices):
+            position = last_by_track.get(tid)
+            if position is None or np.isnan(position[0]):
+                continue
+            if latest[did] is None or position[2] > latest[did][2]:
+                latest[did] = position
+        now = timezone.now().isoformat()
+        for did, position in latest.items():
+            if position is None:
+                yield did, 'SRID=4326;POINT EMPTY', now, now
+                continue
+            lon, lat, time_us = position
+            updated_at = datetime.datetime.fromtimestamp(time_us / 10 ** 6, timezone.utc).isoformat()
+            yield did, 'SRID=4326;POINT(%r %r)' % (float(lon), float(lat)), updated_at, updated_at
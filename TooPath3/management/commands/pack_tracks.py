@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from TooPath3.archive import cold_tracks, pack_track
+
+
+class Command(BaseCommand):
+    help = ('Packs the points of every track whose points in the table were all last updated more than --days ago '
+            'into a blob in the track\'s row, a transaction per track.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.TOOPATH_PACK_AFTER_DAYS)
+
+    def handle(self, *args, **options):
+        count = 0
+        for tid in list(cold_tracks(options['days'])):
+            pack_track(tid)
+            count += 1
+        self.stdout.write('Packed %d tracks.' % count)
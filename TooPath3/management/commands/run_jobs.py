@@ -0,0 +1,39 @@
+import multiprocessing
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from TooPath3.jobs import run_pending
+
+
+def work(once, poll_seconds):
+    while True:
+        if not run_pending():
+            if once:
+                return
+            time.sleep(poll_seconds)
+
+
+class Command(BaseCommand):
+    help = 'Runs the queued background jobs, like purging what users deleted.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1, help='Worker processes.')
+        parser.add_argument('--once', action='store_true', help='Exit when no job is due instead of polling.')
+        parser.add_argument('--poll', type=float, default=settings.TOOPATH_JOBS_POLL_SECONDS,
+                            help='Seconds to wait for new jobs when none is due.')
+
+    def handle(self, *args, **options):
+        if options['workers'] <= 1:
+            work(options['once'], options['poll'])
+            return
+        # Forked workers must not share the parent's database connection.
+        connections.close_all()
+        workers = [multiprocessing.Process(target=work, args=(options['once'], options['poll']))
+                   for n in range(options['workers'])]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
@@ -0,0 +1,16 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from TooPath3.stream.server import StreamServer
+
+
+class Command(BaseCommand):
+    help = 'Serves the live device positions as Server-Sent Events.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default=settings.TOOPATH_STREAM_HOST)
+        parser.add_argument('--port', type=int, default=settings.TOOPATH_STREAM_PORT)
+
+    def handle(self, *args, **options):
+        self.stdout.write('Streaming live locations on %s:%s' % (options['host'], options['port']))
+        StreamServer().serve_forever(options['host'], options['port'])
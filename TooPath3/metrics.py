@@ -0,0 +1,302 @@
+import atexit
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.signals import request_started
+from django.db import connections, reset_queries
+from django.http import HttpResponse, HttpResponseForbidden
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+class Registry(object):
+    """
+     Metrics of this process. Every worker dumps its own snapshot so `/metrics/` can add them all up.
+    """
+
+    def __init__(self):
+        self.types = {}
+        self.values = {}
+        self._lock = threading.Lock()
+        self._flushed_at = 0
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self._lock:
+            self.types[name] = 'counter'
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, labels=(), value=0):
+        with self._lock:
+            self.types[name] = 'gauge'
+            self.values[(name, labels)] = [value, time.time()]
+
+    def observe(self, name, labels=(), value=0, buckets=LATENCY_BUCKETS):
+        key = (name, labels)
+        with self._lock:
+            self.types[name] = 'histogram'
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = {'buckets': buckets, 'counts': [0] * len(buckets), 'sum': 0,
+                                                'count': 0}
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram['counts'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'types': dict(self.types),
+                'values': [[name, list(labels), json.loads(json.dumps(value))]
+                           for (name, labels), value in self.values.items()],
+            }
+
+    def flush(self, force=False):
+        now = time.time()
+        if not force and now - self._flushed_at < settings.TOOPATH_METRICS_FLUSH_SECONDS:
+            return
+        self._flushed_at = now
+        directory = settings.TOOPATH_METRICS_DIR
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, '%d.json' % os.getpid())
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(path + '.tmp', path)
+
+    def clear(self):
+        with self._lock:
+            self.types.clear()
+            self.values.clear()
+
+
+registry = Registry()
+
+
+@atexit.register
+def _flush_on_exit():
+    if registry.values:
+        registry.flush(force=True)
+
+
+def merge(snapshots):
+    types = {}
+    values = {}
+    for snapshot in snapshots:
+        types.update(snapshot['types'])
+        for name, labels, value in snapshot['values']:
+            key = (name, tuple(tuple(label) for label in labels))
+            kind = types.get(name)
+            if key not in values:
+                values[key] = value
+            elif kind == 'counter':
+                values[key] += value
+            elif kind == 'gauge':
+                # The most recently set value wins.
+                values[key] = max(values[key], value, key=lambda gauge: gauge[1])
+            else:
+                merged = values[key]
+                merged['counts'] = [a + b for a, b in zip(merged['counts'], value['counts'])]
+                merged['sum'] += value['sum']
+                merged['count'] += value['count']
+    return types, values
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join('%s="%s"' % (name, value) for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def render(types, values):
+    lines = []
+    for name in sorted(types):
+        kind = types[name]
+        lines.append('# TYPE %s %s' % (name, kind))
+        for (key_name, labels), value in sorted(values.items()):
+            if key_name != name:
+                continue
+            if kind == 'counter':
+                lines.append('%s%s %r' % (name, _labels(labels), float(value)))
+            elif kind == 'gauge':
+                lines.append('%s%s %r' % (name, _labels(labels), float(value[0])))
+            else:
+                for bound, count in zip(value['buckets'], value['counts']):
+                    lines.append('%s_bucket%s %d' % (name, _labels(labels, (('le', repr(float(bound))),)), count))
+                lines.append('%s_bucket%s %d' % (name, _labels(labels, (('le', '+Inf'),)), value['count']))
+                lines.append('%s_sum%s %r' % (name, _labels(labels), float(value['sum'])))
+                lines.append('%s_count%s %d' % (name, _labels(labels), value['count']))
+    return '\n'.join(lines) + '\n'
+
+
+def collect():
+    registry.flush(force=True)
+    snapshots = []
+    for path in glob.glob(os.path.join(settings.TOOPATH_METRICS_DIR, '*.json')):
+        try:
+            with open(path) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return merge(snapshots)
+
+
+def metrics_view(request):
+    if request.META.get('REMOTE_ADDR') not in settings.TOOPATH_METRICS_ALLOWED_IPS:
+        return HttpResponseForbidden()
+    return HttpResponse(render(*collect()), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class QueryStats(object):
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.add(sql, time.perf_counter() - start)
+
+    def add(self, sql, duration):
+        self.count += 1
+        self.time += duration
+        self.queries.append(sql)
+
+
+_logging_lock = threading.Lock()
+_logging_blocks = [0, False]
+_END = object()
+
+
+def _start_logging():
+    # As in CaptureQueriesContext, a request starting inside the block mustn't empty the log it is counted from.
+    with _logging_lock:
+        if not _logging_blocks[0]:
+            _logging_blocks[1] = request_started.disconnect(reset_queries)
+        _logging_blocks[0] += 1
+
+
+def _stop_logging():
+    with _logging_lock:
+        _logging_blocks[0] -= 1
+        if not _logging_blocks[0] and _logging_blocks[1]:
+            request_started.connect(reset_queries)
+
+
+def _logged_after(log, last):
+    """
+     The entries of a queries log after `last`, or all of them once `last` fell off it.
+    """
+    queries = list(log)
+    for index in range(len(queries) - 1, -1, -1):
+        if queries[index] is last:
+            return queries[index + 1:]
+    return queries
+
+
+@contextmanager
+def query_stats(stats=None):
+    """
+     Counts and times the SQL run inside the block on every database connection, adding it up in `stats` when
+     given.
+    """
+    stats = QueryStats() if stats is None else stats
+    wrapped = []
+    logging = not all(hasattr(connection, 'execute_wrapper') for connection in connections.all())
+    if logging:
+        _start_logging()
+    for connection in connections.all():
+        if hasattr(connection, 'execute_wrapper'):
+            manager = connection.execute_wrapper(stats)
+            manager.__enter__()
+            wrapped.append((connection, manager))
+        else:
+            # Django < 2.0 has no execute_wrapper: the debug cursor logs the queries, counted from the last entry
+            # the log holds now rather than from an index, which the log's maxlen shifts once it is full.
+            log = connection.queries_log
+            wrapped.append((connection, (connection.force_debug_cursor, log[-1] if log else None)))
+            connection.force_debug_cursor = True
+    try:
+        yield stats
+    finally:
+        for connection, state in wrapped:
+            if hasattr(connection, 'execute_wrapper'):
+                state.__exit__(None, None, None)
+                continue
+            force_debug_cursor, last = state
+            connection.force_debug_cursor = force_debug_cursor
+            for query in _logged_after(connection.queries_log, last):
+                stats.add(query['sql'], float(query['time']))
+        if logging:
+            _stop_logging()
+
+
+def serialized_objects(response):
+    data = getattr(response, 'data', None)
+    if isinstance(data, list):
+        return len(data)
+    if isinstance(data, dict):
+        features = data.get('features')
+        return len(features) if isinstance(features, list) else 1
+    return 0
+
+
+class MetricsMiddleware(object):
+    """
+     Records latency, SQL, response size and serialized objects per URL pattern name and method.
+    """
+
+    def __init__(self, get_response):
+        if not settings.TOOPATH_METRICS_ENABLED:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        with query_stats() as stats:
+            response = self.get_response(request)
+        if response.streaming:
+            # Its body, and the queries behind it, come after the view returned: recorded once it is sent.
+            response.streaming_content = self.metered_chunks(request, response, start, stats)
+        else:
+            self.record(request, response, time.perf_counter() - start, stats)
+        return response
+
+    def metered_chunks(self, request, response, start, stats):
+        chunks = iter(response.streaming_content)
+        try:
+            while True:
+                with query_stats(stats):
+                    chunk = next(chunks, _END)
+                if chunk is _END:
+                    return
+                yield chunk
+        finally:
+            self.record(request, response, time.perf_counter() - start, stats)
+
+    def record(self, request, response, duration, stats):
+        match = getattr(request, 'resolver_match', None)
+        labels = (('endpoint', match.url_name if match and match.url_name else 'unmatched'),
+                  ('method', request.method))
+        registry.observe('toopath_request_duration_seconds', labels, duration, LATENCY_BUCKETS)
+        registry.inc('toopath_requests_total', labels + (('status', str(response.status_code)),))
+        registry.observe('toopath_request_queries', labels, stats.count, QUERY_BUCKETS)
+        registry.inc('toopath_request_query_seconds_total', labels, stats.time)
+        if not response.streaming:
+            registry.observe('toopath_response_bytes', labels, len(response.content), BYTES_BUCKETS)
+        registry.inc('toopath_serialized_objects_total', labels, serialized_objects(response))
+        registry.flush()
@@ -0,0 +1,60 @@
+import jwt
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework_jwt.settings import api_settings
+
+from TooPath3.routers import choose_replica, reading_from, reading_chunks_from, replica_aliases
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+def jwt_user_id(request):
+    # Only used to pick a database, the view still authenticates the token.
+    prefix = api_settings.JWT_AUTH_HEADER_PREFIX + ' '
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    if not authorization.startswith(prefix):
+        return None
+    try:
+        payload = jwt.decode(authorization[len(prefix):], verify=False)
+    except jwt.InvalidTokenError:
+        return None
+    return api_settings.JWT_PAYLOAD_GET_USER_ID_HANDLER(payload)
+
+
+class ReplicaRoutingMiddleware(object):
+    """
+     Serves safe requests from a read replica, unless the user wrote something in the last few seconds.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not replica_aliases():
+            return self.get_response(request)
+        alias = None
+        if request.method in SAFE_METHODS and not self.recently_wrote(request):
+            alias = choose_replica()
+        with reading_from(alias):
+            response = self.get_response(request)
+        if response.streaming:
+            response.streaming_content = reading_chunks_from(alias, response.streaming_content)
+        if request.method not in SAFE_METHODS and response.status_code < 400:
+            self.pin_to_primary(request, response)
+        return response
+
+    def recently_wrote(self, request):
+        if settings.TOOPATH_REPLICA_PIN_COOKIE in request.COOKIES:
+            return True
+        user_id = jwt_user_id(request)
+        return user_id is not None and caches[settings.TOOPATH_REPLICA_PIN_CACHE].get(self.pin_key(user_id), False)
+
+    def pin_to_primary(self, request, response):
+        sticky_seconds = settings.TOOPATH_REPLICA_STICKY_SECONDS
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            caches[settings.TOOPATH_REPLICA_PIN_CACHE].set(self.pin_key(user.pk), True, sticky_seconds)
+        response.set_cookie(settings.TOOPATH_REPLICA_PIN_COOKIE, '1', max_age=sticky_seconds, httponly=True)
+
+    def pin_key(self, user_id):
+        return 'replica-pin:%s' % user_id
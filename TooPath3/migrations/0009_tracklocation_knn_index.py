@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('TooPath3', '0008_auto_20171124_1208'),
+    ]
+
+    operations = [
+        # Lets `WHERE track_id = ... ORDER BY point <-> ...` walk a single track's points in distance order.
+        migrations.RunSQL(
+            sql='CREATE EXTENSION IF NOT EXISTS btree_gist',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.RunSQL(
+            sql='CREATE INDEX track_locations_track_point_knn ON track_locations USING gist (track_id, point)',
+            reverse_sql='DROP INDEX IF EXISTS track_locations_track_point_knn',
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('TooPath3', '0011_job_track_trash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tracklocation',
+            name='device',
+            field=models.ForeignKey(default=None, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='TooPath3.Device'),
+        ),
+        migrations.AddField(
+            model_name='tracklocation',
+            name='seq',
+            field=models.BigIntegerField(default=None, null=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='tracklocation',
+            unique_together=set([('device', 'seq')]),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('TooPath3', '0012_tracklocation_sync'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestCheckpoint',
+            fields=[
+                ('segment', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('offset', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'ingest_checkpoints',
+            },
+        ),
+    ]
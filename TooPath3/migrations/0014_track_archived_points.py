@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('TooPath3', '0013_ingestcheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='track',
+            name='archived_points',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('TooPath3', '0014_track_archived_points'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='track',
+            name='packed',
+            field=models.BinaryField(default=None, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('TooPath3', '0015_track_packed'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='device',
+            index=models.Index(fields=['updated_at'], name='devices_updated_at_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='actuallocation',
+            index=models.Index(fields=['updated_at'], name='actual_locations_updated_idx'),
+        ),
+    ]
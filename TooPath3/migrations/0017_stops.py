@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.gis.db.models.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('TooPath3', '0016_updated_at_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='track',
+            name='stops_checked_at',
+            field=models.DateTimeField(default=None, editable=False, null=True),
+        ),
+        migrations.CreateModel(
+            name='Stop',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('point', django.contrib.gis.db.models.fields.PointField(srid=4326)),
+                ('arrived_at', models.DateTimeField()),
+                ('departed_at', models.DateTimeField()),
+                ('duration', models.FloatField()),
+                ('points', models.IntegerField()),
+                ('track', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stops',
+                                            to='TooPath3.Track')),
+            ],
+            options={
+                'db_table': 'stops',
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='stop',
+            index_together=set([('track', 'arrived_at')]),
+        ),
+    ]
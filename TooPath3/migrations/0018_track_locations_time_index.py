@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('TooPath3', '0017_stops'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='tracklocation',
+            index=models.Index(fields=['track', 'created_at'], name='track_locations_track_time_idx'),
+        ),
+    ]
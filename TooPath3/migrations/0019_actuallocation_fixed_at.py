@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('TooPath3', '0018_track_locations_time_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='actuallocation',
+            name='fixed_at',
+            field=models.DateTimeField(auto_now=True, null=True),
+        ),
+    ]
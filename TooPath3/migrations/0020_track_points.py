@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('TooPath3', '0019_actuallocation_fixed_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='track',
+            name='points',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='track',
+            name='points_updated_at',
+            field=models.DateTimeField(default=None, editable=False, null=True),
+        ),
+        # Counts the points already stored, which later writes keep up to date.
+        migrations.RunSQL(
+            sql='''
+                UPDATE tracks
+                SET points = archived_points + (SELECT count(*) FROM track_locations WHERE track_id = tid),
+                    points_updated_at = (SELECT max(updated_at) FROM track_locations WHERE track_id = tid)
+            ''',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
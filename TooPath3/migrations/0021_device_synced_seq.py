@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('TooPath3', '0020_track_points'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='synced_seq',
+            field=models.BigIntegerField(default=None, editable=False, null=True),
+        ),
+        # The end of the first run of consecutive numbers of every device, so that no device walks them all at once.
+        migrations.RunSQL(
+            sql='''
+                UPDATE devices SET synced_seq = runs.seq
+                FROM (
+                    SELECT DISTINCT ON (device_id) device_id, seq FROM (
+                        SELECT device_id, seq, lead(seq) OVER (PARTITION BY device_id ORDER BY seq) AS next
+                        FROM track_locations WHERE seq IS NOT NULL
+                    ) AS numbered
+                    WHERE next IS NULL OR next > seq + 1
+                    ORDER BY device_id, seq
+                ) AS runs
+                WHERE devices.did = runs.device_id
+            ''',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
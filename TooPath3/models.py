@@ -1,8 +1,10 @@
 import uuid
 
+from django.contrib.postgres.fields import JSONField
 from django.db import models
 from django.contrib.gis.db import models as gismodels
 from django.contrib.auth.models import AbstractUser
+from django.utils import timezone
 
 
 class CustomUser(AbstractUser):
@@ -50,9 +52,12 @@ class Device(models.Model):
     device_type = models.CharField(max_length=2, null=False, choices=TYPE_CHOICES, default=ANDROID)
     device_imei = models.CharField(max_length=40, null=True)
     owner = models.ForeignKey(CustomUser, related_name='devices', on_delete=models.CASCADE)
+    # Every point it numbered up to this one is stored (see TooPath3/locations/queries.py).
+    synced_seq = models.BigIntegerField(null=True, default=None, editable=False)
 
     class Meta:
         db_table = 'devices'
+        indexes = [models.Index(fields=['updated_at'], name='devices_updated_at_idx')]
 
 
 class Track(models.Model):
@@ -60,6 +65,18 @@ class Track(models.Model):
     name = models.CharField(max_length=100, null=False)
     description = models.CharField(max_length=200, null=True)
     device = models.ForeignKey(Device, related_name='tracks', null=False)
+    updated_at = models.DateTimeField(auto_now=True, null=False)
+    trash = models.BooleanField(null=False, default=False)
+    # Points moved out of the table into the track's archive file (see TooPath3/archive.py).
+    archived_points = models.IntegerField(null=False, default=0)
+    # When set, those points are packed here instead of in the file (see TooPath3/packing.py).
+    packed = models.BinaryField(null=True, default=None, editable=False)
+    # When its stops were last detected (see TooPath3/stops.py).
+    stops_checked_at = models.DateTimeField(null=True, default=None, editable=False)
+    # How many points it has, archived ones included, and when they last changed: kept by every write of its points so
+    # that validators don't have to read them (see TooPath3/conditional.py).
+    points = models.IntegerField(null=False, default=0, editable=False)
+    points_updated_at = models.DateTimeField(null=True, default=None, editable=False)
 
     class Meta:
         db_table = 'tracks'
@@ -76,13 +93,80 @@ class Location(models.Model):
 
 class ActualLocation(Location):
     device = models.OneToOneField(Device, on_delete=models.CASCADE, primary_key=True)
+    # When the device reported the position. The ingestion log's drainer writes it a while after, and stamps that
+    # in `updated_at` (see TooPath3/ingest.py).
+    fixed_at = models.DateTimeField(auto_now=True, null=True)
 
     class Meta(Location.Meta):
         db_table = 'actual_locations'
+        # Polled for the devices that moved (see TooPath3/proximity.py).
+        indexes = [models.Index(fields=['updated_at'], name='actual_locations_updated_idx')]
 
 
 class TrackLocation(Location):
     track = models.ForeignKey(Track, related_name='locations', null=False)
+    # Set by the sync endpoint: the device numbers its points, so an upload retried over a flaky link is a no-op.
+    device = models.ForeignKey(Device, related_name='+', null=True, default=None, on_delete=models.CASCADE)
+    seq = models.BigIntegerField(null=True, default=None)
 
     class Meta(Location.Meta):
         db_table = 'track_locations'
+        unique_together = (('device', 'seq'),)
+        # Read in time order per track, and in time buckets (see TooPath3/locations/queries.py).
+        indexes = [models.Index(fields=['track', 'created_at'], name='track_locations_track_time_idx')]
+
+
+class Stop(models.Model):
+    """
+     Where the device of a track stayed, detected from its points by TooPath3/stops.py.
+    """
+    track = models.ForeignKey(Track, related_name='stops', null=False, on_delete=models.CASCADE)
+    point = gismodels.PointField(null=False)
+    arrived_at = models.DateTimeField(null=False)
+    departed_at = models.DateTimeField(null=False)
+    duration = models.FloatField(null=False)
+    points = models.IntegerField(null=False)
+
+    class Meta:
+        db_table = 'stops'
+        index_together = (('track', 'arrived_at'),)
+
+
+class Job(models.Model):
+    """
+     A unit of background work, run by `manage.py run_jobs` (see TooPath3/jobs.py).
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+    kind = models.CharField(max_length=50, null=False)
+    payload = JSONField(null=False, default=dict)
+    status = models.CharField(max_length=7, null=False, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.IntegerField(null=False, default=0)
+    run_after = models.DateTimeField(null=False, default=timezone.now)
+    locked_at = models.DateTimeField(null=True, default=None)
+    error = models.TextField(null=True, default=None)
+    created_at = models.DateTimeField(auto_now_add=True, null=False)
+    updated_at = models.DateTimeField(auto_now=True, null=False)
+
+    class Meta:
+        db_table = 'jobs'
+        index_together = (('status', 'run_after'),)
+
+
+class IngestCheckpoint(models.Model):
+    """
+     How far the drainer replayed a segment of the ingestion log (see TooPath3/ingest.py).
+    """
+    segment = models.CharField(max_length=100, primary_key=True)
+    offset = models.BigIntegerField(null=False, default=0)
+
+    class Meta:
+        db_table = 'ingest_checkpoints'
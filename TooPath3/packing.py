@@ -0,0 +1,117 @@
+import struct
+
+import numpy as np
+
+# A packed track is VERSION, the number of points and then every column of COLUMNS: its encoding, its length in
+# bytes and the zigzag varints of the differences between its consecutive values.
+VERSION = 1
+HEADER = struct.Struct('<BI')
+COLUMN = struct.Struct('<BI')
+COLUMNS = ('id', 'created_at', 'updated_at', 'device', 'seq', 'x', 'y')
+FLOAT_COLUMNS = ('x', 'y')
+# Encodings of a column. Coordinates are scaled to integers when that gives back every one of them exactly, which
+# is the case for the usual 7 decimals of a GPS fix; otherwise the bits of their doubles are differenced.
+INTEGERS = 0
+SCALED = 1
+BITS = 2
+SCALE = 10 ** 7
+MAX_VARINT_BYTES = 10
+
+
+def zigzag(values):
+    values = values.astype(np.int64)
+    return (values << np.int64(1)).view(np.uint64) ^ (values >> np.int64(63)).view(np.uint64)
+
+
+def unzigzag(values):
+    return ((values >> np.uint64(1)) ^ (np.uint64(0) - (values & np.uint64(1)))).view(np.int64)
+
+
+def encode_varints(values):
+    """
+     LEB128 bytes of unsigned 64-bit `values`, built a 7-bit group at a time for all of them at once.
+    """
+    lengths = np.ones(len(values), dtype=np.int64)
+    for group in range(1, MAX_VARINT_BYTES):
+        lengths += values >= np.uint64(1 << (7 * group))
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    out = np.zeros(int(ends[-1]) if len(values) else 0, dtype=np.uint8)
+    for group in range(MAX_VARINT_BYTES):
+        selected = lengths > group
+        if not selected.any():
+            break
+        bits = (values[selected] >> np.uint64(7 * group)) & np.uint64(0x7f)
+        more = np.where(lengths[selected] > group + 1, np.uint64(0x80), np.uint64(0))
+        out[starts[selected] + group] = (bits | more).astype(np.uint8)
+    return out.tobytes()
+
+
+def decode_varints(data, count):
+    raw = np.frombuffer(data, dtype=np.uint8)
+    last = (raw & 0x80) == 0
+    if int(last.sum()) != count:
+        raise ValueError('Expected %d varints, found %d.' % (count, int(last.sum())))
+    # Each byte's value, and its group within the value.
+    index = np.cumsum(last) - last
+    starts = np.flatnonzero(np.concatenate(([True], last[:-1])))
+    group = np.arange(len(raw)) - starts[index]
+    values = np.zeros(count, dtype=np.uint64)
+    for g in range(MAX_VARINT_BYTES):
+        selected = group == g
+        if not selected.any():
+            break
+        values[index[selected]] |= (raw[selected] & 0x7f).astype(np.uint64) << np.uint64(7 * g)
+    return values
+
+
+def _deltas(values):
+    return np.diff(values, prepend=values.dtype.type(0))
+
+
+def _encode_column(name, values):
+    if name not in FLOAT_COLUMNS:
+        return INTEGERS, zigzag(_deltas(values.astype(np.int64)))
+    scaled = np.round(values * SCALE)
+    if np.all(np.abs(scaled) < 2 ** 62) and np.array_equal(scaled / SCALE, values):
+        return SCALED, zigzag(_deltas(scaled.astype(np.int64)))
+    # Unsigned differences wrap around, and the cumulative sum undoes them exactly.
+    return BITS, _deltas(values.astype(np.float64).view(np.uint64))
+
+
+def pack(columns):
+    """
+     Packs the columns of a track's points, as `TooPath3.archive.columns_of` returns them, into bytes.
+    """
+    count = len(columns['id'])
+    parts = [HEADER.pack(VERSION, count)]
+    for name in COLUMNS:
+        encoding, values = _encode_column(name, columns[name])
+        data = encode_varints(values)
+        parts.append(COLUMN.pack(encoding, len(data)))
+        parts.append(data)
+    return b''.join(parts)
+
+
+def unpack(blob):
+    """
+     The columns packed in `blob`.
+    """
+    view = memoryview(blob)
+    version, count = HEADER.unpack_from(view, 0)
+    if version != VERSION:
+        raise ValueError('Unknown packed track version %d.' % version)
+    offset = HEADER.size
+    columns = {}
+    for name in COLUMNS:
+        encoding, length = COLUMN.unpack_from(view, offset)
+        offset += COLUMN.size
+        values = decode_varints(view[offset:offset + length], count)
+        offset += length
+        if encoding == BITS:
+            columns[name] = np.cumsum(values, dtype=np.uint64).view(np.float64)
+        elif encoding == SCALED:
+            columns[name] = np.cumsum(unzigzag(values), dtype=np.int64) / SCALE
+        else:
+            columns[name] = np.cumsum(unzigzag(values), dtype=np.int64)
+    return columns
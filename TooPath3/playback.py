@@ -0,0 +1,123 @@
+import collections
+import threading
+
+import numpy as np
+from django.conf import settings
+from django.db import connection
+from django.db.models import Count, Max
+
+from TooPath3.archive import EPOCH, MICROSECOND, archived_columns
+from TooPath3.caching import get_versions, version_key
+from TooPath3.models import TrackLocation
+
+TRACK_TIMELINE = '''
+    SELECT id, (extract(epoch FROM created_at) * 1000000)::bigint, ST_X(point), ST_Y(point)
+    FROM track_locations
+    WHERE track_id = %s
+'''
+
+Timeline = collections.namedtuple('Timeline', ('times', 'xs', 'ys'))
+
+
+def microseconds(dates):
+    return np.array([(date - EPOCH) // MICROSECOND for date in dates], dtype=np.int64)
+
+
+def load_timeline(track):
+    """
+     The times, in microseconds, and coordinates of the points of the track in time order, archived ones included.
+     Points are timed by their `created_at`.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(TRACK_TIMELINE, [track.tid])
+        rows = cursor.fetchall()
+    ids = np.array([row[0] for row in rows], dtype=np.int64)
+    times = np.array([row[1] for row in rows], dtype=np.int64)
+    xs = np.array([row[2] for row in rows], dtype=np.float64)
+    ys = np.array([row[3] for row in rows], dtype=np.float64)
+    columns = archived_columns(track) if track.archived_points else None
+    if columns is not None:
+        # A point both archived and still in the table is only counted once, from the table.
+        archived = ~np.isin(columns['id'], ids)
+        ids = np.concatenate((ids, columns['id'][archived]))
+        times = np.concatenate((times, columns['created_at'][archived]))
+        xs = np.concatenate((xs, columns['x'][archived]))
+        ys = np.concatenate((ys, columns['y'][archived]))
+    order = np.lexsort((ids, times))
+    return Timeline(times[order], xs[order], ys[order])
+
+
+def interpolate(timeline, times):
+    """
+     Coordinates of the track at each of `times`, interpolated linearly between the points around it, with NaN
+     outside the track. Longitudes are interpolated the short way round, across the antimeridian if need be.
+    """
+    count = len(timeline.times)
+    xs = np.full(len(times), np.nan)
+    ys = np.full(len(times), np.nan)
+    if not count:
+        return xs, ys
+    inside = (times >= timeline.times[0]) & (times <= timeline.times[-1])
+    if count == 1:
+        xs[inside], ys[inside] = timeline.xs[0], timeline.ys[0]
+        return xs, ys
+    after = np.clip(np.searchsorted(timeline.times, times[inside], side='right'), 1, count - 1)
+    before = after - 1
+    span = timeline.times[after] - timeline.times[before]
+    fraction = np.where(span > 0, (times[inside] - timeline.times[before]) / np.maximum(span, 1), 0.0)
+    fraction = np.clip(fraction, 0.0, 1.0)
+    dx = (timeline.xs[after] - timeline.xs[before] + 180.0) % 360.0 - 180.0
+    xs[inside] = (timeline.xs[before] + fraction * dx + 180.0) % 360.0 - 180.0
+    ys[inside] = timeline.ys[before] + fraction * (timeline.ys[after] - timeline.ys[before])
+    return xs, ys
+
+
+class TimelineCache(object):
+    """
+     The timelines of the tracks played back lately, least recently used first, holding up to `max_points` points
+     in total. A timeline is loaded again once its track's version changes.
+    """
+
+    def __init__(self, max_points):
+        self.max_points = max_points
+        self.points = 0
+        self.timelines = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, track, version):
+        with self.lock:
+            cached = self.timelines.get(track.tid)
+            if cached is not None and cached[0] == version:
+                self.timelines.move_to_end(track.tid)
+                return cached[1]
+        timeline = load_timeline(track)
+        with self.lock:
+            previous = self.timelines.pop(track.tid, None)
+            if previous is not None:
+                self.points -= len(previous[1].times)
+            self.timelines[track.tid] = (version, timeline)
+            self.points += len(timeline.times)
+            while self.points > self.max_points and len(self.timelines) > 1:
+                self.points -= len(self.timelines.popitem(last=False)[1][1].times)
+        return timeline
+
+
+_cache = None
+
+
+def track_version(track):
+    """
+     What changes whenever the points of the track do: their response cache version when that cache is on, or else
+     their count and latest update, with the track's own, which archiving updates.
+    """
+    if settings.TOOPATH_RESPONSE_CACHE_ENABLED:
+        return get_versions([version_key('track', track.tid)])[0]
+    aggregates = TrackLocation.objects.filter(track=track).aggregate(count=Count('id'), updated=Max('updated_at'))
+    return aggregates['count'], aggregates['updated'], track.updated_at
+
+
+def track_positions(track, dates):
+    global _cache
+    if _cache is None or _cache.max_points != settings.TOOPATH_PLAYBACK_CACHE_POINTS:
+        _cache = TimelineCache(settings.TOOPATH_PLAYBACK_CACHE_POINTS)
+    return interpolate(_cache.get(track, track_version(track)), microseconds(dates))
@@ -0,0 +1,251 @@
+import datetime
+import heapq
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from TooPath3.clustering import ClusterPyramid
+from TooPath3.metrics import registry
+from TooPath3.models import Device, ActualLocation
+
+EARTH_RADIUS = 6371008.8
+# Rows are committed a little after their `updated_at` is stamped: polls look back this far, which is harmless
+# since applying a position twice changes nothing.
+POLL_OVERLAP = datetime.timedelta(seconds=5)
+
+
+def haversine(x1, y1, x2, y2):
+    """
+     Great-circle distance in meters between two lon/lat points, within 0.5% of PostGIS' spheroidal one.
+    """
+    lon1, lat1, lon2, lat2 = (math.radians(value) for value in (x1, y1, x2, y2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+class GridIndex(object):
+    """
+     Positions of devices bucketed in a uniform lon/lat grid of `cell` degrees. A lookup only visits the cells a
+     circle overlaps, wrapping around the antimeridian, so its cost depends on the radius and not on the fleet.
+    """
+
+    def __init__(self, cell, pyramid=None):
+        self.cell = cell
+        self.columns = int(math.ceil(360.0 / cell))
+        self.cells = {}
+        # did -> (x, y, owner id, privacy, cell)
+        self.entries = {}
+        self.owners = {}
+        # Kept in step with the grid (see TooPath3/clustering.py).
+        self.pyramid = pyramid
+        self.lock = threading.Lock()
+
+    def _cell_of(self, x, y):
+        return int(math.floor((x + 180.0) / self.cell)) % self.columns, int(math.floor((y + 90.0) / self.cell))
+
+    def _remove(self, did):
+        entry = self.entries.pop(did, None)
+        if entry is not None:
+            x, y, owner_id, privacy, cell = entry
+            members = self.cells[cell]
+            del members[did]
+            if not members:
+                del self.cells[cell]
+            self.owners[owner_id].discard(did)
+            if not self.owners[owner_id]:
+                del self.owners[owner_id]
+            if self.pyramid is not None:
+                self.pyramid.remove(did, x, y, privacy)
+
+    def update(self, did, x, y, owner_id, privacy):
+        cell = self._cell_of(x, y)
+        with self.lock:
+            self._remove(did)
+            self.entries[did] = (x, y, owner_id, privacy, cell)
+            self.cells.setdefault(cell, {})[did] = (x, y, owner_id, privacy)
+            self.owners.setdefault(owner_id, set()).add(did)
+            if self.pyramid is not None:
+                self.pyramid.add(did, x, y, privacy)
+
+    def remove(self, did):
+        with self.lock:
+            self._remove(did)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def owned_by(self, owner_id):
+        """
+         (did, x, y, privacy) of the devices of `owner_id`.
+        """
+        with self.lock:
+            return [(did,) + self.entries[did][:2] + self.entries[did][3:4] for did in self.owners.get(owner_id, ())]
+
+    def columns_between(self, west, east):
+        """
+         The grid columns from longitude `west` eastwards to `east`, across the antimeridian when west > east.
+        """
+        first = int(math.floor((west + 180.0) / self.cell))
+        last = int(math.floor((east + 180.0) / self.cell))
+        if last < first:
+            last += self.columns
+        if last - first + 1 >= self.columns:
+            return range(self.columns)
+        return [column % self.columns for column in range(first, last + 1)]
+
+    def within(self, columns, south, north):
+        """
+         (did, x, y, owner id, privacy) of the positions in the cells of `columns` between latitudes `south` and
+         `north`, which may lie a cell beyond the bounds.
+        """
+        rows = range(self._cell_of(0.0, south)[1], self._cell_of(0.0, north)[1] + 1)
+        with self.lock:
+            return [(did,) + member for column in columns for row in rows
+                    for did, member in self.cells.get((column, row), {}).items()]
+
+    def nearby(self, x, y, radius, k, visible):
+        """
+         The k positions closest to (x, y) within `radius` meters that `visible(owner_id, privacy)` lets through,
+         as (distance, did, x, y) tuples sorted by distance.
+        """
+        span = math.degrees(radius / EARTH_RADIUS)
+        bottom, top = max(-90.0, y - span), min(90.0, y + span)
+        widest = math.cos(math.radians(max(abs(bottom), abs(top))))
+        if widest <= 0 or span / widest >= 180.0:
+            columns = range(self.columns)
+        else:
+            columns = self.columns_between(x - span / widest, x + span / widest)
+        candidates = []
+        for did, px, py, owner_id, privacy in self.within(columns, bottom, top):
+            if visible(owner_id, privacy):
+                distance = haversine(x, y, px, py)
+                if distance <= radius:
+                    candidates.append((distance, did, px, py))
+        return heapq.nsmallest(k, candidates)
+
+
+class LivePositions(object):
+    """
+     The grid index of every device's actual location, kept by this process. Saves made here are applied by the
+     signals below; those of other processes and of the ingestion log's drainer are picked up by polling the rows
+     updated since the last poll, and the whole index is rebuilt from the database every
+     TOOPATH_NEARBY_RECONCILE_SECONDS, which also drops what was purged or rolled back. Only the first build runs
+     on a request; the others run in a thread of their own while requests keep using the polled index.
+    """
+
+    def __init__(self):
+        self.index = None
+        self.polled_at = None
+        self.reconciled_at = 0.0
+        self.reconciling = False
+        self.lock = threading.Lock()
+
+    def _load(self, rows, index):
+        for did, point, owner_id, privacy, trash in rows:
+            if trash or point is None or point.empty:
+                index.remove(did)
+            else:
+                index.update(did, point.x, point.y, owner_id, privacy)
+
+    def _rows(self, **filters):
+        return ActualLocation.objects.filter(**filters).values_list(
+            'device_id', 'point', 'device__owner_id', 'device__device_privacy', 'device__trash')
+
+    def _rebuilt(self):
+        started = timezone.now()
+        index = GridIndex(settings.TOOPATH_NEARBY_CELL_DEGREES, ClusterPyramid(settings.TOOPATH_CLUSTER_MAX_ZOOM))
+        self._load(self._rows().iterator(), index)
+        registry.inc('toopath_nearby_reconciles_total')
+        return index, started
+
+    def reconcile(self):
+        self.index, self.polled_at = self._rebuilt()
+        self.reconciled_at = time.time()
+
+    def _reconcile_in_background(self):
+        try:
+            index, started = self._rebuilt()
+            with self.lock:
+                # Polled again from when the rebuild started, for what changed while it ran.
+                self.index, self.polled_at, self.reconciled_at = index, started, time.time()
+        finally:
+            self.reconciling = False
+            connection.close()
+
+    def poll(self):
+        started = timezone.now()
+        since = self.polled_at - POLL_OVERLAP
+        # Moved devices, then devices whose owner, privacy or trash changed: each query has an index of its own.
+        self._load(self._rows(updated_at__gte=since), self.index)
+        self._load(self._rows(device__updated_at__gte=since), self.index)
+        self.polled_at = started
+
+    def current(self):
+        with self.lock:
+            if self.index is None:
+                self.reconcile()
+                return self.index
+            if not self.reconciling and time.time() - self.reconciled_at >= settings.TOOPATH_NEARBY_RECONCILE_SECONDS:
+                self.reconciling = True
+                threading.Thread(target=self._reconcile_in_background, daemon=True).start()
+            if (timezone.now() - self.polled_at).total_seconds() >= settings.TOOPATH_NEARBY_POLL_SECONDS:
+                self.poll()
+        return self.index
+
+    def moved(self, did, point):
+        index = self.index
+        if index is None:
+            return
+        entry = index.entries.get(did)
+        if point is None or point.empty:
+            index.remove(did)
+        elif entry is not None:
+            index.update(did, point.x, point.y, entry[2], entry[3])
+        else:
+            device = Device.objects.filter(pk=did).values_list('owner_id', 'device_privacy', 'trash').first()
+            self._load([(did, point) + device] if device else [(did, None, None, None, True)], index)
+
+    def forget(self, did):
+        if self.index is not None:
+            self.index.remove(did)
+
+
+live_positions = LivePositions()
+
+
+def visible_to(user):
+    # There is no friendship between users yet, so only their owner sees the devices shared with friends.
+    def visible(owner_id, privacy):
+        return privacy == Device.PUBLIC or owner_id == user.pk
+    return visible
+
+
+def nearby_devices(user, point, radius, k):
+    return live_positions.current().nearby(point.x, point.y, radius, k, visible_to(user))
+
+
+@receiver(post_save, sender=ActualLocation)
+def actual_location_saved(sender, instance, **kwargs):
+    live_positions.moved(instance.pk, instance.point)
+
+
+@receiver(post_save, sender=Device)
+def device_saved(sender, instance, **kwargs):
+    index = live_positions.index
+    entry = index.entries.get(instance.pk) if index is not None else None
+    if instance.trash:
+        live_positions.forget(instance.pk)
+    elif entry is not None:
+        index.update(instance.pk, entry[0], entry[1], instance.owner_id, instance.device_privacy)
+
+
+@receiver(post_delete, sender=ActualLocation)
+@receiver(post_delete, sender=Device)
+def device_deleted(sender, instance, **kwargs):
+    live_positions.forget(instance.pk)
@@ -0,0 +1,92 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DatabaseError, connections
+
+_state = threading.local()
+_down_until = {}
+_END = object()
+
+
+def replica_aliases():
+    return [alias for alias in settings.DATABASES if alias != 'default']
+
+
+def choose_replica():
+    """
+     Picks a healthy replica for the current request, or None to keep reading from the primary.
+    """
+    now = time.time()
+    candidates = [alias for alias in replica_aliases() if _down_until.get(alias, 0) <= now]
+    random.shuffle(candidates)
+    for alias in candidates:
+        try:
+            _check(alias, now)
+        except DatabaseError:
+            _down_until[alias] = now + settings.TOOPATH_REPLICA_RETRY_SECONDS
+            continue
+        return alias
+    return None
+
+
+def _check(alias, now):
+    """
+     Connects this thread to the replica, raising DatabaseError when it can't. A persistent connection may have died
+     while idle (failover, restart): it is checked with a query at most every TOOPATH_REPLICA_CHECK_SECONDS rather
+     than on every request, and one dying in between fails its request and is closed by Django when the request ends.
+    """
+    checked_at = getattr(_state, 'checked_at', None)
+    if checked_at is None:
+        checked_at = _state.checked_at = {}
+    connection = connections[alias]
+    if connection.connection is not None and now - checked_at.get(alias, 0) < settings.TOOPATH_REPLICA_CHECK_SECONDS:
+        return
+    if connection.connection is not None and not connection.is_usable():
+        connection.close()
+    connection.ensure_connection()
+    checked_at[alias] = now
+
+
+@contextmanager
+def reading_from(alias):
+    previous = getattr(_state, 'alias', None)
+    _state.alias = alias
+    try:
+        yield
+    finally:
+        _state.alias = previous
+
+
+def reading_chunks_from(alias, chunks):
+    """
+     Iterates the body of a streaming response, whose queries run after the middleware returned, reading from
+     `alias` while each chunk is produced.
+    """
+    chunks = iter(chunks)
+    while True:
+        with reading_from(alias):
+            chunk = next(chunks, _END)
+        if chunk is _END:
+            return
+        yield chunk
+
+
+class ReplicaRouter(object):
+    """
+     Sends reads to the replica chosen for the current request; everything else goes to the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        return getattr(_state, 'alias', None) or 'default'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == 'default'
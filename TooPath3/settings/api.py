@@ -0,0 +1,40 @@
+"""
+Slim profile for the API workers (see `TooPath3.wsgi_api`).
+
+It takes the settings of a deployment, TOOPATH3_API_BASE_SETTINGS, and drops what the API never uses: it
+authenticates with JWT and answers JSON, so there is no admin, sessions, messages, static files, templates nor
+CSRF and clickjacking middleware to load at boot or to run on every request.
+"""
+import importlib
+import os
+
+_base = importlib.import_module(os.getenv('TOOPATH3_API_BASE_SETTINGS', 'TooPath3.settings.local'))
+globals().update((name, value) for name, value in vars(_base).items() if name.isupper())
+
+INSTALLED_APPS = [
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+    'django.contrib.gis',
+    'rest_framework',
+    'rest_framework_gis',
+    'rest_framework_jwt',
+    'corsheaders',
+    'TooPath3.apps.TooPathConfig',
+]
+
+MIDDLEWARE = [
+    'TooPath3.metrics.MetricsMiddleware',
+    'django.middleware.security.SecurityMiddleware',
+    'corsheaders.middleware.CorsMiddleware',
+    'django.middleware.common.CommonMiddleware',
+    'TooPath3.middleware.ReplicaRoutingMiddleware',
+]
+
+TEMPLATES = []
+
+WSGI_APPLICATION = 'TooPath3.wsgi_api.application'
+
+REST_FRAMEWORK = dict(_base.REST_FRAMEWORK, **{
+    'DEFAULT_RENDERER_CLASSES': ('TooPath3.renderers.FastJSONRenderer',),
+    'DEFAULT_AUTHENTICATION_CLASSES': ('rest_framework_jwt.authentication.JSONWebTokenAuthentication',),
+})
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/1.11/ref/settings/
 """
 import datetime
 import os
+import tempfile
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 from django.conf import settings
@@ -48,15 +49,16 @@ INSTALLED_APPS = [
 CORS_ORIGIN_ALLOW_ALL = True
 
 MIDDLEWARE = [
+    'TooPath3.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'corsheaders.middleware.CorsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'corsheaders.middleware.CorsMiddleware',
-    'django.middleware.common.CommonMiddleware',
+    'TooPath3.middleware.ReplicaRoutingMiddleware',
 ]
 
 ROOT_URLCONF = 'TooPath3.urls'
@@ -94,6 +96,61 @@ DATABASES = {
     }
 }
 
+
+def database(host, port, name='toopath', user='django', password='toopath3'):
+    return {
+        'ENGINE': 'django.contrib.gis.db.backends.postgis',
+        'NAME': os.getenv('TOOPATH3_DB_NAME', name),
+        'USER': os.getenv('TOOPATH3_DB_USER', user),
+        'PASSWORD': os.getenv('TOOPATH3_DB_PASSWORD', password),
+        'HOST': os.getenv('TOOPATH3_DB_HOST', host),
+        'PORT': os.getenv('TOOPATH3_DB_PORT', port),
+        'CONN_MAX_AGE': int(os.getenv('TOOPATH3_DB_CONN_MAX_AGE', '60')),
+    }
+
+
+def replica_databases(primary):
+    # TOOPATH3_DB_REPLICAS="host[:port],host[:port]" adds one read replica per address.
+    replicas = {}
+    addresses = [address for address in os.getenv('TOOPATH3_DB_REPLICAS', '').split(',') if address]
+    for n, address in enumerate(addresses):
+        host, _, port = address.partition(':')
+        replicas['replica_%d' % n] = dict(primary, HOST=host, PORT=port or primary['PORT'],
+                                          TEST={'MIRROR': 'default'})
+    return replicas
+
+
+DATABASE_ROUTERS = ['TooPath3.routers.ReplicaRouter']
+
+TOOPATH_REPLICA_STICKY_SECONDS = int(os.getenv('TOOPATH3_REPLICA_STICKY_SECONDS', '5'))
+TOOPATH_REPLICA_RETRY_SECONDS = 30
+# How often a worker checks that its persistent connection to a replica still answers.
+TOOPATH_REPLICA_CHECK_SECONDS = 10
+TOOPATH_REPLICA_PIN_COOKIE = 'toopath_primary'
+TOOPATH_REPLICA_PIN_CACHE = 'pins'
+
+# Caches
+# https://docs.djangoproject.com/en/1.11/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Shared by every worker of every host. Memcached evicts the least recently used entries once it is full, so the
+    # versions read by every cached request outlive the responses stored under them (see TooPath3/caching.py).
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': os.getenv('TOOPATH3_MEMCACHED', '127.0.0.1:11211'),
+    },
+    # Read-your-writes pins (see TooPath3/middleware.py), in a memcached of their own so the responses can't evict
+    # them. A pin lasts TOOPATH_REPLICA_STICKY_SECONDS and takes about 100 bytes: 16 MB hold the writers of over
+    # 30000 requests a second.
+    'pins': {
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': os.getenv('TOOPATH3_PIN_MEMCACHED', '127.0.0.1:11212'),
+    },
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
 
@@ -131,7 +188,17 @@ USE_TZ = True
 STATIC_URL = '/static/'
 
 REST_FRAMEWORK = {
-    'TEST_REQUEST_DEFAULT_FORMAT': 'json'
+    'TEST_REQUEST_DEFAULT_FORMAT': 'json',
+    # orjson when it is installed, DRF's own encoder and decoder otherwise
+    'DEFAULT_RENDERER_CLASSES': (
+        'TooPath3.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
+    'DEFAULT_PARSER_CLASSES': (
+        'TooPath3.renderers.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ),
 }
 
 JWT_AUTH = {
@@ -158,3 +225,140 @@ JWT_AUTH = {
 }
 
 AUTH_USER_MODEL = 'TooPath3.CustomUser'
+
+# Live location stream (see `manage.py runstream`)
+
+TOOPATH_STREAM_ENABLED = os.getenv('TOOPATH3_STREAM_ENABLED', '1') == '1'
+TOOPATH_STREAM_CHANNEL = 'actual_locations'
+TOOPATH_STREAM_HOST = '0.0.0.0'
+TOOPATH_STREAM_PORT = int(os.getenv('TOOPATH3_STREAM_PORT', '8081'))
+TOOPATH_STREAM_BACKLOG = 2048
+TOOPATH_STREAM_KEEPALIVE = 15
+TOOPATH_STREAM_QUEUE_SIZE = 16
+TOOPATH_STREAM_DB_THREADS = 4
+
+# Google login: id_tokens are verified locally against Google's signing keys. Only tokens issued to one of
+# TOOPATH3_GOOGLE_CLIENT_IDS are accepted, so Google login is off until it is set.
+
+TOOPATH_GOOGLE_CLIENT_IDS = [client_id for client_id in os.getenv('TOOPATH3_GOOGLE_CLIENT_IDS', '').split(',')
+                             if client_id]
+TOOPATH_GOOGLE_CERTS_URL = 'https://www.googleapis.com/oauth2/v3/certs'
+TOOPATH_GOOGLE_TIMEOUT = (3.05, 5)
+TOOPATH_GOOGLE_POOL_SIZE = 4
+TOOPATH_GOOGLE_KEYS_MAX_AGE = 3600
+TOOPATH_GOOGLE_REFRESH_MARGIN = 300
+# Keys are fetched at most once per TOOPATH_GOOGLE_MIN_REFRESH_SECONDS, failed fetches included: tokens with an
+# unknown kid are rejected in between instead of each one waiting on Google.
+TOOPATH_GOOGLE_MIN_REFRESH_SECONDS = 60
+TOOPATH_GOOGLE_TOKEN_CACHE_SIZE = 10000
+
+# Per-endpoint metrics, exposed at /metrics/ in the Prometheus text format. Counting the SQL of each request takes
+# Django's debug cursor, so they are off unless TOOPATH3_METRICS_ENABLED=1; the settings the service runs with turn
+# them on. Only the addresses in TOOPATH3_METRICS_ALLOWED_IPS, comma-separated, may read them: loopback when unset.
+
+TOOPATH_METRICS_ENABLED = os.getenv('TOOPATH3_METRICS_ENABLED', '0') == '1'
+TOOPATH_METRICS_DIR = os.getenv('TOOPATH3_METRICS_DIR', os.path.join(tempfile.gettempdir(), 'toopath3-metrics'))
+TOOPATH_METRICS_FLUSH_SECONDS = 5
+TOOPATH_METRICS_ALLOWED_IPS = [ip for ip in os.getenv('TOOPATH3_METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',') if ip]
+
+# Per-user cache of the read endpoints, invalidated by model signals (see TooPath3/caching.py). Every worker must
+# see the same versions, so use a cache alias shared by all of them unless there is a single process.
+
+TOOPATH_RESPONSE_CACHE_ENABLED = os.getenv('TOOPATH3_RESPONSE_CACHE_ENABLED', '0') == '1'
+TOOPATH_RESPONSE_CACHE = os.getenv('TOOPATH3_RESPONSE_CACHE', 'default')
+TOOPATH_RESPONSE_CACHE_SECONDS = 300
+
+# Big DeviceList and TrackDetail responses are streamed with gzip or br as they are serialized (see
+# TooPath3/compression.py). Level 5 gzip and quality 4 brotli compress JSON well at a fraction of the CPU of
+# their maximum levels.
+
+TOOPATH_COMPRESSION_MIN_BYTES = 32 * 1024
+TOOPATH_COMPRESSION_GZIP_LEVEL = 5
+TOOPATH_COMPRESSION_BROTLI_QUALITY = 4
+TOOPATH_COMPRESSION_CHUNK_LOCATIONS = 1000
+TOOPATH_COMPRESSION_CHUNK_DEVICES = 20
+
+# Background jobs, kept in the jobs table and run by `manage.py run_jobs` (see TooPath3/jobs.py). A running job
+# whose worker hasn't finished it within the lease is handed to another worker.
+
+TOOPATH_JOBS_LEASE_SECONDS = 600
+TOOPATH_JOBS_MAX_ATTEMPTS = 5
+TOOPATH_JOBS_POLL_SECONDS = 1
+TOOPATH_JOBS_PURGE_BATCH = 5000
+
+# Largest batch of points a device may upload to /devices/{d}/tracks/{t}/sync/ in one request.
+
+TOOPATH_SYNC_MAX_BATCH = 5000
+
+# Track playback (/devices/{d}/tracks/{t}/position/) keeps the timelines of the tracks played back lately in each
+# process, up to TOOPATH_PLAYBACK_CACHE_POINTS points in all, about 24 bytes each.
+
+TOOPATH_PLAYBACK_CACHE_POINTS = 2000000
+TOOPATH_PLAYBACK_MAX_TIMES = 1000
+
+# A stop is a stay of at least TOOPATH_STOPS_MIN_SECONDS within TOOPATH_STOPS_RADIUS meters of where it began. Stops
+# are detected by `detect_stops` jobs, which `manage.py detect_stops` queues for the tracks with new points.
+
+TOOPATH_STOPS_RADIUS = 50
+TOOPATH_STOPS_MIN_SECONDS = 300
+
+# Reads of track locations (/devices/{d}/tracks/{t}/locations/) answer at most TOOPATH_DOWNSAMPLE_MAX_POINTS points,
+# one per time bucket, with buckets as wide as it takes.
+
+TOOPATH_DOWNSAMPLE_MAX_POINTS = 5000
+
+# Optional ingestion log: new track locations and actual locations are appended to local, memory-mapped segments
+# and acknowledged with 202 Accepted, then replayed into PostGIS by `manage.py drain_ingest` (see
+# TooPath3/ingest.py). Keeps the workers answering while the database is slow. Each host running API workers needs
+# its own drainer on the same directory, which must be on local disk.
+
+TOOPATH_INGEST_LOG_ENABLED = os.getenv('TOOPATH3_INGEST_LOG_ENABLED', '0') == '1'
+TOOPATH_INGEST_LOG_DIR = os.getenv('TOOPATH3_INGEST_LOG_DIR', os.path.join(tempfile.gettempdir(), 'toopath3-ingest'))
+TOOPATH_INGEST_SEGMENT_BYTES = 16 * 1024 * 1024
+TOOPATH_INGEST_DRAIN_BATCH = 5000
+TOOPATH_INGEST_DRAIN_POLL_SECONDS = 0.5
+
+# Token buckets for the location writes, per device and per user, shared by the workers of a host through a
+# memory-mapped file (see TooPath3/throttling.py). Rates are (burst, tokens refilled per second), per device_type:
+# 'ad' Android, 'io' iPhone, 'wp' Windows Phone, 'en' Enfora trackers.
+
+TOOPATH_THROTTLE_ENABLED = os.getenv('TOOPATH3_THROTTLE_ENABLED', '1') == '1'
+TOOPATH_THROTTLE_FILE = os.getenv('TOOPATH3_THROTTLE_FILE',
+                                  os.path.join(tempfile.gettempdir(), 'toopath3-throttle', 'buckets'))
+TOOPATH_THROTTLE_SLOTS = 65536
+TOOPATH_THROTTLE_DEVICE_RATES = {
+    'ad': (30, 1.0),
+    'io': (30, 1.0),
+    'wp': (30, 1.0),
+    'en': (60, 5.0),
+}
+TOOPATH_THROTTLE_DEFAULT_DEVICE_RATE = (30, 1.0)
+TOOPATH_THROTTLE_USER_RATE = (300, 20.0)
+
+# Tracks whose points haven't changed for TOOPATH_ARCHIVE_AFTER_DAYS are moved out of track_locations into
+# compressed columnar files, one per track (see TooPath3/archive.py). Every API worker reads them, so with several
+# hosts the directory must be shared.
+
+TOOPATH_ARCHIVE_DIR = os.getenv('TOOPATH3_ARCHIVE_DIR', os.path.join(os.path.dirname(BASE_DIR), 'archive'))
+TOOPATH_ARCHIVE_AFTER_DAYS = 30
+
+# `pack_tracks` packs the points of tracks unchanged for TOOPATH_PACK_AFTER_DAYS into a blob in their own row, which
+# keeps them in the database, replicated and backed up with it, at a fraction of the size of their rows.
+
+TOOPATH_PACK_AFTER_DAYS = 7
+
+# `GET /devices/nearby/` answers from an in-process grid index of the actual locations (see TooPath3/proximity.py),
+# polled for the rows updated elsewhere every TOOPATH_NEARBY_POLL_SECONDS and rebuilt from the database, in the
+# background, every TOOPATH_NEARBY_RECONCILE_SECONDS.
+
+TOOPATH_NEARBY_CELL_DEGREES = 0.05
+TOOPATH_NEARBY_MAX_RADIUS = 50000
+TOOPATH_NEARBY_POLL_SECONDS = 1.0
+TOOPATH_NEARBY_RECONCILE_SECONDS = 300
+
+# `GET /devices/clusters/` keeps the clusters of public devices for zooms up to TOOPATH_CLUSTER_MAX_ZOOM in the same
+# index (see TooPath3/clustering.py); above it, boxes of up to TOOPATH_CLUSTER_MAX_SCAN_CELLS cells of the grid are
+# clustered per request.
+
+TOOPATH_CLUSTER_MAX_ZOOM = 10
+TOOPATH_CLUSTER_MAX_SCAN_CELLS = 4096
@@ -8,12 +8,15 @@ ALLOWED_HOSTS = []
 # https://docs.djangoproject.com/en/1.10/ref/settings/#databases
 
 DATABASES = {
-    'default': {
-        'ENGINE': 'django.contrib.gis.db.backends.postgis',
-        'NAME': 'toopath',
-        'USER': 'django',
-        'PASSWORD': 'toopath3',
-        'HOST': 'postgres',
-        'PORT': '5432',
-    }
+    'default': database('postgres', '5432'),
 }
+DATABASES.update(replica_databases(DATABASES['default']))
+
+CACHES['shared']['LOCATION'] = os.getenv('TOOPATH3_MEMCACHED', 'memcached:11211')
+CACHES['pins']['LOCATION'] = os.getenv('TOOPATH3_PIN_MEMCACHED', 'memcached-pins:11211')
+
+TOOPATH_METRICS_ENABLED = os.getenv('TOOPATH3_METRICS_ENABLED', '1') == '1'
+
+# The workers share the memcached cache, set TOOPATH3_RESPONSE_CACHE_ENABLED=0 to turn it off
+TOOPATH_RESPONSE_CACHE_ENABLED = os.getenv('TOOPATH3_RESPONSE_CACHE_ENABLED', '1') == '1'
+TOOPATH_RESPONSE_CACHE = os.getenv('TOOPATH3_RESPONSE_CACHE', 'shared')
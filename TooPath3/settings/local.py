@@ -17,3 +17,10 @@ DATABASES = {
         'PORT': '15432',
     }
 }
+
+TOOPATH_METRICS_ENABLED = os.getenv('TOOPATH3_METRICS_ENABLED', '1') == '1'
+
+# runserver is a single process, its local memory cache is enough
+CACHES = dict(CACHES, shared={'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'shared'},
+              pins={'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'pins'})
+TOOPATH_RESPONSE_CACHE_ENABLED = os.getenv('TOOPATH3_RESPONSE_CACHE_ENABLED', '1') == '1'
@@ -8,12 +8,12 @@ ALLOWED_HOSTS = ['147.83.153.201', '147.83.153.208', '127.0.0.1']
 # https://docs.djangoproject.com/en/1.10/ref/settings/#databases
 
 DATABASES = {
-    'default': {
-        'ENGINE': 'django.contrib.gis.db.backends.postgis',
-        'NAME': 'toopath',
-        'USER': 'toopath',
-        'PASSWORD': 'toopath3',
-        'HOST': '127.0.0.1',
-        'PORT': '5432',
-    }
+    'default': database('127.0.0.1', '5432', user='toopath'),
 }
+DATABASES.update(replica_databases(DATABASES['default']))
+
+TOOPATH_METRICS_ENABLED = os.getenv('TOOPATH3_METRICS_ENABLED', '1') == '1'
+
+# The workers share the memcached cache, set TOOPATH3_RESPONSE_CACHE_ENABLED=0 to turn it off
+TOOPATH_RESPONSE_CACHE_ENABLED = os.getenv('TOOPATH3_RESPONSE_CACHE_ENABLED', '1') == '1'
+TOOPATH_RESPONSE_CACHE = os.getenv('TOOPATH3_RESPONSE_CACHE', 'shared')
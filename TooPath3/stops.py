@@ -0,0 +1,158 @@
+import numpy as np
+from django.conf import settings
+from django.contrib.gis.geos import Point
+from django.db import connection, transaction
+from django.db.models import F, Max, Q
+from django.utils import timezone
+
+from TooPath3.archive import EPOCH, MICROSECOND
+from TooPath3.jobs import handler
+from TooPath3.models import Job, Stop, Track
+from TooPath3.playback import load_timeline
+from TooPath3.proximity import EARTH_RADIUS
+
+# Points compared at once with the first of a stop, at first, when looking for its end.
+STAY_BLOCK = 64
+# First key of the advisory locks taken while detecting the stops of a track, the second being its id.
+STOPS_LOCK = 0x53544f50
+
+
+def distances(x1, y1, x2, y2):
+    """
+     Great-circle distances in meters between arrays of lon/lat points.
+    """
+    lon1, lat1, lon2, lat2 = (np.radians(values) for values in (x1, y1, x2, y2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.minimum(1.0, np.sqrt(a)))
+
+
+def stay_ends(timeline, radius, min_duration):
+    """
+     For every point, the index of the first later point further than `radius` meters from it, or the number of
+     points when there is none, and -1 once its stay lasts `min_duration`, which makes it a stop as long as it may
+     be. All the points are compared at once with the one `offset` places after them, offset after offset, each
+     round only for those whose stay hasn't ended yet nor lasted that long, so stationary points are not all
+     compared with every one after them.
+    """
+    xs, ys, times = timeline.xs, timeline.ys, timeline.times
+    count = len(xs)
+    ends = np.full(count, count, dtype=np.int64)
+    anchors = np.arange(count)
+    offset = 1
+    while anchors.size:
+        anchors = anchors[anchors + offset < count]
+        far = distances(xs[anchors], ys[anchors], xs[anchors + offset], ys[anchors + offset]) > radius
+        ends[anchors[far]] = anchors[far] + offset
+        anchors = anchors[~far]
+        lasting = times[anchors + offset] - times[anchors] >= min_duration
+        ends[anchors[lasting]] = -1
+        anchors = anchors[~lasting]
+        offset += 1
+    return ends
+
+
+def stay_end(xs, ys, first, radius):
+    """
+     The index of the first point after `first` further than `radius` meters from it, or the number of points when
+     there is none. The points are compared in blocks, each twice as long as the one before, so the end of a long
+     stay costs time in proportion to its length.
+    """
+    count = len(xs)
+    start, size = first + 1, STAY_BLOCK
+    while start < count:
+        stop = min(count, start + size)
+        far = np.flatnonzero(distances(xs[first], ys[first], xs[start:stop], ys[start:stop]) > radius)
+        if far.size:
+            return start + int(far[0])
+        start, size = stop, size * 2
+    return count
+
+
+def find_stops(timeline, radius, min_seconds):
+    """
+     (first, end) index ranges of the stops of a timeline: the points staying within `radius` meters of the first
+     for at least `min_seconds`. Scanning goes on from the end of each stop, and from the next point otherwise, so
+     only the stops it starts from are measured to their end.
+    """
+    min_duration = min_seconds * 10 ** 6
+    ends = stay_ends(timeline, radius, min_duration)
+    stops = []
+    first = 0
+    while first < len(ends):
+        end = int(ends[first])
+        if end < 0:
+            end = stay_end(timeline.xs, timeline.ys, first, radius)
+        if timeline.times[end - 1] - timeline.times[first] >= min_duration:
+            stops.append((first, end))
+            first = end
+        else:
+            first += 1
+    return stops
+
+
+def _date(microseconds):
+    return EPOCH + MICROSECOND * int(microseconds)
+
+
+@handler('detect_stops')
+def detect_stops(tid, rescan=False):
+    """
+     Detects the stops of the track among the points from the arrival of its last stop on, since new points can
+     only extend it or add stops after it, or among all of them when `rescan` or when they were never detected,
+     which deleting a point brings back.
+    """
+    with transaction.atomic():
+        # Rather than a lock on the track's row, which would hold up the inserts of its points until this commits.
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s, %s)', [STOPS_LOCK, tid])
+        track = Track.objects.filter(pk=tid, trash=False).first()
+        if track is None:
+            return
+        checked_at = timezone.now()
+        rescan = rescan or track.stops_checked_at is None
+        last = None if rescan else track.stops.order_by('-arrived_at').first()
+        timeline = load_timeline(track)
+        first = 0
+        if last is not None:
+            first = int(np.searchsorted(timeline.times, (last.arrived_at - EPOCH) // MICROSECOND))
+            track.stops.filter(arrived_at__gte=last.arrived_at).delete()
+        else:
+            track.stops.all().delete()
+        timeline = type(timeline)(*(values[first:] for values in timeline))
+        Stop.objects.bulk_create(
+            Stop(track=track, point=Point(float(timeline.xs[start:end].mean()), float(timeline.ys[start:end].mean()),
+                                          srid=4326),
+                 arrived_at=_date(timeline.times[start]), departed_at=_date(timeline.times[end - 1]),
+                 duration=(timeline.times[end - 1] - timeline.times[start]) / 10 ** 6, points=int(end - start))
+            for start, end in find_stops(timeline, settings.TOOPATH_STOPS_RADIUS, settings.TOOPATH_STOPS_MIN_SECONDS))
+        Track.objects.filter(pk=tid).update(stops_checked_at=checked_at)
+
+
+def unchecked_tracks():
+    """
+     Ids of the tracks with points updated since their stops were last detected, or never detected.
+    """
+    return (Track.objects.filter(trash=False).values('tid')
+            .annotate(last_updated=Max('locations__updated_at'))
+            .filter(Q(stops_checked_at__isnull=True) & (Q(last_updated__isnull=False) | Q(archived_points__gt=0)) |
+                    Q(last_updated__gte=F('stops_checked_at')))
+            .values_list('tid', flat=True))
+
+
+def queue_stop_detection(tids, rescan=False):
+    """
+     Queues a `detect_stops` job per track, in bulk, but for the tracks that already have one waiting. Returns how
+     many were queued.
+    """
+    waiting = {job.payload.get('tid') for job in Job.objects.filter(kind='detect_stops', status=Job.QUEUED).only(
+        'payload')}
+    count = 0
+    batch = []
+    for tid in tids:
+        if tid in waiting:
+            continue
+        batch.append(Job(kind='detect_stops', payload={'tid': tid, 'rescan': rescan}))
+        if len(batch) == 1000:
+            count += len(Job.objects.bulk_create(batch))
+            batch = []
+    return count + len(Job.objects.bulk_create(batch))
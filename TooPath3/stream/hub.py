@@ -0,0 +1,39 @@
+import asyncio
+from collections import defaultdict
+
+
+class Hub(object):
+    """
+     In-process fan-out of live positions to the subscribers of each device.
+    """
+
+    def __init__(self, queue_size=16):
+        self.queue_size = queue_size
+        self._subscribers = defaultdict(set)
+
+    def subscribe(self, keys):
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        for key in keys:
+            self._subscribers[key].add(queue)
+        return queue
+
+    def unsubscribe(self, keys, queue):
+        for key in keys:
+            subscribers = self._subscribers.get(key)
+            if subscribers is None:
+                continue
+            subscribers.discard(queue)
+            if not subscribers:
+                del self._subscribers[key]
+
+    def publish(self, key, message):
+        subscribers = self._subscribers.get(key, ())
+        for queue in subscribers:
+            # A slow consumer only cares about the latest position, so drop its oldest one.
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(message)
+        return len(subscribers)
+
+    def subscriber_count(self):
+        return len(set().union(*self._subscribers.values()))
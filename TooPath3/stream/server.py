@@ -0,0 +1,198 @@
+import asyncio
+import json
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+import psycopg2
+import psycopg2.extensions
+from django.conf import settings
+from django.db import close_old_connections, connections
+from psycopg2 import sql
+from rest_framework import exceptions
+from rest_framework_jwt.authentication import JSONWebTokenAuthentication
+from rest_framework_jwt.settings import api_settings
+
+from TooPath3.models import ActualLocation, Device
+from TooPath3.stream.hub import Hub
+from TooPath3.stream.signals import location_message
+
+logger = logging.getLogger(__name__)
+
+DEVICE_STREAM = re.compile(r'^/devices/(?P<d_pk>[0-9]+)/actualLocation/stream/$')
+USER_STREAM = re.compile(r'^/devices/actualLocations/stream/$')
+
+REASONS = {200: 'OK', 400: 'Bad Request', 401: 'Unauthorized', 403: 'Forbidden', 404: 'Not Found',
+           405: 'Method Not Allowed'}
+
+
+class StreamError(Exception):
+    def __init__(self, status, detail):
+        super(StreamError, self).__init__(detail)
+        self.status = status
+        self.detail = detail
+
+
+def authenticate(token):
+    # EventSource can not send headers, so the JWT may also come in the query string.
+    try:
+        payload = api_settings.JWT_DECODE_HANDLER(token)
+        return JSONWebTokenAuthentication().authenticate_credentials(payload)
+    except exceptions.AuthenticationFailed as e:
+        raise StreamError(401, str(e.detail))
+    except Exception:
+        raise StreamError(401, 'Invalid token.')
+
+
+def subscription_for(user, d_pk=None):
+    """
+     Returns the device ids the user may watch and the current position of each one.
+    """
+    close_old_connections()
+    if d_pk is not None:
+        device = Device.objects.filter(pk=d_pk).only('owner_id').first()
+        if device is None:
+            raise StreamError(404, 'Not found.')
+        if device.owner_id != user.pk:
+            raise StreamError(403, 'You do not have permission to perform this action.')
+        device_ids = [device.pk]
+    else:
+        device_ids = list(Device.objects.filter(owner=user).values_list('pk', flat=True))
+    actual_locations = ActualLocation.objects.filter(pk__in=device_ids)
+    return device_ids, [location_message(actual_location) for actual_location in actual_locations]
+
+
+class StreamServer(object):
+    """
+     Asyncio sidecar serving Server-Sent Events of the positions published by `pg_notify`.
+    """
+
+    def __init__(self, hub=None, loop=None, keepalive=None, executor=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.hub = hub or Hub(queue_size=settings.TOOPATH_STREAM_QUEUE_SIZE)
+        self.keepalive = keepalive or settings.TOOPATH_STREAM_KEEPALIVE
+        self.executor = executor or ThreadPoolExecutor(max_workers=settings.TOOPATH_STREAM_DB_THREADS)
+        self.listen_connection = None
+
+    def listen(self):
+        params = connections['default'].get_connection_params()
+        self.listen_connection = psycopg2.connect(**params)
+        self.listen_connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with self.listen_connection.cursor() as cursor:
+            cursor.execute(sql.SQL('LISTEN {}').format(sql.Identifier(settings.TOOPATH_STREAM_CHANNEL)))
+        self.loop.add_reader(self.listen_connection.fileno(), self._on_notify)
+
+    def _on_notify(self):
+        try:
+            self.listen_connection.poll()
+        except psycopg2.Error:
+            logger.exception('Lost the LISTEN connection, reconnecting')
+            self.loop.remove_reader(self.listen_connection.fileno())
+            self.loop.call_later(1, self.listen)
+            return
+        while self.listen_connection.notifies:
+            notify = self.listen_connection.notifies.pop(0)
+            try:
+                message = json.loads(notify.payload)
+            except ValueError:
+                continue
+            self.hub.publish(message['device'], message)
+
+    async def handle(self, reader, writer):
+        try:
+            method, path, query, headers = await asyncio.wait_for(self._read_request(reader), timeout=10)
+            device_ids, snapshot = await self._open(method, path, query, headers)
+        except StreamError as e:
+            self._write_error(writer, e.status, e.detail)
+            await self._close(writer)
+            return
+        except (asyncio.TimeoutError, ValueError, ConnectionError):
+            writer.close()
+            return
+
+        queue = self.hub.subscribe(device_ids)
+        try:
+            writer.write(b'HTTP/1.1 200 OK\r\n'
+                         b'Content-Type: text/event-stream\r\n'
+                         b'Cache-Control: no-cache\r\n'
+                         b'Connection: keep-alive\r\n'
+                         b'Access-Control-Allow-Origin: *\r\n\r\n')
+            for message in snapshot:
+                writer.write(self._event(message))
+            await writer.drain()
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), timeout=self.keepalive)
+                    writer.write(self._event(message))
+                except asyncio.TimeoutError:
+                    writer.write(b': keepalive\n\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.hub.unsubscribe(device_ids, queue)
+            writer.close()
+
+    async def _read_request(self, reader):
+        request_line = (await reader.readline()).decode('latin-1').split()
+        if len(request_line) != 3:
+            raise ValueError('Malformed request line')
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1')
+            if line in ('\r\n', '\n', ''):
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+            if len(headers) > 100:
+                raise ValueError('Too many headers')
+        url = urlsplit(request_line[1])
+        return request_line[0], url.path, parse_qs(url.query), headers
+
+    async def _open(self, method, path, query, headers):
+        if method != 'GET':
+            raise StreamError(405, 'Method "%s" not allowed.' % method)
+        device_match = DEVICE_STREAM.match(path)
+        if device_match is None and USER_STREAM.match(path) is None:
+            raise StreamError(404, 'Not found.')
+
+        prefix = api_settings.JWT_AUTH_HEADER_PREFIX + ' '
+        authorization = headers.get('authorization', '')
+        if authorization.startswith(prefix):
+            token = authorization[len(prefix):]
+        else:
+            token = query.get('token', [None])[0]
+        if not token:
+            raise StreamError(401, 'Authentication credentials were not provided.')
+
+        d_pk = int(device_match.group('d_pk')) if device_match else None
+        user = await self.loop.run_in_executor(self.executor, authenticate, token)
+        return await self.loop.run_in_executor(self.executor, subscription_for, user, d_pk)
+
+    def _event(self, message):
+        return b'event: location\ndata: ' + json.dumps(message).encode('utf-8') + b'\n\n'
+
+    def _write_error(self, writer, status, detail):
+        body = json.dumps({'detail': detail}).encode('utf-8')
+        writer.write(('HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n'
+                      'Connection: close\r\n\r\n' % (status, REASONS[status], len(body))).encode('latin-1') + body)
+
+    async def _close(self, writer):
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    def serve_forever(self, host, port):
+        self.listen()
+        server = self.loop.run_until_complete(
+            asyncio.start_server(self.handle, host, port, backlog=settings.TOOPATH_STREAM_BACKLOG))
+        logger.info('Streaming live locations on %s:%s', host, port)
+        try:
+            self.loop.run_forever()
+        finally:
+            server.close()
+            self.loop.run_until_complete(server.wait_closed())
+            self.listen_connection.close()
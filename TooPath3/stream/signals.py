@@ -0,0 +1,30 @@
+import json
+
+from django.conf import settings
+from django.db import connection
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from TooPath3.models import ActualLocation
+
+
+def location_message(actual_location):
+    point = actual_location.point
+    return {
+        'device': actual_location.device_id,
+        'point': {'type': 'Point', 'coordinates': [point.x, point.y]} if point and not point.empty else None,
+        'updated_at': actual_location.updated_at.isoformat() if actual_location.updated_at else None,
+    }
+
+
+def notify_location(actual_location):
+    # NOTIFY is transactional: listeners only see the position once the save is committed.
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_notify(%s, %s)',
+                       [settings.TOOPATH_STREAM_CHANNEL, json.dumps(location_message(actual_location))])
+
+
+@receiver(post_save, sender=ActualLocation)
+def publish_actual_location(sender, instance, raw, **kwargs):
+    if settings.TOOPATH_STREAM_ENABLED and not raw:
+        notify_location(instance)
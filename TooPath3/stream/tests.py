@@ -0,0 +1,81 @@
+import asyncio
+from unittest import mock
+
+from django.contrib.gis.geos import Point
+from django.test import SimpleTestCase
+from rest_framework.test import APITestCase, APIClient
+
+from TooPath3.models import ActualLocation
+from TooPath3.stream.hub import Hub
+from TooPath3.stream.server import StreamError, subscription_for
+from TooPath3.stream.signals import location_message
+from TooPath3.utils import create_user_with_email, create_device_with_owner, generate_token_for_user
+
+
+class HubCase(SimpleTestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.hub = Hub(queue_size=2)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_publish_reaches_every_subscriber_of_the_device(self):
+        first = self.hub.subscribe([1])
+        second = self.hub.subscribe([1, 2])
+        self.assertEqual(2, self.hub.publish(1, {'device': 1}))
+        self.assertEqual({'device': 1}, first.get_nowait())
+        self.assertEqual({'device': 1}, second.get_nowait())
+
+    def test_publish_skips_subscribers_of_other_devices(self):
+        queue = self.hub.subscribe([1])
+        self.assertEqual(0, self.hub.publish(2, {'device': 2}))
+        self.assertTrue(queue.empty())
+
+    def test_slow_subscriber_keeps_the_latest_positions(self):
+        queue = self.hub.subscribe([1])
+        for n in range(3):
+            self.hub.publish(1, n)
+        self.assertEqual([1, 2], [queue.get_nowait(), queue.get_nowait()])
+
+    def test_unsubscribe_releases_the_device(self):
+        queue = self.hub.subscribe([1, 2])
+        self.hub.unsubscribe([1, 2], queue)
+        self.assertEqual(0, self.hub.subscriber_count())
+
+
+class PublishActualLocationCase(APITestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = create_user_with_email(email='user_test@gmail.com')
+        self.token = generate_token_for_user(user=self.user)
+        self.device = create_device_with_owner(owner=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION='JWT ' + self.token)
+
+    def test_notify_when_put_actual_location_is_done(self):
+        json_body = {'point': {'type': 'Point', 'coordinates': [10, 20]}}
+        with mock.patch('TooPath3.stream.signals.notify_location') as notify_location:
+            self.client.put(path='/devices/' + str(self.device.did) + '/actualLocation/', data=json_body,
+                            format='json')
+        self.assertEqual(self.device.did, notify_location.call_args[0][0].device_id)
+
+    def test_message_contains_device_and_coordinates(self):
+        actual_location = ActualLocation.objects.get(pk=self.device.did)
+        actual_location.point = Point(10, 20)
+        message = location_message(actual_location)
+        self.assertEqual(self.device.did, message['device'])
+        self.assertEqual([10, 20], message['point']['coordinates'])
+
+    def test_subscription_is_forbidden_when_user_is_not_the_device_owner(self):
+        owner = create_user_with_email(email='owner@gmail.com')
+        device = create_device_with_owner(owner=owner)
+        with self.assertRaises(StreamError) as context:
+            subscription_for(self.user, device.did)
+        self.assertEqual(403, context.exception.status)
+
+    def test_user_subscription_contains_every_owned_device(self):
+        device = create_device_with_owner(owner=self.user)
+        device_ids, snapshot = subscription_for(self.user)
+        self.assertEqual({self.device.did, device.did}, set(device_ids))
+        self.assertEqual(2, len(snapshot))
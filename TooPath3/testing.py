@@ -0,0 +1,119 @@
+from contextlib import ExitStack, contextmanager
+
+from django.contrib.gis.geos import Point
+from django.db import connections
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APITestCase, APIClient
+
+from TooPath3.conditional import points_changed
+from TooPath3.models import TrackLocation
+from TooPath3.utils import create_user_with_email, generate_token_for_user, create_device_with_owner, \
+    create_track_with_device, create_track_location_with_track
+
+
+def build_fixture(size, name):
+    """
+     A user with `size` devices. The first device has `size` tracks and its first track `size` points; every other
+     device has one track with one point. Returns the request context the routes are declared against.
+    """
+    user = create_user_with_email('%s@budget.test' % name)
+    devices = [create_device_with_owner(user) for n in range(size)]
+    tracks = [create_track_with_device(devices[0]) for n in range(size)]
+    TrackLocation.objects.bulk_create(TrackLocation(track=tracks[0], point=Point(44, 67)) for n in range(size - 1))
+    points_changed({tracks[0].pk: size - 1})
+    location = create_track_location_with_track(tracks[0])
+    for device in devices[1:]:
+        create_track_location_with_track(create_track_with_device(device))
+    return {'user': user, 'token': generate_token_for_user(user), 'device': devices[0], 'track': tracks[0],
+            'location': location}
+
+
+def device_path(suffix=''):
+    return lambda context: '/devices/%d/%s' % (context['device'].pk, suffix)
+
+
+def track_path(suffix=''):
+    return lambda context: '/devices/%d/tracks/%d/%s' % (context['device'].pk, context['track'].pk, suffix)
+
+
+def location_path(context):
+    return '/devices/%d/tracks/%d/locations/%d/' % (context['device'].pk, context['track'].pk, context['location'].pk)
+
+
+def user_path(context):
+    return '/users/%d/' % context['user'].pk
+
+
+def location_body(context):
+    return {'point': {'type': 'Point', 'coordinates': [41.38, 2.17]}}
+
+
+@contextmanager
+def captured_queries():
+    """
+     The SQL run inside the block on every database connection, as CaptureQueriesContext records it.
+    """
+    queries = []
+    with ExitStack() as stack:
+        contexts = [stack.enter_context(CaptureQueriesContext(connection)) for connection in connections.all()]
+        yield queries
+    for context in contexts:
+        queries.extend(query['sql'] for query in context.captured_queries)
+
+
+class Route(object):
+    """
+     A request whose number of queries must not depend on the amount of data behind it. `setup` receives the
+     fixture's context and may replace what the request consumes, like the device a DELETE removes.
+    """
+
+    def __init__(self, name, method, path, body=None, setup=None, budget=None):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.body = body
+        self.setup = setup
+        self.budget = budget
+
+    def __str__(self):
+        return '%s %s' % (self.method, self.name)
+
+
+class QueryBudgetTestCase(APITestCase):
+    """
+     Calls every route of `routes` against fixtures of increasing size and fails, listing the SQL, when its number
+     of queries grows with the data or goes over its budget.
+    """
+    sizes = (1, 10, 100)
+    routes = ()
+
+    def test_queries_do_not_grow_with_the_data(self):
+        for n, route in enumerate(self.routes):
+            with self.subTest(route=str(route)):
+                self.assertConstantQueries(route, 'route%d' % n)
+
+    def assertConstantQueries(self, route, name):
+        measured = []
+        for size in self.sizes:
+            context = build_fixture(size, '%s-%d' % (name, size))
+            if route.setup is not None:
+                route.setup(context)
+            client = APIClient()
+            client.credentials(HTTP_AUTHORIZATION='JWT ' + context['token'])
+            body = route.body(context) if route.body else None
+            with captured_queries() as queries:
+                response = getattr(client, route.method.lower())(route.path(context), data=body, format='json')
+            self.assertLess(response.status_code, 400, '%s answered %d' % (route, response.status_code))
+            measured.append((size, queries))
+
+        counts = [len(queries) for size, queries in measured]
+        if len(set(counts)) > 1:
+            self.fail(self.query_report('%s runs more queries as the data grows: %s' % (
+                route, ', '.join('%d with size %d' % (len(queries), size) for size, queries in measured)), measured))
+        if route.budget is not None and counts[-1] > route.budget:
+            self.fail(self.query_report('%s runs %d queries, over its budget of %d' % (
+                route, counts[-1], route.budget), measured))
+
+    def query_report(self, message, measured):
+        size, queries = measured[-1]
+        return '\n'.join([message, 'Queries with size %d:' % size] + ['  %s' % sql for sql in queries])
@@ -0,0 +1,392 @@
+import datetime
+import decimal
+import io
+import json
+import tempfile
+import time
+import uuid
+from collections import OrderedDict
+from unittest import mock
+from urllib.parse import urlencode
+
+import jwt
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from django.conf.urls import url
+from django.core.cache import caches
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import SimpleTestCase, RequestFactory, override_settings
+from django.utils import timezone
+from django.utils.translation import ugettext_lazy
+from jwt.algorithms import RSAAlgorithm
+from rest_framework.exceptions import ParseError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from rest_framework.test import APITestCase, APIClient
+from rest_framework.views import APIView
+from rest_framework_jwt.authentication import JSONWebTokenAuthentication
+
+from TooPath3.jobs import handler, handlers, enqueue, run_pending
+from TooPath3.metrics import registry, merge, render, query_stats
+from TooPath3.middleware import ReplicaRoutingMiddleware
+from TooPath3.models import CustomUser, Device, Track, TrackLocation, Job
+from TooPath3.proximity import live_positions
+from TooPath3.renderers import FastJSONRenderer, FastJSONParser
+from TooPath3.routers import ReplicaRouter, choose_replica, reading_from
+from TooPath3.users import google
+from TooPath3.testing import QueryBudgetTestCase, Route, captured_queries, device_path, track_path, location_path, \
+    user_path, location_body
+from TooPath3.utils import create_user_with_email, generate_token_for_user, create_various_devices_with_owner, \
+    create_device_with_owner, create_track_with_device, create_track_location_with_track
+
+
+class ReplicaRouterCase(SimpleTestCase):
+    def setUp(self):
+        self.router = ReplicaRouter()
+
+    def test_read_from_primary_by_default(self):
+        self.assertEqual('default', self.router.db_for_read(Device))
+
+    def test_read_from_the_replica_chosen_for_the_request(self):
+        with reading_from('replica_0'):
+            self.assertEqual('replica_0', self.router.db_for_read(Device))
+        self.assertEqual('default', self.router.db_for_read(Device))
+
+    def test_write_to_primary_while_reading_from_replica(self):
+        with reading_from('replica_0'):
+            self.assertEqual('default', self.router.db_for_write(Device))
+
+    @mock.patch('TooPath3.routers.replica_aliases', return_value=['replica_check'])
+    def test_a_persistent_connection_is_not_checked_on_every_request(self, *mocks):
+        connection = mock.Mock()
+        with mock.patch('TooPath3.routers.connections', {'replica_check': connection}):
+            self.assertEqual('replica_check', choose_replica())
+            self.assertEqual('replica_check', choose_replica())
+            self.assertEqual(1, connection.is_usable.call_count)
+            with mock.patch('TooPath3.routers.time.time', return_value=time.time() + 11):
+                choose_replica()
+            self.assertEqual(2, connection.is_usable.call_count)
+
+
+@mock.patch('TooPath3.middleware.replica_aliases', return_value=['replica_0'])
+@mock.patch('TooPath3.middleware.choose_replica', return_value='replica_0')
+class ReplicaRoutingMiddlewareCase(SimpleTestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.router = ReplicaRouter()
+        self.user = mock.Mock(pk=42, is_authenticated=True)
+        caches['pins'].clear()
+
+    def _call(self, request):
+        seen = {}
+
+        def get_response(request):
+            seen['alias'] = self.router.db_for_read(Device)
+            return HttpResponse()
+
+        response = ReplicaRoutingMiddleware(get_response)(request)
+        return seen['alias'], response
+
+    def test_safe_request_reads_from_replica(self, *mocks):
+        alias, response = self._call(self.factory.get('/devices/'))
+        self.assertEqual('replica_0', alias)
+
+    def test_write_request_reads_from_primary_and_pins_the_user(self, *mocks):
+        request = self.factory.post('/devices/')
+        request.user = self.user
+        alias, response = self._call(request)
+        self.assertEqual('default', alias)
+        self.assertIn('toopath_primary', response.cookies)
+        self.assertTrue(caches['pins'].get('replica-pin:42'))
+
+    def test_safe_request_after_own_write_reads_from_primary(self, *mocks):
+        caches['pins'].set('replica-pin:42', True, 5)
+        with mock.patch('TooPath3.middleware.jwt_user_id', return_value=42):
+            alias, response = self._call(self.factory.get('/devices/'))
+        self.assertEqual('default', alias)
+
+    def test_safe_request_with_pin_cookie_reads_from_primary(self, *mocks):
+        request = self.factory.get('/devices/')
+        request.COOKIES['toopath_primary'] = '1'
+        alias, response = self._call(request)
+        self.assertEqual('default', alias)
+
+    def test_a_streamed_body_reads_from_the_replica_of_its_request(self, *mocks):
+        def get_response(request):
+            return StreamingHttpResponse(self.router.db_for_read(Device).encode('utf-8') for n in range(2))
+
+        response = ReplicaRoutingMiddleware(get_response)(self.factory.get('/devices/'))
+        self.assertEqual(b'replica_0replica_0', b''.join(response.streaming_content))
+        self.assertEqual('default', self.router.db_for_read(Device))
+
+
+class MetricsRenderCase(SimpleTestCase):
+    def test_counters_of_every_worker_are_added_up(self):
+        snapshot = {'types': {'toopath_requests_total': 'counter'},
+                    'values': [['toopath_requests_total', [['endpoint', 'device-list']], 2]]}
+        types, values = merge([snapshot, snapshot])
+        self.assertIn('toopath_requests_total{endpoint="device-list"} 4.0', render(types, values))
+
+    def test_histogram_buckets_are_cumulative(self):
+        snapshot = {'types': {'latency': 'histogram'},
+                    'values': [['latency', [], {'buckets': [0.1, 1.0], 'counts': [1, 2], 'sum': 0.6, 'count': 2}]]}
+        text = render(*merge([snapshot]))
+        self.assertIn('latency_bucket{le="0.1"} 1', text)
+        self.assertIn('latency_bucket{le="+Inf"} 2', text)
+        self.assertIn('latency_count 2', text)
+
+
+@override_settings(TOOPATH_METRICS_DIR=tempfile.mkdtemp())
+class MetricsEndpointCase(APITestCase):
+    def setUp(self):
+        registry.clear()
+        self.client = APIClient()
+        self.user = create_user_with_email('metrics@gmail.com')
+        self.client.credentials(HTTP_AUTHORIZATION='JWT ' + generate_token_for_user(self.user))
+
+    def test_requests_are_recorded_per_url_pattern_and_method(self):
+        create_various_devices_with_owner(self.user)
+        self.client.get(path='/devices/')
+        response = self.client.get(path='/metrics/')
+        text = response.content.decode('utf-8')
+        self.assertIn('toopath_requests_total{endpoint="device-list",method="GET",status="200"} 1.0', text)
+        self.assertIn('toopath_serialized_objects_total{endpoint="device-list",method="GET"} 5.0', text)
+        self.assertIn('toopath_request_queries_count{endpoint="device-list",method="GET"} 1', text)
+
+    def test_query_stats_count_the_sql_of_the_block(self):
+        with query_stats() as stats:
+            list(Device.objects.all())
+            list(Device.objects.all())
+        self.assertEqual(2, stats.count)
+
+    def test_query_stats_count_every_request_alike(self):
+        counts = []
+        for attempt in range(4):
+            with query_stats() as stats:
+                self.client.get(path='/users/%d/' % self.user.pk)
+            counts.append(stats.count)
+        self.assertGreater(counts[0], 0)
+        self.assertEqual([counts[0]] * 4, counts)
+
+    @override_settings(TOOPATH_COMPRESSION_MIN_BYTES=0)
+    def test_the_queries_of_a_streamed_response_are_recorded_once_it_is_sent(self):
+        create_various_devices_with_owner(self.user)
+        with captured_queries() as queries:
+            response = self.client.get(path='/devices/', HTTP_ACCEPT_ENCODING='gzip')
+            self.assertTrue(response.streaming)
+            b''.join(response.streaming_content)
+        text = self.client.get(path='/metrics/').content.decode('utf-8')
+        self.assertIn('toopath_request_queries_sum{endpoint="device-list",method="GET"} %r' % float(len(queries)),
+                      text)
+
+    def test_metrics_are_only_served_to_loopback_by_default(self):
+        self.assertEqual(200, self.client.get(path='/metrics/').status_code)
+        self.assertEqual(403, self.client.get(path='/metrics/', REMOTE_ADDR='203.0.113.7').status_code)
+
+    @override_settings(TOOPATH_METRICS_ENABLED=False)
+    def test_requests_are_not_recorded_when_metrics_are_off(self):
+        self.client.get(path='/users/%d/' % self.user.pk)
+        self.assertNotIn('toopath_requests_total', [name for name, labels in registry.values])
+
+
+def with_password(context):
+    context['user'].set_password('budget')
+    context['user'].save()
+
+
+def new_user_email(context):
+    context['email'] = 'new-' + context['user'].email
+
+
+def sync_batch(context):
+    return {'locations': [dict(location_body(context), seq=seq) for seq in range(10)]}
+
+
+def google_token(context):
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+    jwk = json.loads(RSAAlgorithm.to_jwk(private_key.public_key()))
+    jwk['kid'] = 'budget-key'
+    google.google_keys.load({'keys': [jwk]}, max_age=3600)
+    claims = {'iss': 'https://accounts.google.com', 'aud': 'budget-client', 'email': context['user'].email,
+              'email_verified': True, 'exp': int(time.time()) + 600, 'iat': int(time.time())}
+    context['google_token'] = jwt.encode(claims, private_key, algorithm='RS256',
+                                         headers={'kid': 'budget-key'}).decode('utf-8')
+
+
+def warm_positions(context):
+    # The index is built by the first request of the process and polled afterwards, neither of which is measured.
+    live_positions.reconcile()
+
+
+@override_settings(TOOPATH_GOOGLE_CLIENT_IDS=['budget-client'])
+class QueryBudgetCase(QueryBudgetTestCase):
+    routes = (
+        Route('device-list', 'GET', lambda c: '/devices/'),
+        Route('device-list', 'POST', lambda c: '/devices/', body=lambda c: {'name': 'budget'}),
+        Route('device-detail', 'GET', device_path()),
+        Route('device-detail', 'PATCH', device_path(), body=lambda c: {'description': 'budget'}),
+        Route('device-detail', 'PUT', device_path(), body=lambda c: {'name': 'budget'}),
+        Route('device-detail', 'DELETE', device_path()),
+        Route('device-nearby', 'GET', lambda c: '/devices/nearby/?point=44,67&radius=1000', setup=warm_positions),
+        Route('device-clusters', 'GET', lambda c: '/devices/clusters/?bbox=-10,-10,10,10&zoom=5',
+              setup=warm_positions),
+        Route('device-actual-location', 'GET', device_path('actualLocation/')),
+        Route('device-actual-location', 'PUT', device_path('actualLocation/'), body=location_body),
+        Route('track-list', 'GET', device_path('tracks/')),
+        Route('track-list', 'POST', device_path('tracks/'), body=lambda c: {'name': 'budget'}),
+        Route('track-detail', 'GET', track_path()),
+        Route('track-detail', 'PATCH', track_path(), body=lambda c: {'description': 'budget'}),
+        Route('track-detail', 'PUT', track_path(), body=lambda c: {'name': 'budget', 'device': c['device'].pk}),
+        Route('track-detail', 'DELETE', track_path()),
+        Route('track-nearest', 'GET', lambda c: track_path('nearest/')(c) + '?point=44,67&k=5'),
+        Route('track-position', 'GET', lambda c: track_path('position/')(c) + '?' + urlencode(
+            {'at': timezone.now().isoformat()})),
+        Route('track-stops', 'GET', track_path('stops/')),
+        Route('track-location-list', 'GET', track_path('locations/')),
+        Route('track-location-list', 'POST', track_path('locations/'), body=location_body),
+        Route('track-sync', 'GET', track_path('sync/')),
+        Route('track-sync', 'POST', track_path('sync/'), body=sync_batch),
+        Route('track-location-detail', 'DELETE', location_path),
+        Route('user-detail', 'GET', user_path),
+        Route('user-detail', 'PATCH', user_path, body=lambda c: {'first_name': 'budget'}),
+        Route('user-detail', 'PUT', user_path,
+              body=lambda c: {'username': c['user'].username, 'email': c['user'].email, 'password': 'budget'}),
+        Route('user-detail', 'DELETE', user_path),
+        Route('user-list', 'POST', lambda c: '/users/', setup=new_user_email,
+              body=lambda c: {'username': c['email'].split('@')[0], 'email': c['email'], 'password': 'budget'}),
+        Route('login', 'POST', lambda c: '/login/', setup=with_password,
+              body=lambda c: {'email': c['user'].email, 'password': 'budget'}),
+        Route('login-google', 'POST', lambda c: '/login-google/', setup=google_token,
+              body=lambda c: {'email': c['user'].email, 'google_token': c['google_token'], 'name': 'Budget'}),
+        Route('api-token-refresh', 'POST', lambda c: '/api-token-refresh/', body=lambda c: {'token': c['token']}),
+        Route('api-token-verify', 'POST', lambda c: '/api-token-verify/', body=lambda c: {'token': c['token']}),
+        Route('metrics', 'GET', lambda c: '/metrics/'),
+    )
+
+
+class TrackCountsWithAQueryPerDevice(APIView):
+    authentication_classes = (JSONWebTokenAuthentication,)
+
+    def get(self, request):
+        return Response([device.tracks.count() for device in Device.objects.filter(owner=request.user)])
+
+
+class AuthenticatedUser(APIView):
+    authentication_classes = (JSONWebTokenAuthentication,)
+
+    def get(self, request):
+        return Response(request.user.pk)
+
+
+urlpatterns = [url(r'^n-plus-one/$', TrackCountsWithAQueryPerDevice.as_view()),
+               url(r'^user/$', AuthenticatedUser.as_view())]
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class QueryBudgetHarnessCase(QueryBudgetTestCase):
+    sizes = (1, 5)
+
+    def test_a_query_per_row_is_caught(self):
+        with self.assertRaisesRegex(self.failureException, 'runs more queries as the data grows'):
+            self.assertConstantQueries(Route('n-plus-one', 'GET', lambda c: '/n-plus-one/'), 'n-plus-one')
+
+    def test_a_route_over_its_budget_is_caught(self):
+        with self.assertRaisesRegex(self.failureException, 'over its budget of 0'):
+            self.assertConstantQueries(Route('user', 'GET', lambda c: '/user/', budget=0), 'budget')
+
+
+class FastJSONCase(SimpleTestCase):
+    data = OrderedDict([
+        ('updated_at', datetime.datetime(2017, 11, 24, 12, 8, 1, 123456, tzinfo=timezone.utc)),
+        ('jwt_secret', uuid.UUID('6f1c27c2-6a38-4b8e-9d4e-3f0d3f1b5b1e')),
+        ('distance', decimal.Decimal('12.5')),
+        ('detail', ugettext_lazy('Not found.')),
+        ('name', 'caf\u00e9 \u2028'),
+        ('locations', [OrderedDict([('id', 1), ('point', None)])]),
+    ])
+
+    def test_renders_what_drf_renders(self):
+        self.assertEqual(JSONRenderer().render(self.data), FastJSONRenderer().render(self.data))
+
+    def test_renders_floats_as_drf_does(self):
+        data = OrderedDict([('coordinates', [1e16, -2.5e-07, 1e+308, 41.38, 0.0001, 0.0]), ('count', 2 ** 70)])
+        self.assertEqual(b'{"coordinates":[1e+16,-2.5e-07,1e+308,41.38,0.0001,0.0],"count":1180591620717411303424}',
+                         FastJSONRenderer().render(data))
+        self.assertEqual(JSONRenderer().render(data), FastJSONRenderer().render(data))
+
+    def test_refuses_nan_and_infinity_as_drf_does(self):
+        for value in (float('nan'), float('inf'), float('-inf')):
+            with self.subTest(value=value):
+                with self.assertRaises(ValueError):
+                    JSONRenderer().render({'distance': value})
+                with self.assertRaises(ValueError):
+                    FastJSONRenderer().render({'distance': value})
+
+    def test_falls_back_to_drf_without_orjson(self):
+        with mock.patch('TooPath3.renderers.orjson', None):
+            self.assertEqual(JSONRenderer().render(self.data), FastJSONRenderer().render(self.data))
+
+    def test_parses_json_bodies(self):
+        parsed = FastJSONParser().parse(io.BytesIO(b'{"point": {"type": "Point", "coordinates": [2.17, 41.38]}}'))
+        self.assertEqual([2.17, 41.38], parsed['point']['coordinates'])
+        with self.assertRaises(ParseError):
+            FastJSONParser().parse(io.BytesIO(b'{"point": '))
+
+
+@override_settings(TOOPATH_JOBS_PURGE_BATCH=2)
+class JobsCase(APITestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = create_user_with_email('jobs@gmail.com')
+        self.device = create_device_with_owner(self.user)
+        self.track = create_track_with_device(self.device)
+        for i in range(5):
+            create_track_location_with_track(self.track)
+        self.track_path = '/devices/%d/tracks/%d/' % (self.device.pk, self.track.pk)
+        self.client.credentials(HTTP_AUTHORIZATION='JWT ' + generate_token_for_user(self.user))
+
+    def tearDown(self):
+        handlers.pop('fails_once', None)
+
+    def test_a_deleted_track_is_hidden_until_purged(self):
+        self.assertEqual(204, self.client.delete(path=self.track_path).status_code)
+        self.assertEqual(404, self.client.get(path=self.track_path).status_code)
+        self.assertEqual(5, TrackLocation.objects.filter(track=self.track).count())
+        self.assertEqual(1, run_pending())
+        self.assertFalse(Track.objects.filter(pk=self.track.pk).exists())
+        self.assertFalse(TrackLocation.objects.filter(track_id=self.track.pk).exists())
+        self.assertEqual(Job.DONE, Job.objects.get().status)
+
+    def test_a_deleted_device_hides_its_tracks(self):
+        self.assertEqual(204, self.client.delete(path='/devices/%d/' % self.device.pk).status_code)
+        self.assertEqual(404, self.client.get(path=self.track_path).status_code)
+        self.assertEqual([], self.client.get(path='/devices/').data)
+        run_pending()
+        self.assertFalse(Device.objects.filter(pk=self.device.pk).exists())
+
+    def test_a_deleted_user_is_deactivated_then_purged(self):
+        self.assertEqual(204, self.client.delete(path='/users/%d/' % self.user.pk).status_code)
+        self.assertFalse(CustomUser.objects.get(pk=self.user.pk).is_active)
+        run_pending()
+        self.assertFalse(CustomUser.objects.filter(pk=self.user.pk).exists())
+        self.assertFalse(TrackLocation.objects.exists())
+
+    def test_a_failed_job_is_retried_later(self):
+        calls = []
+
+        @handler('fails_once')
+        def fails_once():
+            calls.append(1)
+            if len(calls) == 1:
+                raise RuntimeError('first attempt')
+
+        job = enqueue('fails_once')
+        run_pending()
+        job.refresh_from_db()
+        self.assertEqual((Job.QUEUED, 1), (job.status, job.attempts))
+        self.assertIn('first attempt', job.error)
+        Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+        run_pending()
+        job.refresh_from_db()
+        self.assertEqual((Job.DONE, 2), (job.status, job.attempts))
@@ -0,0 +1,151 @@
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.throttling import BaseThrottle
+
+from TooPath3.metrics import registry
+from TooPath3.models import Device
+
+# A bucket: its key's hash, the tokens left and when they were counted.
+SLOT = struct.Struct('<Qdd')
+WAYS = 4
+DEVICE_TYPE_SECONDS = 300
+
+
+class BucketTable(object):
+    """
+     Token buckets in a file every worker of the host maps in memory. A key hashes to a set of `WAYS` slots, locked
+     with fcntl while its bucket is refilled and taken from; a key without a slot takes the least recently used one
+     of its set, so a check costs the same however many keys there are.
+    """
+
+    def __init__(self, path, slots):
+        self.sets = max(1, slots // WAYS)
+        size = self.sets * WAYS * SLOT.size
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # The layout depends on the number of slots, so a resized table gets a file of its own.
+        self.fd = os.open('%s.%d' % (path, self.sets), os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+        # fcntl locks are held by the process, which leaves the threads of a worker to this one.
+        self.lock = threading.Lock()
+
+    def take(self, key, burst, rate, now=None):
+        """
+         Takes a token from the bucket of `key`, holding up to `burst` tokens and refilled with `rate` a second.
+         Returns 0 when it had one, otherwise the seconds until it will.
+        """
+        return self.take_all([(key, burst, rate)], now)[0]
+
+    def take_all(self, buckets, now=None):
+        """
+         Takes a token from every bucket of `buckets`, (key, burst, rate) tuples like the arguments of `take`, or from
+         none of them when one is empty. Returns what `take` would for each bucket.
+        """
+        now = time.time() if now is None else now
+        buckets = [(self._digest(key), burst, rate) for key, burst, rate in buckets]
+        # Locked in file order, so workers taking from the same sets never wait on each other.
+        starts = sorted(set(self._start(digest) for digest, burst, rate in buckets))
+        with self.lock:
+            for start in starts:
+                fcntl.lockf(self.fd, fcntl.LOCK_EX, WAYS * SLOT.size, start)
+            try:
+                # Refilled first and written back at once, so a later bucket of the same set finds the slot taken.
+                refilled = [self._refill(digest, burst, rate, now) for digest, burst, rate in buckets]
+                waits = [0.0 if tokens >= 1 else (1 - tokens) / rate
+                         for (digest, burst, rate), (offset, tokens) in zip(buckets, refilled)]
+                if not any(waits):
+                    for (digest, burst, rate), (offset, tokens) in zip(buckets, refilled):
+                        SLOT.pack_into(self.map, offset, digest, tokens - 1, now)
+            finally:
+                for start in reversed(starts):
+                    fcntl.lockf(self.fd, fcntl.LOCK_UN, WAYS * SLOT.size, start)
+        return waits
+
+    def _digest(self, key):
+        return struct.unpack('<Q', hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest())[0] or 1
+
+    def _start(self, digest):
+        return (digest % self.sets) * WAYS * SLOT.size
+
+    def _refill(self, digest, burst, rate, now):
+        """
+         Refills the bucket of `digest` up to `now`, in its slot or in the least recently used one of its set, and
+         returns the offset of the slot and its tokens.
+        """
+        start = self._start(digest)
+        slots = [SLOT.unpack_from(self.map, start + way * SLOT.size) for way in range(WAYS)]
+        way = next((way for way, slot in enumerate(slots) if slot[0] == digest), None)
+        if way is None:
+            way = min(range(WAYS), key=lambda way: slots[way][2])
+            tokens = burst
+        else:
+            tokens = min(burst, slots[way][1] + max(0.0, now - slots[way][2]) * rate)
+        SLOT.pack_into(self.map, start + way * SLOT.size, digest, tokens, now)
+        return start + way * SLOT.size, tokens
+
+
+_table = None
+_table_key = None
+
+
+def get_table():
+    global _table, _table_key
+    # A forked worker maps the file again rather than sharing its parent's locks.
+    key = (os.getpid(), settings.TOOPATH_THROTTLE_FILE, settings.TOOPATH_THROTTLE_SLOTS)
+    if _table is None or _table_key != key:
+        _table = BucketTable(settings.TOOPATH_THROTTLE_FILE, settings.TOOPATH_THROTTLE_SLOTS)
+        _table_key = key
+    return _table
+
+
+def device_type(d_pk):
+    # Kept in this worker's cache rather than in the bucket, so a changed type applies within minutes.
+    key = 'throttle:device-type:%s' % d_pk
+    value = caches['default'].get(key)
+    if value is None:
+        value = Device.objects.filter(pk=d_pk).values_list('device_type', flat=True).first() or ''
+        caches['default'].set(key, value, DEVICE_TYPE_SECONDS)
+    return value
+
+
+class LocationWriteThrottle(BaseThrottle):
+    """
+     Rate limits the writes of the location endpoints with a token bucket per device, sized by its `device_type`,
+     and one per user for all their devices. Devices are counted per user, so posting to somebody else's device,
+     which is forbidden anyway, can't use up its bucket. Rejected requests get a 429 with Retry-After.
+    """
+
+    def allow_request(self, request, view):
+        self.retry_after = None
+        if not settings.TOOPATH_THROTTLE_ENABLED or request.method in SAFE_METHODS:
+            return True
+        d_pk = view.kwargs['d_pk']
+        kind = device_type(d_pk)
+        burst, rate = settings.TOOPATH_THROTTLE_DEVICE_RATES.get(kind, settings.TOOPATH_THROTTLE_DEFAULT_DEVICE_RATE)
+        table = get_table()
+        device_key, user_key = 'device:%s:%s' % (request.user.pk, d_pk), 'user:%s' % request.user.pk
+        # Both buckets are checked before either is taken from, so a request the user's bucket refuses costs the
+        # device's nothing.
+        device_wait, user_wait = table.take_all([(device_key, burst, rate),
+                                                 (user_key,) + tuple(settings.TOOPATH_THROTTLE_USER_RATE)])
+        wait = max(device_wait, user_wait)
+        scope = 'device' if device_wait else 'user' if user_wait else 'none'
+        registry.inc('toopath_throttle_decisions_total', (('decision', 'throttled' if wait else 'allowed'),
+                                                           ('device_type', kind), ('scope', scope)))
+        if wait:
+            self.retry_after = wait
+            return False
+        return True
+
+    def wait(self):
+        return self.retry_after
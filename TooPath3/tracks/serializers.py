@@ -1,16 +1,30 @@
 from rest_framework import serializers
+from rest_framework_gis.serializers import GeoFeatureModelListSerializer, GeoFeatureModelSerializer
 
+from TooPath3.archive import track_locations
 from TooPath3.constants import DEFAULT_ERROR_MESSAGES
+from TooPath3.fieldsets import SparseFieldsetMixin
 from TooPath3.locations.serializers import TrackLocationSerializer
-from TooPath3.models import Track
+from TooPath3.models import Stop, Track
 
 
-class TrackSerializer(serializers.ModelSerializer):
-    locations = TrackLocationSerializer(many=True, read_only=True)
+class TrackLocationsSerializer(GeoFeatureModelListSerializer):
+    """
+     The locations of a track, with the archived ones read back from its archive.
+    """
+
+    def get_attribute(self, instance):
+        return track_locations(instance)
+
+
+class TrackSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    locations = TrackLocationsSerializer(child=TrackLocationSerializer(), read_only=True)
+    column_dependencies = {'locations': ('archived_points', 'packed')}
 
     class Meta:
         model = Track
-        fields = '__all__'
+        exclude = ('packed', 'stops_checked_at', 'points', 'points_updated_at')
+        read_only_fields = ('trash', 'archived_points')
 
     def validate(self, data):
         if self.partial is True:
@@ -19,3 +33,10 @@ class TrackSerializer(serializers.ModelSerializer):
             if bool(data) is False:
                 raise serializers.ValidationError(DEFAULT_ERROR_MESSAGES['patch_track_fields_required'])
         return data
+
+
+class StopSerializer(GeoFeatureModelSerializer):
+    class Meta:
+        model = Stop
+        geo_field = 'point'
+        fields = '__all__'
@@ -1,11 +1,34 @@
+import datetime
+import json
+import os
+import tempfile
+import zlib
+from unittest import mock
+
+import numpy as np
+from django.contrib.gis.geos import Point
+from django.db import connection
+from django.test import SimpleTestCase, RequestFactory, override_settings
+from django.utils import timezone
 from rest_framework.status import *
-from rest_framework.test import APITestCase, APIClient
+from rest_framework.test import APITestCase, APITransactionTestCase, APIClient
 
+from TooPath3.archive import archive_path, archive_track, cold_tracks, pack_track, read_archive, write_archive
+from TooPath3.caching import get_versions, version_key
+from TooPath3.compression import accepted_encoding
+from TooPath3.ingest import replay
 from TooPath3.constants import DEFAULT_ERROR_MESSAGES
-from TooPath3.models import Track
+from TooPath3.jobs import run_pending
+from TooPath3.metrics import registry, query_stats
+from TooPath3.models import Track, TrackLocation
+from TooPath3.packing import pack, unpack, decode_varints, encode_varints
+from TooPath3.playback import Timeline
+from TooPath3.stops import detect_stops, distances, find_stops, unchecked_tracks
+from TooPath3.testing import captured_queries
 from TooPath3.tracks.serializers import TrackSerializer
 from TooPath3.utils import generate_token_for_user, create_user_with_email, create_device_with_owner, \
-    create_track_with_device, get_latest_id_inserted, create_various_track_locations_with_track
+    create_track_with_device, get_latest_id_inserted, create_various_track_locations_with_track, \
+    create_track_location_with_track, create_various_devices_with_owner
 
 
 class GetTrackCase(APITestCase):
@@ -43,6 +66,13 @@ class GetTrackCase(APITestCase):
         response = self.client.get('/devices/' + str(device.did) + '/tracks/' + str(track.tid) + '/')
         self.assertEqual(TrackSerializer(track).data, response.data)
 
+    def test_return_only_the_fields_asked_for(self):
+        device = create_device_with_owner(self.user)
+        track = create_track_with_device(device)
+        create_various_track_locations_with_track(track)
+        response = self.client.get('/devices/' + str(device.did) + '/tracks/' + str(track.tid) + '/?fields=name')
+        self.assertEqual({'name': track.name}, response.data)
+
 
 class PatchTrackCase(APITestCase):
     def setUp(self):
@@ -286,3 +316,480 @@ class PostTracksCase(APITestCase):
                                     {"name": "test_track", "description": "this is a description"})
         track_created = Track.objects.get(pk=get_latest_id_inserted(Track))
         self.assertEqual(TrackSerializer(track_created).data, response.data)
+
+
+class TimedLocationsTestCase(APITestCase):
+    """
+     A track whose points are 10 seconds and over a thousand kilometers apart, an hour ago.
+    """
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = create_user_with_email('playback@gmail.com')
+        self.client.credentials(HTTP_AUTHORIZATION='JWT ' + generate_token_for_user(self.user))
+        self.device = create_device_with_owner(self.user)
+        self.track = create_track_with_device(self.device)
+        self.start = timezone.now().replace(microsecond=0) - datetime.timedelta(hours=1)
+        for seconds, x, y in ((0, 0.0, 0.0), (10, 10.0, 0.0), (20, 10.0, 10.0)):
+            self.add_location(seconds, x, y)
+
+    def add_location(self, seconds, x, y):
+        location = TrackLocation.objects.create(point=Point(x, y, srid=4326), track=self.track)
+        TrackLocation.objects.filter(pk=location.pk).update(
+            created_at=self.start + datetime.timedelta(seconds=seconds))
+
+
+class TrackPositionCase(TimedLocationsTestCase):
+    def setUp(self):
+        super(TrackPositionCase, self).setUp()
+        self.path = '/devices/%d/tracks/%d/position/' % (self.device.did, self.track.tid)
+
+    def at(self, seconds):
+        return (self.start + datetime.timedelta(seconds=seconds)).isoformat()
+
+    def test_return_the_position_interpolated_between_points(self):
+        response = self.client.get(self.path, {'at': self.at(5)})
+        self.assertEqual(HTTP_200_OK, response.status_code)
+        self.assertEqual([5.0, 0.0], response.data['point']['coordinates'])
+
+    def test_return_a_position_per_time(self):
+        response = self.client.get(self.path, {'times': ','.join(self.at(s) for s in (-1, 15, 20))})
+        self.assertEqual([None, [10.0, 5.0], [10.0, 10.0]],
+                         [position['point'] and position['point']['coordinates'] for position in response.data])
+
+    def test_new_points_are_played_back(self):
+        self.client.get(self.path, {'at': self.at(5)})
+        self.add_location(30, 10.0, 20.0)
+        response = self.client.get(self.path, {'at': self.at(25)})
+        self.assertEqual([10.0, 15.0], response.data['point']['coordinates'])
+
+    def test_return_400_status_when_no_time_is_given(self):
+        response = self.client.get(self.path)
+        self.assertEqual(HTTP_400_BAD_REQUEST, response.status_code)
+        self.assertEqual([DEFAULT_ERROR_MESSAGES['playback_time_required']], response.data['non_field_errors'])
+
+
+class TrackStopsCase(TimedLocationsTestCase):
+    def setUp(self):
+        super(TrackStopsCase, self).setUp()
+        self.path = '/devices/%d/tracks/%d/stops/' % (self.device.did, self.track.tid)
+
+    def stay(self, start, minutes, x, y):
+        for minute in range(minutes + 1):
+            self.add_location(start + minute * 60, x + minute * 0.00001, y)
+
+    def stops(self):
+        response = self.client.get(self.path)
+        self.assertEqual(HTTP_200_OK, response.status_code)
+        return [(feature['properties']['points'], feature['properties']['duration'])
+                for feature in response.data['features']]
+
+    def test_return_the_stays_longer_than_the_minimum(self):
+        self.stay(100, 10, 2.0, 41.0)
+        self.stay(800, 3, 3.0, 41.0)
+        self.stay(1200, 6, 4.0, 41.0)
+        detect_stops(self.track.tid)
+        self.assertEqual([(11, 600.0), (7, 360.0)], self.stops())
+
+    def test_new_points_extend_the_last_stop(self):
+        self.stay(100, 6, 2.0, 41.0)
+        detect_stops(self.track.tid)
+        self.assertEqual([], list(unchecked_tracks()))
+        self.add_location(100 + 7 * 60, 2.00007, 41.0)
+        self.assertEqual([self.track.tid], list(unchecked_tracks()))
+        detect_stops(self.track.tid)
+        self.assertEqual([(8, 420.0)], self.stops())
+
+    def test_a_point_replayed_late_from_the_ingestion_log_detects_the_stops_again(self):
+        self.stay(100, 6, 2.0, 41.0)
+        detect_stops(self.track.tid)
+        # Logged before the stops were detected, replayed after.
+        logged_at = self.start + datetime.timedelta(seconds=100 + 7 * 60)
+        replay('0-late.wal', [{'kind': 'track', 'track': self.track.tid, 'at': logged_at.timestamp(),
+                               'point': bytes(Point(2.00007, 41.0, srid=4326).ewkb).hex()}], 0)
+        self.assertEqual([self.track.tid], list(unchecked_tracks()))
+
+    def test_deleting_a_point_detects_the_stops_again(self):
+        self.stay(100, 6, 2.0, 41.0)
+        detect_stops(self.track.tid)
+        location = TrackLocation.objects.filter(track=self.track).order_by('-created_at').first()
+        self.client.delete('/devices/%d/tracks/%d/locations/%d/' % (self.device.did, self.track.tid, location.pk))
+        detect_stops(self.track.tid)
+        self.assertEqual([(6, 300.0)], self.stops())
+
+    def test_a_long_stop_is_not_compared_point_by_point(self):
+        count = 20000
+        timeline = Timeline(np.arange(count) * 10 ** 6, np.full(count, 2.0), np.full(count, 41.0))
+        compared = []
+
+        def counted(*points):
+            compared.append(np.size(points[2]))
+            return distances(*points)
+
+        with mock.patch('TooPath3.stops.distances', side_effect=counted):
+            self.assertEqual([(0, count)], find_stops(timeline, 50, 300))
+        # Every point with those of the next 300 seconds, then the first with all the others.
+        self.assertLess(sum(compared), 302 * count)
+
+
+@override_settings(TOOPATH_RESPONSE_CACHE_ENABLED=True)
+class ResponseCacheCase(APITestCase):
+    def setUp(self):
+        registry.clear()
+        self.client = APIClient()
+        self.user = create_user_with_email('cache@gmail.com')
+        self.device = create_device_with_owner(self.user)
+        self.track = create_track_with_device(self.device)
+        self.location = create_track_location_with_track(self.track)
+        self.track_path = '/devices/%d/tracks/%d/' % (self.device.pk, self.track.pk)
+        self.client.credentials(HTTP_AUTHORIZATION='JWT ' + generate_token_for_user(self.user))
+
+    def hits(self, endpoint):
+        return registry.values.get(('toopath_response_cache_hits_total', (('endpoint', endpoint),)), 0)
+
+    def test_a_repeated_get_is_served_from_the_cache(self):
+        first = self.client.get(path='/devices/%d/' % self.device.pk)
+        with query_stats() as stats:
+            second = self.client.get(path='/devices/%d/' % self.device.pk)
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(1, self.hits('device-detail'))
+        self.assertNotIn('track_locations', ' '.join(stats.queries))
+
+    def test_a_new_location_invalidates_the_track_and_its_device(self):
+        self.client.get(path=self.track_path)
+        self.client.get(path='/devices/%d/' % self.device.pk)
+        create_track_location_with_track(self.track)
+        self.assertEqual(2, len(self.client.get(path=self.track_path).data['locations']['features']))
+        self.assertEqual(2, len(self.client.get(path='/devices/%d/' % self.device.pk)
+                                .data['tracks'][0]['locations']['features']))
+        self.assertEqual(0, self.hits('track-detail'))
+
+    def test_a_deleted_user_invalidates_its_devices(self):
+        keys = [version_key('device', self.device.pk)]
+        versions = get_versions(keys)
+        self.client.delete(path='/users/%d/' % self.user.pk)
+        self.assertNotEqual(versions, get_versions(keys))
+
+    def test_a_deleted_location_invalidates_the_track(self):
+        self.client.get(path=self.track_path)
+        self.client.delete(path='%slocations/%d/' % (self.track_path, self.location.pk))
+        self.assertEqual(0, len(self.client.get(path=self.track_path).data['locations']['features']))
+
+    def test_locations_are_deleted_with_their_track_in_a_single_query(self):
+        for n in range(150):
+            create_track_location_with_track(self.track)
+        with self.assertNumQueries(1):
+            TrackLocation.objects.filter(track=self.track).delete()
+
+    def test_a_transaction_bumps_its_keys_once_more_when_it_commits(self):
+        with mock.patch('TooPath3.caching._new_versions') as new_versions:
+            for n in range(3):
+                create_track_location_with_track(self.track)
+            self.assertEqual(3, new_versions.call_count)
+            # The test's transaction never commits: its callbacks are run by hand.
+            callbacks = [callback for savepoints, callback in connection.run_on_commit if hasattr(callback, 'keys')]
+            self.assertEqual(1, len(callbacks))
+            callbacks[0]()
+        self.assertEqual(4, new_versions.call_count)
+        self.assertIn(version_key('track', self.track.pk), new_versions.call_args[0][0])
+
+    def test_a_deleted_track_is_not_served(self):
+        self.client.get(path=self.track_path)
+        self.track.delete()
+        self.assertEqual(404, self.client.get(path=self.track_path).status_code)
+
+    def test_responses_are_not_shared_between_users(self):
+        self.client.get(path='/devices/%d/' % self.device.pk)
+        other = create_user_with_email('other-cache@gmail.com')
+        self.client.credentials(HTTP_AUTHORIZATION='JWT ' + generate_token_for_user(other))
+        self.assertEqual(403, self.client.get(path='/devices/%d/' % self.device.pk).status_code)
+
+    @override_settings(TOOPATH_RESPONSE_CACHE_ENABLED=False)
+    def test_the_kill_switch_bypasses_the_cache(self):
+        self.client.get(path='/devices/%d/' % self.device.pk)
+        self.client.get(path='/devices/%d/' % self.device.pk)
+        self.assertEqual(0, self.hits('device-detail'))
+
+
+class ConditionalGetCase(APITestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = create_user_with_email('conditional@gmail.com')
+        self.device = create_device_with_owner(self.user)
+        self.track = create_track_with_device(self.device)
+        self.location = create_track_location_with_track(self.track)
+        self.track_path = '/devices/%d/tracks/%d/' % (self.device.pk, self.track.pk)
+        self.client.credentials(HTTP_AUTHORIZATION='JWT ' + generate_token_for_user(self.user))
+
+    def test_a_matching_etag_is_answered_with_304_before_serializing(self):
+        etag = self.client.get(path=self.track_path)['ETag']
+        with query_stats() as stats:
+            response = self.client.get(path=self.track_path, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(etag, response['ETag'])
+        self.assertEqual(b'', response.content)
+        self.assertNotIn('SELECT "track_locations"."id"', ' '.join(stats.queries))
+
+    def test_a_new_location_changes_the_etag_of_its_track_and_device(self):
+        track_etag = self.client.get(path=self.track_path)['ETag']
+        device_etag = self.client.get(path='/devices/%d/' % self.device.pk)['ETag']
+        create_track_location_with_track(self.track)
+        self.assertEqual(200, self.client.get(path=self.track_path, HTTP_IF_NONE_MATCH=track_etag).status_code)
+        self.assertEqual(200, self.client.get(path='/devices/%d/' % self.device.pk,
+                                              HTTP_IF_NONE_MATCH=device_etag).status_code)
+
+    def test_the_validators_of_the_device_list_do_not_read_the_locations(self):
+        etag = self.client.get(path='/devices/')['ETag']
+        with query_stats() as stats:
+            response = self.client.get(path='/devices/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+        self.assertNotIn('track_locations', ' '.join(stats.queries))
+
+    def test_deleted_and_synced_locations_change_the_etag_of_the_list(self):
+        etag = self.client.get(path='/devices/')['ETag']
+        self.client.delete(path=self.track_path + 'locations/%d/' % self.location.pk)
+        self.assertEqual(200, self.client.get(path='/devices/', HTTP_IF_NONE_MATCH=etag).status_code)
+        etag = self.client.get(path='/devices/')['ETag']
+        self.client.post(path=self.track_path + 'sync/',
+                         data={'locations': [{'seq': 1, 'point': {'type': 'Point', 'coordinates': [41.0, 2.0]}}]})
+        self.assertEqual(200, self.client.get(path='/devices/', HTTP_IF_NONE_MATCH=etag).status_code)
+
+    def test_a_deleted_device_changes_the_etag_of_the_list(self):
+        etag = self.client.get(path='/devices/')['ETag']
+        self.assertEqual(304, self.client.get(path='/devices/', HTTP_IF_NONE_MATCH=etag).status_code)
+        self.device.delete()
+        self.assertEqual(200, self.client.get(path='/devices/', HTTP_IF_NONE_MATCH=etag).status_code)
+
+    def test_the_actual_location_honours_if_modified_since(self):
+        last_modified = self.client.get(path='/devices/%d/actualLocation/' % self.device.pk)['Last-Modified']
+        response = self.client.get(path='/devices/%d/actualLocation/' % self.device.pk,
+                                   HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(304, response.status_code)
+
+    def test_other_users_get_no_validators(self):
+        other = create_user_with_email('other-conditional@gmail.com')
+        self.client.credentials(HTTP_AUTHORIZATION='JWT ' + generate_token_for_user(other))
+        response = self.client.get(path=self.track_path, HTTP_IF_NONE_MATCH='*')
+        self.assertEqual(403, response.status_code)
+        self.assertNotIn('ETag', response)
+
+
+@override_settings(TOOPATH_COMPRESSION_MIN_BYTES=0, TOOPATH_COMPRESSION_CHUNK_LOCATIONS=2,
+                   TOOPATH_COMPRESSION_CHUNK_DEVICES=2)
+class CompressedStreamCase(APITestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = create_user_with_email('compression@gmail.com')
+        create_various_devices_with_owner(self.user)
+        self.track = TrackLocation.objects.filter(track__device__owner=self.user).first().track
+        self.track_path = '/devices/%d/tracks/%d/' % (self.track.device_id, self.track.pk)
+        self.client.credentials(HTTP_AUTHORIZATION='JWT ' + generate_token_for_user(self.user))
+
+    def decompressed(self, response):
+        return json.loads(zlib.decompress(b''.join(response.streaming_content), 16 + zlib.MAX_WBITS).decode('utf-8'))
+
+    def test_a_track_is_streamed_compressed_as_the_json_it_would_be(self):
+        response = self.client.get(path=self.track_path, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertTrue(response.streaming)
+        self.assertEqual('gzip', response['Content-Encoding'])
+        self.assertEqual(json.loads(self.client.get(path=self.track_path).content.decode('utf-8')),
+                         self.decompressed(response))
+
+    def test_the_device_list_is_streamed_compressed_as_the_json_it_would_be(self):
+        response = self.client.get(path='/devices/', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(json.loads(self.client.get(path='/devices/').content.decode('utf-8')),
+                         self.decompressed(response))
+        self.assertIn('Accept-Encoding', response['Vary'])
+
+    def test_the_device_list_is_counted_once_per_request(self):
+        with captured_queries() as queries:
+            b''.join(self.client.get(path='/devices/', HTTP_ACCEPT_ENCODING='gzip').streaming_content)
+        self.assertEqual(1, len([sql for sql in queries if 'COUNT(DISTINCT' in sql]))
+
+    def test_a_track_without_its_locations_is_streamed_whole(self):
+        path = self.track_path + '?omit=locations'
+        response = self.client.get(path=path, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertNotIn('locations', self.decompressed(response))
+        self.assertEqual(json.loads(self.client.get(path=path).content.decode('utf-8')), self.decompressed(response))
+
+    @override_settings(TOOPATH_COMPRESSION_MIN_BYTES=10 ** 9)
+    def test_small_responses_are_not_compressed(self):
+        response = self.client.get(path=self.track_path, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse(response.streaming)
+        self.assertNotIn('Content-Encoding', response)
+
+    def test_the_accepted_encoding_honours_quality_values(self):
+        factory = RequestFactory()
+        self.assertEqual('gzip', accepted_encoding(factory.get('/', HTTP_ACCEPT_ENCODING='deflate, gzip;q=0.5')))
+        self.assertIsNone(accepted_encoding(factory.get('/', HTTP_ACCEPT_ENCODING='gzip;q=0, identity')))
+        self.assertIsNone(accepted_encoding(factory.get('/')))
+
+
+class ArchiveCase(APITransactionTestCase):
+    def setUp(self):
+        self.settings = override_settings(TOOPATH_ARCHIVE_DIR=tempfile.mkdtemp(), TOOPATH_RESPONSE_CACHE_ENABLED=False)
+        self.settings.enable()
+        self.client = APIClient()
+        self.user = create_user_with_email('archive@gmail.com')
+        self.device = create_device_with_owner(self.user)
+        self.track = create_track_with_device(self.device)
+        for x, y in ((2.1734, 41.3851), (2.0, 41.0), (-3.7038, 40.4168)):
+            TrackLocation.objects.create(point=Point(x, y, srid=4326), track=self.track)
+        self.track_path = '/devices/%d/tracks/%d/' % (self.device.pk, self.track.pk)
+        self.client.credentials(HTTP_AUTHORIZATION='JWT ' + generate_token_for_user(self.user))
+
+    def tearDown(self):
+        self.settings.disable()
+
+    def locations(self):
+        return self.client.get(path=self.track_path).data['locations']
+
+    def test_columns_come_back_exactly(self):
+        columns = {'id': np.array([3, 7, 8]), 'x': np.array([0.1, -179.99999999, 1e-300]),
+                   'y': np.array([-0.0, 89.123456789012345, 41.38]), 'created_at': np.array([0, 2 ** 50, 5]),
+                   'updated_at': np.array([1, 1, 1]), 'device': np.array([0, 4, 4]), 'seq': np.array([-1, 0, 2 ** 40])}
+        write_archive(self.track.pk, columns)
+        archived = read_archive(self.track.pk)
+        for name, values in columns.items():
+            self.assertEqual(values.tolist(), archived[name].tolist())
+
+    def test_an_archived_track_is_served_as_before(self):
+        before = self.locations()
+        archive_track(self.track.pk)
+        self.assertFalse(TrackLocation.objects.filter(track=self.track).exists())
+        self.assertEqual(3, Track.objects.get(pk=self.track.pk).archived_points)
+        self.assertEqual(before, self.locations())
+        self.assertEqual(before, self.client.get(path='/devices/%d/' % self.device.pk).data['tracks'][0]['locations'])
+
+    def test_synced_points_stay_in_the_table(self):
+        path = self.track_path + 'sync/'
+        batch = {'locations': [{'seq': seq, 'point': {'type': 'Point', 'coordinates': [2.17, 41.38]}}
+                               for seq in (1, 2)]}
+        self.client.post(path, batch)
+        archive_track(self.track.pk)
+        self.assertEqual(3, Track.objects.get(pk=self.track.pk).archived_points)
+        self.assertEqual([1, 2], sorted(TrackLocation.objects.filter(track=self.track).values_list('seq', flat=True)))
+        # A device retrying its upload after the archiving still gets nothing stored twice.
+        self.assertEqual({'seq': 2, 'created': 0}, self.client.post(path, batch).data)
+        self.assertEqual(5, len(self.locations()['features']))
+        self.assertEqual([], list(cold_tracks(-1)))
+
+    def test_downsampled_reads_merge_archived_points(self):
+        start = timezone.now().replace(second=0, microsecond=0) - datetime.timedelta(hours=1)
+        points = list(TrackLocation.objects.filter(track=self.track).order_by('id'))
+        for location, seconds in zip(points, (0, 10, 40)):
+            TrackLocation.objects.filter(pk=location.pk).update(created_at=start + datetime.timedelta(seconds=seconds))
+        archive_track(self.track.pk)
+        points.append(TrackLocation.objects.create(point=Point(1.0, 1.0, srid=4326), track=self.track))
+        TrackLocation.objects.filter(pk=points[-1].pk).update(created_at=start + datetime.timedelta(seconds=45))
+        path = self.track_path + 'locations/'
+        for pick, expected in (('first', [0, 2]), ('last', [1, 3])):
+            response = self.client.get(path=path, data={'bucket': '30s', 'pick': pick})
+            self.assertEqual([points[i].pk for i in expected], [feature['id'] for feature in response.data['features']])
+        self.assertEqual([location.pk for location in points],
+                         [feature['id'] for feature in self.client.get(path=path).data['features']])
+
+    def test_points_added_after_archiving_are_merged(self):
+        archive_track(self.track.pk)
+        TrackLocation.objects.create(point=Point(1.0, 1.0, srid=4326), track=self.track)
+        self.assertEqual(4, len(self.locations()['features']))
+        archive_track(self.track.pk)
+        self.assertEqual(4, len(read_archive(self.track.pk)['id']))
+        self.assertEqual(4, len(self.locations()['features']))
+
+    def test_the_nearest_points_of_an_archived_track_are_the_same(self):
+        path = self.track_path + 'nearest/'
+        before = self.client.get(path, {'point': '2.17,41.38', 'k': 2}).data
+        archive_track(self.track.pk)
+        self.assertEqual(before, self.client.get(path, {'point': '2.17,41.38', 'k': 2}).data)
+
+    def test_an_archived_track_plays_back_the_same(self):
+        times = ','.join(location.created_at.isoformat() for location in TrackLocation.objects.filter(track=self.track))
+        before = self.client.get(self.track_path + 'position/', {'times': times}).data
+        archive_track(self.track.pk)
+        self.assertEqual(before, self.client.get(self.track_path + 'position/', {'times': times}).data)
+
+    def test_deleting_an_archived_point_restores_the_track(self):
+        location = TrackLocation.objects.filter(track=self.track).order_by('id').first()
+        archive_track(self.track.pk)
+        response = self.client.delete(path=self.track_path + 'locations/%d/' % location.pk)
+        self.assertEqual(204, response.status_code)
+        self.assertEqual(2, TrackLocation.objects.filter(track=self.track).count())
+        self.assertEqual(0, Track.objects.get(pk=self.track.pk).archived_points)
+        self.assertFalse(os.path.exists(archive_path(self.track.pk)))
+
+    def test_purging_the_track_removes_its_archive(self):
+        archive_track(self.track.pk)
+        self.client.delete(path=self.track_path)
+        run_pending()
+        self.assertFalse(os.path.exists(archive_path(self.track.pk)))
+
+    def test_a_packed_track_is_served_as_before(self):
+        before = self.locations()
+        pack_track(self.track.pk)
+        track = Track.objects.get(pk=self.track.pk)
+        self.assertFalse(TrackLocation.objects.filter(track=self.track).exists())
+        self.assertEqual(3, track.archived_points)
+        self.assertIsNotNone(track.packed)
+        self.assertEqual(before, self.locations())
+        self.assertNotIn('packed', self.client.get(path=self.track_path).data)
+
+    def test_the_packed_points_are_only_loaded_to_be_rendered(self):
+        pack_track(self.track.pk)
+        with captured_queries() as queries:
+            response = self.client.post(self.track_path + 'locations/',
+                                        {'point': {'type': 'Point', 'coordinates': [2.17, 41.38]}})
+        self.assertEqual(201, response.status_code)
+        self.assertEqual([], [sql for sql in queries if '"packed"' in sql])
+        with captured_queries() as queries:
+            self.assertEqual(4, len(self.locations()['features']))
+        self.assertEqual(1, len([sql for sql in queries if '"packed"' in sql]))
+
+    def test_packing_an_archived_track_moves_it_out_of_its_file(self):
+        archive_track(self.track.pk)
+        TrackLocation.objects.create(point=Point(1.0, 1.0, srid=4326), track=self.track)
+        before = self.locations()
+        pack_track(self.track.pk)
+        self.assertEqual(4, len(unpack(Track.objects.get(pk=self.track.pk).packed)['id']))
+        self.assertFalse(os.path.exists(archive_path(self.track.pk)))
+        self.assertEqual(before, self.locations())
+
+    def test_deleting_a_packed_point_restores_the_track(self):
+        location = TrackLocation.objects.filter(track=self.track).order_by('id').first()
+        pack_track(self.track.pk)
+        response = self.client.delete(path=self.track_path + 'locations/%d/' % location.pk)
+        self.assertEqual(204, response.status_code)
+        track = Track.objects.get(pk=self.track.pk)
+        self.assertEqual(2, TrackLocation.objects.filter(track=self.track).count())
+        self.assertEqual((0, None), (track.archived_points, track.packed))
+
+
+class PackingCase(SimpleTestCase):
+    def test_varints_come_back_exactly(self):
+        values = np.array([0, 1, 127, 128, 300, 2 ** 35, 2 ** 64 - 1], dtype=np.uint64)
+        encoded = encode_varints(values)
+        self.assertEqual(b'\x00\x01\x7f\x80\x01', encoded[:5])
+        self.assertEqual(values.tolist(), decode_varints(encoded, len(values)).tolist())
+
+    def test_columns_come_back_exactly(self):
+        columns = {'id': np.array([3, 7, 8]), 'x': np.array([2.1734, -3.7038, 0.0]),
+                   'y': np.array([-0.0, 89.123456789012345, 1e-300]), 'created_at': np.array([0, 2 ** 50, 5]),
+                   'updated_at': np.array([1, 1, 1]), 'device': np.array([0, 4, 4]),
+                   'seq': np.array([-1, 0, 2 ** 62])}
+        packed = unpack(pack(columns))
+        for name, values in columns.items():
+            self.assertEqual(values.tolist(), packed[name].tolist())
+        self.assertEqual(np.signbit(columns['y']).tolist(), np.signbit(packed['y']).tolist())
+
+    def test_an_empty_track_packs(self):
+        columns = {name: np.array([], dtype=np.int64) for name in ('id', 'created_at', 'updated_at', 'device', 'seq')}
+        columns.update(x=np.array([], dtype=np.float64), y=np.array([], dtype=np.float64))
+        self.assertEqual(0, len(unpack(pack(columns))['x']))
+
+    def test_points_in_order_pack_small(self):
+        count = 1000
+        columns = {'id': np.arange(count), 'created_at': np.arange(count) * 10 ** 6,
+                   'updated_at': np.arange(count) * 10 ** 6, 'device': np.zeros(count, dtype=np.int64),
+                   'seq': np.arange(count), 'x': np.round(2.1734 + np.arange(count) / 10 ** 5, 7),
+                   'y': np.round(41.3851 + np.arange(count) / 10 ** 5, 7)}
+        self.assertLess(len(pack(columns)), 16 * count)
@@ -1,3 +1,6 @@
+from django.conf import settings
+from django.db import transaction
+from rest_framework import serializers
 from rest_framework.authentication import SessionAuthentication, BasicAuthentication
 from rest_framework.generics import get_object_or_404
 from rest_framework.permissions import IsAuthenticated
@@ -6,9 +9,19 @@ from rest_framework.status import *
 from rest_framework.views import APIView
 from rest_framework_jwt.authentication import JSONWebTokenAuthentication
 
+from TooPath3.archive import location_batches
+from TooPath3.caching import cached_response, device_dependencies, track_dependencies
+from TooPath3.compression import compressed_stream, track_bytes
+from TooPath3.conditional import conditional_response, track_validators
 from TooPath3.devices.permissions import IsOwnerOrReadOnly
+from TooPath3.fieldsets import requested_fieldset
+from TooPath3.jobs import enqueue
+from TooPath3.locations.serializers import TrackLocationSerializer, PlaybackQuerySerializer
 from TooPath3.models import Device, Track
-from TooPath3.tracks.serializers import TrackSerializer
+from TooPath3.playback import track_positions
+from TooPath3.renderers import array_chunks, render, streamed_field
+from TooPath3.tracks.serializers import TrackSerializer, StopSerializer
+from TooPath3.utils import alive
 
 
 class TrackList(APIView):
@@ -16,14 +29,19 @@ class TrackList(APIView):
     permission_classes = (IsAuthenticated, IsOwnerOrReadOnly,)
 
     def get_object(self, pk):
-        obj = get_object_or_404(Device, pk=pk)
+        obj = get_object_or_404(alive(Device), pk=pk)
         self.check_object_permissions(self.request, obj=obj)
         return obj
 
+    @cached_response('track-list', device_dependencies)
     def get(self, request, d_pk):
         device = self.get_object(d_pk)
-        tracks = Track.objects.filter(device=device)
-        serializer = TrackSerializer(tracks, many=True)
+        fieldset = requested_fieldset(request)
+        sparse = TrackSerializer(**fieldset)
+        tracks = alive(Track).defer(None).filter(device=device).only(*sparse.columns('device'))
+        if 'locations' in sparse.fields:
+            tracks = tracks.prefetch_related('locations')
+        serializer = TrackSerializer(tracks, many=True, **fieldset)
         return Response(serializer.data, status=HTTP_200_OK)
 
     def post(self, request, d_pk):
@@ -41,20 +59,40 @@ class TrackDetail(APIView):
     authentication_classes = (JSONWebTokenAuthentication, SessionAuthentication, BasicAuthentication,)
     permission_classes = (IsAuthenticated, IsOwnerOrReadOnly,)
 
-    def get_object(self, pk, model_class):
-        obj = get_object_or_404(model_class, pk=pk)
+    def get_object(self, pk, model_class, queryset=None):
+        obj = get_object_or_404(alive(model_class) if queryset is None else queryset, pk=pk)
         self.check_object_permissions(self.request, obj=obj)
         return obj
 
+    def get_sparse_track(self, request, t_pk):
+        """
+         The track and its serializer for the sparse fieldset asked for, with only the columns it renders loaded.
+        """
+        serializer = TrackSerializer(**requested_fieldset(request))
+        serializer.instance = self.get_object(t_pk, Track, alive(Track).defer(None).only(*serializer.columns('device')))
+        return serializer
+
+    @conditional_response(track_validators)
+    @compressed_stream(track_bytes, 'stream')
+    @cached_response('track-detail', track_dependencies)
     def get(self, request, d_pk, t_pk):
         self.get_object(d_pk, Device)
-        track = self.get_object(t_pk, Track)
-        serializer = TrackSerializer(track)
+        serializer = self.get_sparse_track(request, t_pk)
         return Response(serializer.data, status=HTTP_200_OK)
 
+    def stream(self, request, d_pk, t_pk):
+        self.get_object(d_pk, Device)
+        serializer = self.get_sparse_track(request, t_pk)
+        if 'locations' not in serializer.fields:
+            return iter([render(serializer.data)])
+        locations = (render(TrackLocationSerializer(batch, many=True).data['features'])
+                     for batch in location_batches(serializer.instance, settings.TOOPATH_COMPRESSION_CHUNK_LOCATIONS))
+        return streamed_field(serializer, 'locations',
+                              array_chunks(locations, b'{"type":"FeatureCollection","features":[', b']}'))
+
     def patch(self, request, d_pk, t_pk):
         self.get_object(d_pk, Device)
-        track = self.get_object(t_pk, Track)
+        track = self.get_object(t_pk, Track, alive(Track).defer(None))
         serializer = TrackSerializer(track, data=request.data, partial=True)
         if serializer.is_valid():
             track_partial_updated = serializer.save()
@@ -63,7 +101,7 @@ class TrackDetail(APIView):
 
     def put(self, request, d_pk, t_pk):
         self.get_object(d_pk, Device)
-        track = self.get_object(t_pk, Track)
+        track = self.get_object(t_pk, Track, alive(Track).defer(None))
         serializer = TrackSerializer(track, data=request.data)
         if serializer.is_valid():
             track_partial_updated = serializer.save()
@@ -73,5 +111,55 @@ class TrackDetail(APIView):
     def delete(self, request, d_pk, t_pk):
         self.get_object(pk=d_pk, model_class=Device)
         track = self.get_object(pk=t_pk, model_class=Track)
-        track.delete()
+        with transaction.atomic():
+            track.trash = True
+            track.save()
+            enqueue('purge_track', tid=track.tid)
         return Response(status=HTTP_204_NO_CONTENT)
+
+
+class TrackPosition(APIView):
+    """
+     Where the device was at a time, `at`, or at each of a comma-separated list of `times`, interpolated between the
+     points of the track around it. The point is null for times outside the track.
+    """
+    authentication_classes = (JSONWebTokenAuthentication, SessionAuthentication, BasicAuthentication,)
+    permission_classes = (IsAuthenticated, IsOwnerOrReadOnly,)
+
+    def get_object(self, pk, model_class, queryset=None):
+        obj = get_object_or_404(alive(model_class) if queryset is None else queryset, pk=pk)
+        self.check_object_permissions(self.request, obj=obj)
+        return obj
+
+    def get(self, request, d_pk, t_pk):
+        self.get_object(d_pk, Device)
+        track = self.get_object(t_pk, Track, alive(Track).defer(None))
+        query = PlaybackQuerySerializer(data=request.query_params)
+        if not query.is_valid():
+            return Response(query.errors, status=HTTP_400_BAD_REQUEST)
+        dates = query.validated_data.get('times') or [query.validated_data['at']]
+        xs, ys = track_positions(track, dates)
+        to_representation = serializers.DateTimeField().to_representation
+        positions = [{'at': to_representation(date),
+                      'point': None if x != x else {'type': 'Point', 'coordinates': [x, y]}}
+                     for date, x, y in zip(dates, xs.tolist(), ys.tolist())]
+        return Response(positions if 'times' in query.validated_data else positions[0], status=HTTP_200_OK)
+
+
+class TrackStops(APIView):
+    """
+     The stops of the track, as last detected in the background (see TooPath3/stops.py), in arrival order.
+    """
+    authentication_classes = (JSONWebTokenAuthentication, SessionAuthentication, BasicAuthentication,)
+    permission_classes = (IsAuthenticated, IsOwnerOrReadOnly,)
+
+    def get_object(self, pk, model_class):
+        obj = get_object_or_404(alive(model_class), pk=pk)
+        self.check_object_permissions(self.request, obj=obj)
+        return obj
+
+    def get(self, request, d_pk, t_pk):
+        self.get_object(d_pk, Device)
+        track = self.get_object(t_pk, Track)
+        serializer = StopSerializer(track.stops.order_by('arrived_at'), many=True)
+        return Response(serializer.data, status=HTTP_200_OK)
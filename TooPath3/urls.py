@@ -3,22 +3,36 @@ from TooPath3.locations import views as locations_views
 from TooPath3.devices import views as devices_views
 from TooPath3.users import views as users_views
 from TooPath3.tracks import views as tracks_views
+from TooPath3.metrics import metrics_view
 from rest_framework_jwt.views import obtain_jwt_token, refresh_jwt_token, verify_jwt_token
 
 urlpatterns = [
     url(r'^devices/(?P<d_pk>[0-9]+)/tracks/(?P<t_pk>[0-9]+)/locations/(?P<l_pk>[0-9]+)/$',
-        locations_views.TrackLocationDetail.as_view()),
+        locations_views.TrackLocationDetail.as_view(), name='track-location-detail'),
     url(r'^devices/(?P<d_pk>[0-9]+)/tracks/(?P<t_pk>[0-9]+)/locations/$',
-        locations_views.TrackLocationList.as_view()),
-    url(r'^devices/(?P<d_pk>[0-9]+)/tracks/(?P<t_pk>[0-9]+)/$', tracks_views.TrackDetail.as_view()),
-    url(r'^devices/(?P<d_pk>[0-9]+)/tracks/$', tracks_views.TrackList.as_view()),
-    url(r'^devices/(?P<d_pk>[0-9]+)/actualLocation/$', locations_views.DeviceActualLocation.as_view()),
-    url(r'^devices/(?P<d_pk>[0-9]+)/$', devices_views.DeviceDetail.as_view()),
-    url(r'^devices/$', devices_views.DeviceList.as_view()),
-    url(r'^users/(?P<u_pk>[0-9]+)/$', users_views.UserDetail.as_view()),
-    url(r'^users/$', users_views.UserList.as_view()),
-    url(r'^login-google/$', users_views.UserGoogleLogIn.as_view()),
-    url(r'^login/$', users_views.UserLogin.as_view()),
-    url(r'^api-token-refresh/$', refresh_jwt_token),
-    url(r'^api-token-verify/$', verify_jwt_token),
+        locations_views.TrackLocationList.as_view(), name='track-location-list'),
+    url(r'^devices/(?P<d_pk>[0-9]+)/tracks/(?P<t_pk>[0-9]+)/nearest/$',
+        locations_views.TrackLocationNearest.as_view(), name='track-nearest'),
+    url(r'^devices/(?P<d_pk>[0-9]+)/tracks/(?P<t_pk>[0-9]+)/position/$', tracks_views.TrackPosition.as_view(),
+        name='track-position'),
+    url(r'^devices/(?P<d_pk>[0-9]+)/tracks/(?P<t_pk>[0-9]+)/stops/$', tracks_views.TrackStops.as_view(),
+        name='track-stops'),
+    url(r'^devices/(?P<d_pk>[0-9]+)/tracks/(?P<t_pk>[0-9]+)/sync/$',
+        locations_views.TrackLocationSync.as_view(), name='track-sync'),
+    url(r'^devices/(?P<d_pk>[0-9]+)/tracks/(?P<t_pk>[0-9]+)/$', tracks_views.TrackDetail.as_view(),
+        name='track-detail'),
+    url(r'^devices/(?P<d_pk>[0-9]+)/tracks/$', tracks_views.TrackList.as_view(), name='track-list'),
+    url(r'^devices/(?P<d_pk>[0-9]+)/actualLocation/$', locations_views.DeviceActualLocation.as_view(),
+        name='device-actual-location'),
+    url(r'^devices/(?P<d_pk>[0-9]+)/$', devices_views.DeviceDetail.as_view(), name='device-detail'),
+    url(r'^devices/nearby/$', devices_views.DeviceNearby.as_view(), name='device-nearby'),
+    url(r'^devices/clusters/$', devices_views.DeviceClusters.as_view(), name='device-clusters'),
+    url(r'^devices/$', devices_views.DeviceList.as_view(), name='device-list'),
+    url(r'^users/(?P<u_pk>[0-9]+)/$', users_views.UserDetail.as_view(), name='user-detail'),
+    url(r'^users/$', users_views.UserList.as_view(), name='user-list'),
+    url(r'^login-google/$', users_views.UserGoogleLogIn.as_view(), name='login-google'),
+    url(r'^login/$', users_views.UserLogin.as_view(), name='login'),
+    url(r'^api-token-refresh/$', refresh_jwt_token, name='api-token-refresh'),
+    url(r'^api-token-verify/$', verify_jwt_token, name='api-token-verify'),
+    url(r'^metrics/$', metrics_view, name='metrics'),
 ]
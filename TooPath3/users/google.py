@@ -0,0 +1,141 @@
+import json
+import re
+import threading
+import time
+
+import jwt
+import requests
+from django.conf import settings
+from jwt.algorithms import RSAAlgorithm
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+GOOGLE_ISSUERS = ('accounts.google.com', 'https://accounts.google.com')
+MAX_AGE = re.compile(r'max-age=(\d+)')
+
+
+def build_session():
+    session = requests.Session()
+    retries = Retry(total=2, backoff_factor=0.2, status_forcelist=(500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.TOOPATH_GOOGLE_POOL_SIZE, max_retries=retries)
+    session.mount('https://', adapter)
+    return session
+
+
+class GoogleKeySet(object):
+    """
+     Google signing keys, fetched once and refreshed in the background shortly before they expire. A kid missing
+     from them is only looked for again once TOOPATH_GOOGLE_MIN_REFRESH_SECONDS have passed since the last fetch.
+    """
+
+    def __init__(self, url=None, session=None):
+        self.url = url or settings.TOOPATH_GOOGLE_CERTS_URL
+        self.session = session
+        self._keys = {}
+        self._expires_at = 0
+        self._fetched_at = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def load(self, jwks, max_age):
+        self._keys = {jwk['kid']: RSAAlgorithm.from_jwk(json.dumps(jwk)) for jwk in jwks['keys']}
+        self._expires_at = time.time() + max_age
+
+    def refresh(self):
+        self._fetched_at = time.time()
+        if self.session is None:
+            self.session = build_session()
+        response = self.session.get(self.url, timeout=settings.TOOPATH_GOOGLE_TIMEOUT)
+        response.raise_for_status()
+        max_age = MAX_AGE.search(response.headers.get('Cache-Control', ''))
+        self.load(response.json(), int(max_age.group(1)) if max_age else settings.TOOPATH_GOOGLE_KEYS_MAX_AGE)
+
+    def _may_refresh(self):
+        return self._fetched_at is None or time.time() - self._fetched_at >= settings.TOOPATH_GOOGLE_MIN_REFRESH_SECONDS
+
+    def _stale(self, kid):
+        return (kid not in self._keys or time.time() >= self._expires_at) and self._may_refresh()
+
+    def get(self, kid):
+        if self._stale(kid):
+            # Nothing usable yet: the first caller fetches the keys while the others wait for it.
+            with self._lock:
+                if self._stale(kid):
+                    self.refresh()
+        elif kid in self._keys and time.time() >= self._expires_at - settings.TOOPATH_GOOGLE_REFRESH_MARGIN:
+            self._refresh_in_background()
+        return self._keys.get(kid)
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing or not self._may_refresh():
+                return
+            self._refreshing = True
+        threading.Thread(target=self._background_refresh, daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            with self._lock:
+                self.refresh()
+        except (requests.RequestException, ValueError):
+            pass
+        finally:
+            self._refreshing = False
+
+
+class VerifiedTokenCache(object):
+    """
+     Claims of the already verified tokens, kept until the token expires.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size or settings.TOOPATH_GOOGLE_TOKEN_CACHE_SIZE
+        self._claims = {}
+
+    def get(self, token):
+        claims = self._claims.get(token)
+        if claims is not None and claims['exp'] <= time.time():
+            self._claims.pop(token, None)
+            return None
+        return claims
+
+    def set(self, token, claims):
+        if len(self._claims) >= self.max_size:
+            now = time.time()
+            self._claims = {key: value for key, value in self._claims.items() if value['exp'] > now}
+            if len(self._claims) >= self.max_size:
+                self._claims.clear()
+        self._claims[token] = claims
+
+    def clear(self):
+        self._claims.clear()
+
+
+google_keys = GoogleKeySet()
+verified_tokens = VerifiedTokenCache()
+
+
+def verify_id_token(token):
+    """
+     Returns the claims of a Google id_token signed by Google for one of our clients, with a verified email, None
+     otherwise. Every token is refused until TOOPATH_GOOGLE_CLIENT_IDS lists the clients.
+    """
+    claims = verified_tokens.get(token)
+    if claims is not None:
+        return claims
+    try:
+        key = google_keys.get(jwt.get_unverified_header(token).get('kid'))
+        if key is None:
+            return None
+        claims = jwt.decode(token, key, algorithms=['RS256'], options={'verify_aud': False})
+    except (jwt.InvalidTokenError, requests.RequestException, ValueError):
+        return None
+    if claims.get('iss') not in GOOGLE_ISSUERS or 'exp' not in claims:
+        return None
+    if claims.get('aud') not in settings.TOOPATH_GOOGLE_CLIENT_IDS:
+        return None
+    # A boolean in id_tokens, a string in what the tokeninfo endpoint used to answer.
+    if claims.get('email_verified') not in (True, 'true'):
+        return None
+    verified_tokens.set(token, claims)
+    return claims
@@ -2,10 +2,11 @@ from django.contrib.auth.hashers import make_password
 from rest_framework import serializers
 
 from TooPath3.constants import DEFAULT_ERROR_MESSAGES
+from TooPath3.fieldsets import SparseFieldsetMixin
 from TooPath3.models import CustomUser
 
 
-class CustomUserSerializer(serializers.ModelSerializer):
+class CustomUserSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = CustomUser
         fields = '__all__'
@@ -22,7 +23,7 @@ class CustomUserSerializer(serializers.ModelSerializer):
 
 
 # Custom User Serializer for GET methods
-class PublicCustomUserSerializer(serializers.ModelSerializer):
+class PublicCustomUserSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = CustomUser
         fields = ('id', 'username', 'email', 'first_name', 'last_name', 'date_joined', 'last_login')
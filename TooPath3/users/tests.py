@@ -1,9 +1,18 @@
+import json
+import time
+from unittest import mock
+
 import jwt
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import rsa
 from django.contrib.auth.hashers import make_password
+from django.test import override_settings
+from jwt.algorithms import RSAAlgorithm
 from rest_framework.test import APITestCase, APIClient
 from rest_framework_jwt.settings import api_settings
 
 from TooPath3.constants import DEFAULT_ERROR_MESSAGES
+from TooPath3.users import google
 from TooPath3.users.views import *
 from TooPath3.utils import create_user_with_email, generate_token_for_user, get_latest_id_inserted
 
@@ -177,6 +186,25 @@ class DeleteUserCase(APITestCase):
         response = self.client.delete(path='/users/' + str(user.pk) + '/')
         self.assertEqual(response.status_code, HTTP_403_FORBIDDEN)
 
+    def test_deleted_user_can_not_log_in_nor_use_its_token(self):
+        user = CustomUser.objects.create(username='deleted', email='deleted@gmail.com', password=make_password('test'))
+        self.client.credentials(HTTP_AUTHORIZATION='JWT ' + generate_token_for_user(user))
+        self.client.delete(path='/users/' + str(user.pk) + '/')
+        response = self.client.post(path='/login/', data={'email': 'deleted@gmail.com', 'password': 'test'},
+                                    format='json')
+        self.assertEqual(response.data, DEFAULT_ERROR_MESSAGES['invalid_email'])
+        response = self.client.get(path='/users/' + str(user.pk) + '/')
+        self.assertEqual(response.status_code, HTTP_401_UNAUTHORIZED)
+
+    def test_deleted_user_email_can_sign_up_again_before_the_purge(self):
+        user = create_user_with_email('again@gmail.com')
+        self.client.credentials(HTTP_AUTHORIZATION='JWT ' + generate_token_for_user(user))
+        self.client.delete(path='/users/' + str(user.pk) + '/')
+        self.client.credentials(HTTP_AUTHORIZATION='')
+        json_body = {'username': 'again', 'email': 'again@gmail.com', 'password': 'test_password'}
+        response = self.client.post(path='/users/', data=json_body, format='json')
+        self.assertEqual(response.status_code, HTTP_201_CREATED)
+
 
 class LoginTestCase(APITestCase):
     class PayloadObject:
@@ -235,3 +263,88 @@ class LoginTestCase(APITestCase):
         ).decode('utf-8')
         response = self.client.post(path='/api-token-verify/', data={"token": token}, format='json')
         self.assertEqual(response.status_code, HTTP_200_OK)
+
+
+@override_settings(TOOPATH_GOOGLE_CLIENT_IDS=['toopath-client'])
+class GoogleLogInCase(APITestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+        jwk = json.loads(RSAAlgorithm.to_jwk(self.private_key.public_key()))
+        jwk['kid'] = 'local-key'
+        google.google_keys.load({'keys': [jwk]}, max_age=3600)
+        google.verified_tokens.clear()
+
+    def _google_token(self, email='google@gmail.com', expires_in=600, kid='local-key', private_key=None,
+                      email_verified=True):
+        claims = {'iss': 'https://accounts.google.com', 'aud': 'toopath-client', 'email': email,
+                  'email_verified': email_verified, 'exp': int(time.time()) + expires_in, 'iat': int(time.time())}
+        return jwt.encode(claims, private_key or self.private_key, algorithm='RS256',
+                          headers={'kid': kid}).decode('utf-8')
+
+    def _log_in(self, token, email='google@gmail.com'):
+        json_body = {'email': email, 'google_token': token, 'name': 'Google User'}
+        return self.client.post(path='/login-google/', data=json_body, format='json')
+
+    def test_return_200_status__when_google_token_is_valid(self):
+        response = self._log_in(self._google_token())
+        self.assertEqual(response.status_code, HTTP_200_OK)
+        self.assertTrue(CustomUser.objects.filter(email='google@gmail.com').exists())
+
+    def test_return_400_status__when_google_token_is_signed_by_another_key(self):
+        other_key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+        response = self._log_in(self._google_token(private_key=other_key))
+        self.assertEqual(response.data, DEFAULT_ERROR_MESSAGES['invalid_google_token'])
+
+    def test_return_400_status__when_google_token_is_expired(self):
+        response = self._log_in(self._google_token(expires_in=-60))
+        self.assertEqual(response.status_code, HTTP_400_BAD_REQUEST)
+
+    def test_return_400_status__when_google_token_belongs_to_another_email(self):
+        response = self._log_in(self._google_token(email='other@gmail.com'))
+        self.assertEqual(response.status_code, HTTP_400_BAD_REQUEST)
+
+    def test_deleted_user_google_log_in_gets_a_new_account(self):
+        self._log_in(self._google_token())
+        user = CustomUser.objects.get(email='google@gmail.com')
+        self.client.credentials(HTTP_AUTHORIZATION='JWT ' + generate_token_for_user(user))
+        self.client.delete(path='/users/' + str(user.pk) + '/')
+        self.client.credentials(HTTP_AUTHORIZATION='')
+        response = self._log_in(self._google_token())
+        self.assertEqual(response.status_code, HTTP_200_OK)
+        self.assertNotEqual(user.pk, response.data['user']['id'])
+
+    def test_return_400_status__when_audience_is_not_a_client(self):
+        with self.settings(TOOPATH_GOOGLE_CLIENT_IDS=['another-client']):
+            response = self._log_in(self._google_token())
+        self.assertEqual(response.status_code, HTTP_400_BAD_REQUEST)
+
+    def test_return_400_status__when_no_client_is_configured(self):
+        with self.settings(TOOPATH_GOOGLE_CLIENT_IDS=[]):
+            response = self._log_in(self._google_token())
+        self.assertEqual(response.status_code, HTTP_400_BAD_REQUEST)
+
+    def test_return_400_status__when_email_is_not_verified(self):
+        response = self._log_in(self._google_token(email_verified=False))
+        self.assertEqual(response.status_code, HTTP_400_BAD_REQUEST)
+        self.assertFalse(CustomUser.objects.filter(email='google@gmail.com').exists())
+
+    def test_verified_token_is_not_decoded_again(self):
+        token = self._google_token()
+        google.verify_id_token(token)
+        with mock.patch('TooPath3.users.google.jwt.decode') as decode:
+            claims = google.verify_id_token(token)
+        decode.assert_not_called()
+        self.assertEqual('google@gmail.com', claims['email'])
+
+    def test_unknown_kids_do_not_fetch_the_keys_every_time(self):
+        session = mock.Mock()
+        session.get.return_value.headers = {'Cache-Control': 'public, max-age=3600'}
+        session.get.return_value.json.return_value = {'keys': []}
+        keys = google.GoogleKeySet(url='https://keys.test/', session=session)
+        for attempt in range(5):
+            self.assertIsNone(keys.get('unknown-key'))
+        self.assertEqual(1, session.get.call_count)
+        with mock.patch('TooPath3.users.google.time.time', return_value=time.time() + 61):
+            keys.get('unknown-key')
+        self.assertEqual(2, session.get.call_count)
@@ -1,4 +1,8 @@
+import uuid
+
+from django.db import transaction
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
 from rest_framework.authentication import SessionAuthentication, BasicAuthentication
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
@@ -6,9 +10,12 @@ from rest_framework.status import *
 from rest_framework.views import APIView
 from rest_framework_jwt.authentication import JSONWebTokenAuthentication
 
+from TooPath3.caching import bump, version_key
 from TooPath3.constants import DEFAULT_ERROR_MESSAGES
 from TooPath3.devices.permissions import IsOwnerOrReadOnly
-from TooPath3.models import CustomUser
+from TooPath3.fieldsets import requested_fieldset
+from TooPath3.jobs import enqueue
+from TooPath3.models import CustomUser, Device
 from TooPath3.users.serializers import CustomUserSerializer, PublicCustomUserSerializer, LoginSerializer, \
     GoogleLoginSerializer
 from TooPath3.utils import generate_token_for_user, validate_google_token, generate_user_info_from_google
@@ -18,14 +25,14 @@ class UserDetail(APIView):
     authentication_classes = (JSONWebTokenAuthentication, SessionAuthentication, BasicAuthentication,)
     permission_classes = (IsAuthenticated, IsOwnerOrReadOnly,)
 
-    def get_object(self, pk):
-        obj = get_object_or_404(CustomUser, pk=pk)
+    def get_object(self, pk, queryset=None):
+        obj = get_object_or_404(CustomUser if queryset is None else queryset, pk=pk)
         self.check_object_permissions(self.request, obj=obj)
         return obj
 
     def get(self, request, u_pk):
-        user = self.get_object(u_pk)
-        serializer = PublicCustomUserSerializer(instance=user)
+        serializer = PublicCustomUserSerializer(**requested_fieldset(request))
+        serializer.instance = self.get_object(u_pk, CustomUser.objects.only(*serializer.columns()))
         return Response(status=HTTP_200_OK, data=serializer.data)
 
     def patch(self, request, u_pk):
@@ -46,7 +53,22 @@ class UserDetail(APIView):
 
     def delete(self, request, u_pk):
         user = self.get_object(pk=u_pk)
-        user.delete()
+        # An inactive user can't authenticate anymore; the account and its devices are purged in the background.
+        with transaction.atomic():
+            user.is_active = False
+            # A new secret voids the tokens already issued, and the email and username are released so the address
+            # can sign up again before the purge runs.
+            user.jwt_secret = uuid.uuid4()
+            user.email = '%d@deleted.invalid' % user.pk
+            user.username = 'deleted-%d' % user.pk
+            user.save()
+            devices = Device.objects.filter(owner=user)
+            dids = list(devices.values_list('did', flat=True))
+            # Stamped as a save would be, for the processes polling the updated devices (see TooPath3/proximity.py),
+            # and bumped as its signal would, since an update sends none.
+            devices.update(trash=True, updated_at=timezone.now())
+            bump(*[version_key('device', did) for did in dids])
+            enqueue('purge_user', user_id=user.pk)
         return Response(status=HTTP_204_NO_CONTENT)
 
 
@@ -64,7 +86,7 @@ class UserLogin(APIView):
         serializer = LoginSerializer(data=request.data)
         if serializer.is_valid():
             try:
-                user = CustomUser.objects.get(email=serializer.validated_data['email'])
+                user = CustomUser.objects.get(email=serializer.validated_data['email'], is_active=True)
             except CustomUser.DoesNotExist:
                 return Response(data=DEFAULT_ERROR_MESSAGES['invalid_email'], status=HTTP_400_BAD_REQUEST)
             if not user.check_password(serializer.validated_data['password']):
@@ -79,10 +101,11 @@ class UserGoogleLogIn(APIView):
     def post(self, request):
         serializer = GoogleLoginSerializer(data=request.data)
         if serializer.is_valid():
-            response = validate_google_token(serializer.validated_data['google_token'])
-            if response.status_code == 200:
+            claims = validate_google_token(serializer.validated_data['google_token'],
+                                           serializer.validated_data['email'])
+            if claims is not None:
                 try:
-                    user = CustomUser.objects.get(email=serializer.validated_data['email'])
+                    user = CustomUser.objects.get(email=serializer.validated_data['email'], is_active=True)
                 except CustomUser.DoesNotExist:
                     user_info = generate_user_info_from_google(email=serializer.validated_data['email'],
                                                                name=serializer.validated_data['name'])
@@ -1,8 +1,7 @@
 from django.contrib.auth.hashers import make_password
 from django.contrib.gis.geos import Point
-import requests
 from rest_framework_jwt.settings import api_settings
-from TooPath3.models import CustomUser, Device, Track, TrackLocation
+from TooPath3.models import CustomUser, Device, Track, TrackLocation, ActualLocation
 
 
 def get_jwt_secret(user):
@@ -17,6 +16,22 @@ def generate_token_for_user(user):
     return jwt_encode_handler(payload)
 
 
+def alive(model_class):
+    """
+     The rows of `model_class` that aren't trashed, nor belong to something trashed and waiting to be purged.
+    """
+    if model_class is Device:
+        return Device.objects.filter(trash=False)
+    if model_class is Track:
+        # The packed points are only loaded by the views rendering them, with `.defer(None)`.
+        return Track.objects.filter(trash=False, device__trash=False).defer('packed')
+    if model_class is ActualLocation:
+        return ActualLocation.objects.filter(device__trash=False)
+    if model_class is TrackLocation:
+        return TrackLocation.objects.filter(track__trash=False)
+    return model_class.objects.all()
+
+
 def get_latest_id_inserted(model_class):
     return model_class.objects.latest('pk').pk
 
@@ -55,9 +70,13 @@ def create_various_track_locations_with_track(track):
         count += 1
 
 
-def validate_google_token(token):
-    params = {'id_token': token}
-    return requests.post('https://www.googleapis.com/oauth2/v3/tokeninfo', params=params)
+def validate_google_token(token, email):
+    # requests and cryptography are only needed here, workers that never see a Google login don't import them.
+    from TooPath3.users.google import verify_id_token
+    claims = verify_id_token(token)
+    if claims is None or claims.get('email', '').lower() != email.lower():
+        return None
+    return claims
 
 
 def generate_user_info_from_google(email, name):
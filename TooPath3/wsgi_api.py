@@ -0,0 +1,13 @@
+"""
+WSGI entry point of the API workers, with the slim `TooPath3.settings.api` profile.
+
+Serve it with e.g. ``gunicorn TooPath3.wsgi_api`` and point TOOPATH3_API_BASE_SETTINGS at the deployment settings.
+"""
+
+import os
+
+from django.core.wsgi import get_wsgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "TooPath3.settings.api")
+
+application = get_wsgi_application()
@@ -5,5 +5,8 @@ set -e
 python manage.py migrate --settings=TooPath3.settings.docker
 
 export DJANGO_SETTINGS_MODULE=TooPath3.settings.docker
-exec gunicorn -b 0.0.0.0:8080 TooPath3.wsgi
+# Metrics snapshots of the previous workers, counters start from zero again
+rm -rf "${TOOPATH3_METRICS_DIR:-/tmp/toopath3-metrics}"
+export TOOPATH3_API_BASE_SETTINGS=TooPath3.settings.docker
+DJANGO_SETTINGS_MODULE=TooPath3.settings.api exec gunicorn -b 0.0.0.0:8080 TooPath3.wsgi_api
 